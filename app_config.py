@@ -8,7 +8,7 @@ from genetic_algorithm.fitness_function.fitness_constants import MISSING_ACCOMP_
 # enables
 from logging.logging_constants import WARNING_LEVEL, DEBUG_LEVEL
 from music_interfaces.composition.composition_constants import MAJOR_TONIC, MINOR_TONIC, MAJOR_TRIAD, MINOR_TRIAD, \
-    DIMINISHED_CHORD
+    DIMINISHED_CHORD, LEGACY_KEY_DETECTION
 
 # metrics
 
@@ -40,8 +40,15 @@ ALLOWED_ACCOMP_TRIADS_FOR_MELODY_TONIC = {
                   [7 + note for note in MINOR_TRIAD], [8 + note for note in MAJOR_TRIAD],
                   [10 + note for note in MAJOR_TRIAD]]
 }
+# melody key for CORRECT_TRIAD_FOR_MELODY_KEY: LEGACY_KEY_DETECTION is Composition.key, GLOBAL_KEY_DETECTION is one
+# key of all notes by pitch classes and WINDOWED_KEY_DETECTION is a local key at each beat (see key_analysis)
+KEY_DETECTION = LEGACY_KEY_DETECTION
+# beats of windows of WINDOWED_KEY_DETECTION
+KEY_WINDOW_BEATS = 16
 TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES = 12
 TOO_LOW_NOTE_UPPER_BOUND = 23
+# JSON file with chord progressions that replace the built-in ones, see progression_index.load_progressions
+PROGRESSIONS_PATH = None
 
 # award values for metrics
 EVENT_TO_AWARD_WEIGHTS = {
@@ -67,6 +74,25 @@ EVENT_TO_AWARD_WEIGHTS = {
 # definitions
 
 MAX_MUTATION_SHIFT = 12
+# share of mutation chance of targeted mutation spread over all beats, the rest goes to beats with penalties
+TARGETED_MUTATION_BASE_SHARE = 0.2
+
+
+# selection
+
+# definitions
+
+# number of random candidates that compete for each parent in tournament selection
+TOURNAMENT_SIZE = 3
+
+
+# stagnation
+
+# definitions
+
+STAGNATION_MUTATION_FACTOR = 2
+STAGNATION_MAX_MUTATION_CHANCE = 0.1
+STAGNATION_RERANDOMIZED_SHARE = 0.5
 
 
 # note
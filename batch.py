@@ -0,0 +1,173 @@
+import csv
+import json
+import os
+import signal
+import time
+import traceback
+from argparse import ArgumentParser, Namespace
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection, wait
+from typing import Any, Dict, List
+
+from app_config import EVENT_TO_AWARD_WEIGHTS
+from main import parser as run_parser, read_config, run
+
+BATCH_WORKERS_NUM_DEFAULT = None
+FILE_TIMEOUT_DEFAULT = None
+RESULTS_FILE_NAME_DEFAULT = "batch_results.jsonl"
+MIDI_EXTENSIONS = (".mid", ".midi")
+OK_STATUS = "ok"
+ERROR_STATUS = "error"
+TIMEOUT_STATUS = "timeout"
+RESULT_FIELDS = ["input_file_path", "status", "fitness", "execution_time", "wall_time", "save_dir_path", "error"]
+
+# Specify inputs, options of main.py are shared by all runs
+parser = ArgumentParser(parents=[run_parser], add_help=False)
+parser.add_argument("-id", "--input_dir", dest="input_dir",
+                    help=f"Directory with input MIDI files, searched recursively for {', '.join(MIDI_EXTENSIONS)} "
+                         f"files.", metavar="PATH")
+parser.add_argument("-mf", "--manifest", dest="manifest",
+                    help="Text file with a path to an input MIDI file per line, relative paths are resolved against "
+                         "directory of the manifest. Empty lines and lines starting with # are skipped.",
+                    metavar="PATH")
+parser.add_argument("-bwn", "--batch_workers_num", dest="batch_workers_num",
+                    help="Number of melodies processed at once, each in a separate process. Default: number of cores",
+                    metavar="INT")
+parser.add_argument("-ft", "--file_timeout", dest="file_timeout",
+                    help=f"Seconds after which processing of a melody is stopped and recorded as timed out. "
+                         f"Default: {FILE_TIMEOUT_DEFAULT}", metavar="FLOAT")
+parser.add_argument("-rp", "--results_path", dest="results_path",
+                    help=f"Path to aggregated results of all melodies, CSV if it ends with .csv and JSON lines "
+                         f"otherwise. Default: save_dir_path/{RESULTS_FILE_NAME_DEFAULT}", metavar="PATH")
+
+
+def find_input_files(input_dir: str = None, manifest: str = None) -> List[str]:
+    """Returns paths of MIDI files in the input directory or listed in the manifest."""
+    if manifest is not None:
+        manifest_dir = os.path.dirname(manifest)
+        with open(manifest) as manifest_file:
+            lines = [line.strip() for line in manifest_file]
+        return [os.path.join(manifest_dir, line) for line in lines if line and not line.startswith("#")]
+    return sorted(os.path.join(dir_path, file_name) for dir_path, dir_names, file_names in os.walk(input_dir)
+                  for file_name in file_names if file_name.lower().endswith(MIDI_EXTENSIONS))
+
+
+def run_batch(config: Namespace, input_file_paths: List[str], results_path: str, workers_num: int,
+              file_timeout: float = None) -> List[Dict[str, Any]]:
+    """Runs main.run for each input file in a separate process, at most workers_num at once, and returns their results.
+
+    Results of each file are saved to save_dir_path/<input file name>/<n>/ as by main.py and appended to results_path
+    as soon as the file is processed. A failure or timeout of a file is recorded in its result and does not affect
+    other files.
+
+    """
+    assert workers_num >= 1, "workers_num must be positive"
+    assert file_timeout is None or file_timeout > 0, "file_timeout must be positive"
+    pending = list(reversed(input_file_paths))
+    running = {}
+    results = []
+    with open(results_path, "w", newline="") as results_file:
+        writer = _ResultsWriter(results_file, csv_format=results_path.lower().endswith(".csv"))
+        while pending or running:
+            while pending and len(running) < workers_num:
+                input_file_path = pending.pop()
+                connection, worker_connection = Pipe(duplex=False)
+                process = Process(target=_run_file, args=(config, input_file_path, worker_connection))
+                process.start()
+                worker_connection.close()
+                running[connection] = (input_file_path, process, time.perf_counter())
+            deadlines = [start_time + file_timeout for input_file_path, process, start_time in running.values()] \
+                if file_timeout is not None else []
+            for connection in wait(list(running.keys()),
+                                   timeout=max(0.0, min(deadlines) - time.perf_counter()) if deadlines else None):
+                input_file_path, process, start_time = running.pop(connection)
+                try:
+                    result = connection.recv()
+                    process.join()
+                except EOFError:
+                    process.join()
+                    result = {"status": ERROR_STATUS, "error": f"worker exited with code {process.exitcode}"}
+                results.append(writer.write(input_file_path, result, time.perf_counter() - start_time))
+            for connection, (input_file_path, process, start_time) in list(running.items()):
+                if file_timeout is not None and time.perf_counter() - start_time >= file_timeout:
+                    running.pop(connection)
+                    _terminate(process)
+                    results.append(writer.write(input_file_path, {"status": TIMEOUT_STATUS,
+                                                                  "error": f"timeout after {file_timeout} s"},
+                                                time.perf_counter() - start_time))
+    return results
+
+
+class _ResultsWriter:
+    """Writes a row of aggregated results per file, as CSV with a column per metric or as JSON lines."""
+    def __init__(self, results_file, csv_format: bool):
+        self.results_file = results_file
+        self.csv_writer = csv.DictWriter(results_file, fieldnames=RESULT_FIELDS + list(EVENT_TO_AWARD_WEIGHTS.keys())) \
+            if csv_format else None
+        if self.csv_writer is not None:
+            self.csv_writer.writeheader()
+
+    def write(self, input_file_path: str, result: Dict[str, Any], wall_time: float) -> Dict[str, Any]:
+        """Writes result of the file and returns it as a row."""
+        row = {field: None for field in RESULT_FIELDS}
+        row.update(result, input_file_path=input_file_path, wall_time=wall_time)
+        print(f"{row['status']}\t{input_file_path}\tfitness: {row['fitness']}\ttime: {wall_time:.2f} s"
+              + (f"\t{row['error']}" if row["error"] is not None else ""))
+        if self.csv_writer is not None:
+            self.csv_writer.writerow({**{field: row[field] for field in RESULT_FIELDS}, **(row.get("metrics") or {})})
+        else:
+            self.results_file.write(json.dumps(row) + "\n")
+        self.results_file.flush()
+        return row
+
+
+def _run_file(config: Namespace, input_file_path: str, connection: Connection):
+    """Runs main.run for the input file and sends its result or error to the connection."""
+    if hasattr(os, "setpgrp"):
+        # own process group lets timeout stop worker processes of the run too
+        os.setpgrp()
+    input_file_name = os.path.splitext(os.path.basename(input_file_path))[0]
+    try:
+        result = run(config, input_file_path, save_dir_path=os.path.join(config.save_dir_path, input_file_name))
+        result["status"] = OK_STATUS
+    except Exception as error:
+        traceback.print_exc()
+        result = {"status": ERROR_STATUS, "error": f"{type(error).__name__}: {error}"}
+    connection.send(result)
+    connection.close()
+
+
+def _terminate(process: Process):
+    """Stops the process with processes it started."""
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        process.terminate()
+    process.join()
+
+
+def main():
+    args = parser.parse_args()
+    config = read_config(args)
+    if (args.input_dir is None) == (args.manifest is None):
+        parser.error("specify either input_dir or manifest")
+    workers_num = int(args.batch_workers_num) if args.batch_workers_num is not None \
+        else BATCH_WORKERS_NUM_DEFAULT or os.cpu_count()
+    file_timeout = float(args.file_timeout) if args.file_timeout is not None else FILE_TIMEOUT_DEFAULT
+    results_path = args.results_path or os.path.join(config.save_dir_path, RESULTS_FILE_NAME_DEFAULT)
+    os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+    input_file_paths = find_input_files(input_dir=args.input_dir, manifest=args.manifest)
+
+    start_time = time.time()
+    results = run_batch(config, input_file_paths, results_path, workers_num=workers_num, file_timeout=file_timeout)
+    statuses = [result["status"] for result in results]
+    print(f"Processed {len(results)} files in {time.time() - start_time} s: "
+          + ", ".join(f"{statuses.count(status)} {status}" for status in [OK_STATUS, ERROR_STATUS, TIMEOUT_STATUS]))
+    print(f"Results were saved to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Tuple
+
+import mido
+import numpy as np
+
+from app_config import KEY_WINDOW_BEATS
+from genetic_algorithm.crossover_strategy import make_crossover, make_genome_crossover
+from genetic_algorithm.fitness_function.batch_fitness_function import batch_fitness_function
+from genetic_algorithm.fitness_function.fitness_function import fitness_function
+from genetic_algorithm.fitness_function.table_fitness_function import TableFitnessFunction
+from genetic_algorithm.genetic_algorithm import GeneticAlgorithm
+from genetic_algorithm.melody_context import MelodyContext
+from genetic_algorithm.mutation_strategy import make_mutation, get_random_candidate, make_genome_mutation, \
+    get_random_genome
+from genetic_algorithm.population_operators import PopulationOperators
+from music_interfaces.composition.composition import Composition
+from music_interfaces.composition.key_analysis import estimate_key, pitch_class_histogram, windowed_keys
+from music_interfaces.note import CompositionNote
+
+INPUT_DIR_DEFAULT = "input/"
+SYNTHETIC_BEATS_NUMS_DEFAULT = "2000,10000"
+POPULATION_SIZES_DEFAULT = "50,200"
+SOLVE_GENERATIONS_DEFAULT = 5
+SOLVE_MELODIES_DEFAULT = "input3,synthetic_2000"
+MIN_TIME_DEFAULT = 0.2
+REPEATS_DEFAULT = 3
+REGRESSION_THRESHOLD_DEFAULT = 0.2
+OUTPUT_PATH_DEFAULT = "benchmark_results.json"
+COMPOSITION_REPRESENTATION = "composition"
+GENOME_REPRESENTATION = "genome"
+SYNTHETIC_TICKS_PER_BEAT = 384
+SYNTHETIC_TEMPO = 600000
+SEED = 0
+
+# Specify inputs
+parser = ArgumentParser(description="Measures cost of genetic algorithm hot paths on melodies of input directory and "
+                                    "synthetic long melodies, saves results as JSON and compares them to a baseline.")
+parser.add_argument("-id", "--input_dir", dest="input_dir",
+                    help=f"Directory with input MIDI files. Default: {INPUT_DIR_DEFAULT}", metavar="PATH")
+parser.add_argument("-sbn", "--synthetic_beats_nums", dest="synthetic_beats_nums",
+                    help=f"Comma-separated lengths in beats of synthetic melodies, named synthetic_<beats>, empty for "
+                         f"none. Default: {SYNTHETIC_BEATS_NUMS_DEFAULT}", metavar="INTS")
+parser.add_argument("-ps", "--population_sizes", dest="population_sizes",
+                    help=f"Comma-separated generation sizes of solve benchmark and of populations evaluated by "
+                         f"batch_fitness_function. Default: {POPULATION_SIZES_DEFAULT}", metavar="INTS")
+parser.add_argument("-sg", "--solve_generations", dest="solve_generations",
+                    help=f"Number of generations of each solve run. Default: {SOLVE_GENERATIONS_DEFAULT}",
+                    metavar="INT")
+parser.add_argument("-sm", "--solve_melodies", dest="solve_melodies",
+                    help=f"Comma-separated names of melodies of solve benchmark. Default: {SOLVE_MELODIES_DEFAULT}",
+                    metavar="NAMES")
+parser.add_argument("-mt", "--min_time", dest="min_time",
+                    help=f"Minimal seconds of calls in a measurement. Default: {MIN_TIME_DEFAULT}", metavar="FLOAT")
+parser.add_argument("-rn", "--repeats", dest="repeats",
+                    help=f"Number of measurements of each benchmark, the fastest is kept. Default: {REPEATS_DEFAULT}",
+                    metavar="INT")
+parser.add_argument("-o", "--output_path", dest="output_path",
+                    help=f"Path to JSON results. Default: {OUTPUT_PATH_DEFAULT}", metavar="PATH")
+parser.add_argument("-bl", "--baseline_path", dest="baseline_path",
+                    help="Path to JSON results of an earlier run to compare with. Exit status is 1 if any benchmark "
+                         "regressed.", metavar="PATH")
+parser.add_argument("-rth", "--regression_threshold", dest="regression_threshold",
+                    help=f"Relative slowdown against baseline that is reported as regression. "
+                         f"Default: {REGRESSION_THRESHOLD_DEFAULT}", metavar="FLOAT")
+
+
+def measure(func: Callable[[], Any], min_time: float = MIN_TIME_DEFAULT, repeats: int = REPEATS_DEFAULT) -> float:
+    """Returns seconds per call of func: the fastest of repeats measurements, each of them calls func until min_time
+    seconds pass."""
+    best = None
+    for i in range(repeats):
+        calls_num = 0
+        start_time = time.perf_counter()
+        while True:
+            func()
+            calls_num += 1
+            elapsed = time.perf_counter() - start_time
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / calls_num) if best is not None else elapsed / calls_num
+    return best
+
+
+def synthetic_melody(beats_num: int, seed: int = SEED) -> Composition:
+    """Returns melody of random notes of one or two per beat."""
+    rng = random.Random(seed)
+    notes = []
+    for beat in range(beats_num):
+        start_time = beat * SYNTHETIC_TICKS_PER_BEAT
+        if rng.random() < 0.5:
+            notes.append(CompositionNote(rng.randrange(60, 84), start_time, SYNTHETIC_TICKS_PER_BEAT))
+        else:
+            half = SYNTHETIC_TICKS_PER_BEAT // 2
+            notes += [CompositionNote(rng.randrange(60, 84), start_time, half),
+                      CompositionNote(rng.randrange(60, 84), start_time + half, half)]
+    return Composition(notes=notes, ticks_per_beat=SYNTHETIC_TICKS_PER_BEAT, tempo=SYNTHETIC_TEMPO)
+
+
+def benchmark_melody(name: str, melody_path: str, population_sizes: List[int], min_time: float, repeats: int) \
+        -> Dict[str, float]:
+    """Returns seconds per call of MIDI reading and writing, fitness functions, GA operators and key detection on the
+    melody. batch_fitness_function is measured per candidate on populations of population_sizes mutated random
+    candidates, so that the cost of a call is not dominated by its fixed overhead."""
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results[f"midi_read/{name}"] = measure(lambda: Composition(midi_file=mido.MidiFile(melody_path)), min_time,
+                                               repeats)
+        melody = Composition(midi_file=mido.MidiFile(melody_path))
+        melody_context = MelodyContext(melody)
+        random.seed(SEED)
+        candidates = [get_random_candidate(melody_context) for i in range(2)]
+        results[f"midi_write/{name}"] = measure(lambda: candidates[0].save_midi(os.path.join(temp_dir, "out.mid")),
+                                                min_time, repeats)
+    results[f"get_random_candidate/{name}"] = measure(lambda: get_random_candidate(melody_context), min_time, repeats)
+    results[f"make_crossover/{name}"] = measure(lambda: make_crossover(candidates[0], candidates[1], 0.5), min_time,
+                                                repeats)
+    results[f"make_mutation/{name}"] = measure(lambda: make_mutation(candidates[0], 0.005), min_time, repeats)
+    results[f"fitness_function/{name}"] = measure(lambda: fitness_function(melody_context, candidates[0]), min_time,
+                                                  repeats)
+    population = [make_mutation(candidates[i % len(candidates)], 0.5) for i in range(max(population_sizes))]
+    for population_size in population_sizes:
+        results[f"batch_fitness_function_per_candidate/{population_size}/{name}"] = measure(
+            lambda: batch_fitness_function(melody_context, population[:population_size]), min_time, repeats) / \
+            population_size
+    # Composition.key is cached, so the method under the cache is measured
+    results[f"key_legacy/{name}"] = measure(lambda: Composition.key.fget.__wrapped__(melody), min_time, repeats)
+    results[f"key_global/{name}"] = measure(lambda: estimate_key(pitch_class_histogram(melody.pitches)), min_time,
+                                            repeats)
+    results[f"key_windowed/{name}"] = measure(
+        lambda: windowed_keys(melody_context.bucket_pitch_classes, KEY_WINDOW_BEATS, 0), min_time, repeats)
+    return results
+
+
+def benchmark_gen_alg(melody_context: MelodyContext, representation: str) -> GeneticAlgorithm:
+    """Returns GeneticAlgorithm of solve benchmarks for the representation."""
+    if representation == GENOME_REPRESENTATION:
+        table_fitness_function = TableFitnessFunction(melody_context)
+        return GeneticAlgorithm(melody_context, table_fitness_function, make_genome_crossover, make_genome_mutation,
+                                batch_fitness_function=table_fitness_function.batch,
+                                random_candidate_strategy=get_random_genome,
+                                population_operators=PopulationOperators(melody_context, np.random.default_rng(SEED)))
+    return GeneticAlgorithm(melody_context, fitness_function, make_crossover, make_mutation,
+                            batch_fitness_function=batch_fitness_function)
+
+
+def benchmark_solve(melody_path: str, representation: str, generation_size: int, generations_num: int,
+                    repeats: int) -> float:
+    """Returns seconds per generation of GeneticAlgorithm.solve on the melody, excluding the initial generation."""
+    melody_context = MelodyContext(Composition(midi_file=mido.MidiFile(melody_path)))
+    best = None
+    for i in range(repeats):
+        random.seed(SEED)
+        gen_alg = benchmark_gen_alg(melody_context, representation)
+        with gen_alg.evaluation_backend:
+            candidates_fitness = gen_alg.evaluate(gen_alg.get_init_generation(generation_size))
+            start_time = time.perf_counter()
+            gen_alg.evolve(candidates_fitness, generation_size=generation_size, mutation_chance=0.005,
+                           best_parents_num=min(10, generation_size - 1), random_parents_num=1,
+                           similarity_to_single_parent=0.5, iterations_num=generations_num)
+            seconds = (time.perf_counter() - start_time) / generations_num
+        best = min(best, seconds) if best is not None else seconds
+    return best
+
+
+def benchmark_breeding_memory(melody_path: str, representation: str, generation_size: int) -> Tuple[float, int]:
+    """Returns (peak bytes allocated, number of memory blocks allocated and kept) while GeneticAlgorithm breeds a
+    generation from an evaluated one, as traced by tracemalloc. Blocks are counted by snapshots taken before and after
+    breeding."""
+    melody_context = MelodyContext(Composition(midi_file=mido.MidiFile(melody_path)))
+    random.seed(SEED)
+    gen_alg = benchmark_gen_alg(melody_context, representation)
+    with gen_alg.evaluation_backend:
+        candidates_fitness = gen_alg.evaluate(gen_alg.get_init_generation(generation_size))
+    tracemalloc.start()
+    try:
+        snapshot_filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        start_snapshot = tracemalloc.take_snapshot().filter_traces(snapshot_filters)
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        generation = gen_alg.get_next_generation(candidates_fitness, mutation_chance=0.005,
+                                                 best_parents_num=min(10, generation_size - 1), random_parents_num=1,
+                                                 generation_size=generation_size, similarity_to_single_parent=0.5)
+        peak_memory = tracemalloc.get_traced_memory()[1] - start_memory
+        snapshot = tracemalloc.take_snapshot().filter_traces(snapshot_filters)
+        allocations_num = sum(max(0, statistic.count_diff)
+                              for statistic in snapshot.compare_to(start_snapshot, "lineno"))
+        del generation
+        return peak_memory, allocations_num
+    finally:
+        tracemalloc.stop()
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float, unit: str = "s") -> List[str]:
+    """Prints change of each benchmark against baseline and returns names of regressed benchmarks."""
+    regressions = []
+    for name in sorted(set(results) | set(baseline)):
+        if name not in results or name not in baseline:
+            print(f"{name}: only in {'results' if name in results else 'baseline'}")
+            continue
+        ratio = results[name] / baseline[name]
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name}: {baseline[name]:.6g} {unit} -> {results[name]:.6g} {unit} ({ratio:.2f}x)"
+              + ("\tREGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    input_dir = args.input_dir or INPUT_DIR_DEFAULT
+    synthetic_beats_nums = [int(value) for value in
+                            (args.synthetic_beats_nums if args.synthetic_beats_nums is not None
+                             else SYNTHETIC_BEATS_NUMS_DEFAULT).split(",") if value]
+    population_sizes = [int(value) for value in (args.population_sizes or POPULATION_SIZES_DEFAULT).split(",")]
+    solve_generations = int(args.solve_generations or SOLVE_GENERATIONS_DEFAULT)
+    solve_melodies = (args.solve_melodies or SOLVE_MELODIES_DEFAULT).split(",")
+    min_time = float(args.min_time or MIN_TIME_DEFAULT)
+    repeats = int(args.repeats or REPEATS_DEFAULT)
+    output_path = args.output_path or OUTPUT_PATH_DEFAULT
+    threshold = float(args.regression_threshold or REGRESSION_THRESHOLD_DEFAULT)
+
+    results = {}
+    memory_results = {}
+    allocation_results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        melody_paths = {os.path.splitext(file_name)[0]: os.path.join(input_dir, file_name)
+                        for file_name in sorted(os.listdir(input_dir)) if file_name.lower().endswith(".mid")}
+        for beats_num in synthetic_beats_nums:
+            melody_paths[f"synthetic_{beats_num}"] = os.path.join(temp_dir, f"synthetic_{beats_num}.mid")
+            synthetic_melody(beats_num).save_midi(melody_paths[f"synthetic_{beats_num}"])
+        for name, melody_path in melody_paths.items():
+            print(f"Benchmarking {name}")
+            results.update(benchmark_melody(name, melody_path, population_sizes, min_time, repeats))
+        for name in solve_melodies:
+            for representation in [COMPOSITION_REPRESENTATION, GENOME_REPRESENTATION]:
+                for generation_size in population_sizes:
+                    print(f"Benchmarking solve of {name} with {generation_size} {representation} candidates")
+                    results[f"solve_generation/{representation}/{generation_size}/{name}"] = benchmark_solve(
+                        melody_paths[name], representation, generation_size, solve_generations, repeats)
+                    memory_results[f"breeding_peak/{representation}/{generation_size}/{name}"], \
+                        allocation_results[f"breeding_allocations/{representation}/{generation_size}/{name}"] = \
+                        benchmark_breeding_memory(melody_paths[name], representation, generation_size)
+
+    with open(output_path, "w") as output_file:
+        json.dump({"environment": {"python": platform.python_version(), "numpy": np.__version__,
+                                   "platform": platform.platform(), "cpu_count": os.cpu_count()},
+                   "seconds": results, "bytes": memory_results, "allocations": allocation_results}, output_file,
+                  indent=2)
+    for name, seconds in results.items():
+        print(f"{name}: {seconds:.6g} s" + (f" ({1 / seconds:.1f} generations/s)"
+                                            if name.startswith("solve_generation/") else ""))
+    for name, memory in memory_results.items():
+        print(f"{name}: {memory:.0f} bytes")
+    for name, allocations_num in allocation_results.items():
+        print(f"{name}: {allocations_num} allocations")
+    print(f"Results were saved to {output_path}")
+    if args.baseline_path is not None:
+        with open(args.baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline["seconds"], threshold) + \
+            compare(memory_results, baseline.get("bytes", {}), threshold, unit="bytes") + \
+            compare(allocation_results, baseline.get("allocations", {}), threshold, unit="allocations")
+        print(f"{len(regressions)} regressions over {threshold:.0%} against {args.baseline_path}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
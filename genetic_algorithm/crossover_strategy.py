@@ -1,6 +1,9 @@
 from random import random
 from typing import Tuple
 
+import numpy as np
+
+from genetic_algorithm.genome import Genome
 from music_interfaces.composition.composition import Composition
 
 
@@ -11,21 +14,66 @@ def make_crossover(candidate1: Composition, candidate2: Composition, similarity_
     Note: candidate compostitions should have chords should be placed exactly at places that are multiples of
     4 quarter. Other chords are ignored.
 
+    Children are gathered from columns of the parents by beats, and a child without swapped beats shares columns with
+    its parent. Each child keeps fitness_state of the parent it is cloned from, and beats swapped with different chords
+    are added to its dirty_beats.
+
     """
-    child1_notes = []
-    child2_notes = []
-    cand1_notes_as = candidate1.notes_at
-    cand2_notes_as = candidate2.notes_at
-    times = set(list(cand1_notes_as.keys()) + list(cand2_notes_as.keys()))
-    for time in times:
-        if random() > similarity_to_single_parent:
-            child1_notes += cand2_notes_as.get(time, [])
-            child2_notes += cand1_notes_as.get(time, [])
-        else:
-            child1_notes += cand1_notes_as.get(time, [])
-            child2_notes += cand2_notes_as.get(time, [])
-    child1 = candidate1.clone()
-    child2 = candidate2.clone()
-    child1.notes = child1_notes
-    child2.notes = child2_notes
-    return child1, child2
+    ticks_per_beat = candidate1.ticks_per_beat
+    beats_num = max(candidate1.duration, candidate2.duration) // ticks_per_beat + 1
+    ordered1, offsets1 = candidate1.at_beats(beats_num)
+    ordered2, offsets2 = candidate2.at_beats(beats_num)
+    chords_nums1 = np.diff(offsets1)
+    chords_nums2 = np.diff(offsets2)
+    swapped = np.zeros(beats_num, dtype=bool)
+    for beat in np.flatnonzero((chords_nums1 > 0) | (chords_nums2 > 0)):
+        swapped[beat] = random() > similarity_to_single_parent
+    if not swapped.any():
+        children = ordered1.clone(), ordered2.clone()
+    else:
+        beats1 = np.repeat(np.arange(beats_num), chords_nums1)
+        beats2 = np.repeat(np.arange(beats_num), chords_nums2)
+        children = _gather_beats(ordered1, ~swapped[beats1], beats1, ordered2, swapped[beats2], beats2), \
+            _gather_beats(ordered2, ~swapped[beats2], beats2, ordered1, swapped[beats1], beats1)
+    if any(parent.fitness_state is not None and parent.dirty_beats is not None for parent in (candidate1, candidate2)):
+        changed = swapped & _different_chords(ordered1.columns[0], offsets1, ordered2.columns[0], offsets2)
+        swapped_beats = set(np.flatnonzero(changed).tolist())
+        for child, parent in zip(children, (candidate1, candidate2)):
+            if parent.fitness_state is not None and parent.dirty_beats is not None:
+                child.fitness_state = parent.fitness_state
+                child.dirty_beats = parent.dirty_beats | swapped_beats
+    return children
+
+
+def _different_chords(pitches1: np.ndarray, offsets1: np.ndarray, pitches2: np.ndarray, offsets2: np.ndarray) -> \
+        np.ndarray:
+    """Returns mask of beats where chords of two compositions ordered by beats differ, offsets are the ones of
+    Composition.at_beats. Chords are compared as sorted note numbers."""
+    chords_nums1, chords_nums2 = np.diff(offsets1), np.diff(offsets2)
+    different = chords_nums1 != chords_nums2
+    beats1 = np.repeat(np.arange(len(chords_nums1)), chords_nums1)
+    beats2 = np.repeat(np.arange(len(chords_nums2)), chords_nums2)
+    # notes of beats with the same number of notes are at the same places after sorting by (beat, note)
+    compared1, compared2 = ~different[beats1], ~different[beats2]
+    sorted1 = pitches1[np.lexsort((pitches1, beats1))][compared1]
+    sorted2 = pitches2[np.lexsort((pitches2, beats2))][compared2]
+    different[beats1[compared1][sorted1 != sorted2]] = True
+    return different
+
+
+def _gather_beats(own: Composition, own_taken: np.ndarray, own_beats: np.ndarray, other: Composition,
+                  other_taken: np.ndarray, other_beats: np.ndarray) -> Composition:
+    """Returns Composition with metadata of own and taken notes of both compositions ordered by beats. Notes of a beat
+    must be taken from one of the compositions only."""
+    order = np.argsort(np.concatenate([own_beats[own_taken], other_beats[other_taken]]), kind="stable")
+    return own.with_columns(*[np.concatenate([own_column[own_taken], other_column[other_taken]])[order]
+                              for own_column, other_column in zip(own.columns, other.columns)])
+
+
+def make_genome_crossover(candidate1: Genome, candidate2: Genome, similarity_to_single_parent: float) -> \
+        Tuple[Genome, Genome]:
+    """Returns two offsprings that are result of beat-wise uniform crossover of genomes, as make_crossover does."""
+    swapped = np.fromiter((random() > similarity_to_single_parent for _ in range(len(candidate1))), dtype=bool,
+                          count=len(candidate1))
+    return Genome(np.where(swapped, candidate2.states, candidate1.states)), \
+        Genome(np.where(swapped, candidate1.states, candidate2.states))
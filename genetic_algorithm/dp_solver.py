@@ -0,0 +1,242 @@
+import time
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from app_config import ENABLE_TOO_BIG_CHORD_DROP, TOO_BIG_CHORD_DROP_IN_NOTES, ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE, \
+    TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES, ENABLE_PARTIAL_PROGRESSION, ENABLE_COMPLETED_PROGRESSION, MAX_NOTE
+from genetic_algorithm.fitness_function.fitness_constants import TOO_BIG_CHORD_DROP, TOO_WIDE_ACCOMPANIMENT_RANGE, \
+    COMPLETED_PROGRESSION, PARTIAL_PROGRESSION
+from genetic_algorithm.fitness_function.fitness_function import fitness_function
+from genetic_algorithm.fitness_function.score_tables import ScoreTables, CHORD_SHAPES, SHAPE_WIDTHS, LOWS_NUM, \
+    EMPTY_STATE, get_weight
+from genetic_algorithm.melody_context import MelodyContext
+from logging.logging import log
+from logging.logging_constants import INFO_LEVEL
+from music_interfaces.composition.composition import Composition
+from music_interfaces.composition.composition_constants import PROGRESSION_LEN
+from music_interfaces.composition.progression_index import PROGRESSION_INDEX
+from music_interfaces.note import CompositionNote
+
+OPTIMALITY_TOLERANCE = 1e-6
+
+
+class DPSolver:
+    """Exact solver of accompaniment for a given melody, an alternative to GeneticAlgorithm.
+
+    The search space is the one of GA operators: each beat holds no chord or one of ACCOMPANIMENT_CHORDS with the lowest
+    note in [0; MAX_NOTE - chord width]. Fitness is split into beat-local terms, the chord drop term between consecutive
+    chords and progression terms of 4-beat windows (see ScoreTables), and is minimized by Viterbi-style dynamic
+    programming over beats with the last chord as a state. The only global term, too wide accompaniment range, is
+    replaced by the distance to a fixed range center, and the problem is solved for every center with half-note step at
+    once.
+
+    Minimum over centers is a lower bound of fitness. Solutions of the best centers are evaluated by fitness_function
+    until the lower bound is reached (the accompaniment is optimal) or no center can give better fitness (the gap
+    between the found fitness and lower_bound is reported).
+
+    """
+    def __init__(self, melody: Union[Composition, MelodyContext], tables: ScoreTables = None):
+        self.melody = MelodyContext.of(melody)
+        self.tables = tables or ScoreTables(self.melody)
+        self.chords = CHORD_SHAPES
+        self.widths = SHAPE_WIDTHS
+        self.lows = np.arange(LOWS_NUM)
+        self.valid = self.lows[None, :] + self.widths[:, None] <= MAX_NOTE
+        self.beats_num = self.melody.beats_num
+        self.drop_weight = get_weight(TOO_BIG_CHORD_DROP, ENABLE_TOO_BIG_CHORD_DROP)
+        self.wide_weight = get_weight(TOO_WIDE_ACCOMPANIMENT_RANGE, ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE)
+        assert self.drop_weight >= 0, "dp engine requires non-negative weight of too big chord drop"
+        self.constant_cost = self.tables.constant_score
+        chord_costs = self.tables.local_scores[:, :EMPTY_STATE].reshape(self.beats_num, len(self.chords), LOWS_NUM)
+        self.chord_costs = np.where(self.valid[None], chord_costs, np.inf)
+        self.empty_costs = self.tables.local_scores[:, EMPTY_STATE]
+        self.window_bonus, self.window_empty_bonus, self.exact_windows = self._window_bonuses()
+        self.considered, self.tail_costs = self._tails()
+        self.lower_bound = None
+        self.gap = None
+        self.centers_num = 0
+        self.solve_time = 0
+
+    @property
+    def summary(self) -> str:
+        """Returns description of the lower bound and the gap between it and the found fitness."""
+        optimality = "optimal" if self.gap <= OPTIMALITY_TOLERANCE else f"gap {self.gap}"
+        return f"{optimality}, lower bound {self.lower_bound}, {self.centers_num} range centers evaluated " \
+               f"in {self.solve_time:.2f}s"
+
+    def solve(self) -> (Composition, float):
+        """Returns the best found accompaniment and its fitness value."""
+        start_time = time.perf_counter()
+        centers = np.arange(2 * MAX_NOTE + 1) / 2
+        bounds, _, _ = self._forward(centers)
+        self.lower_bound = float(bounds.min())
+        best_accompaniment, best_fitness = None, None
+        self.centers_num = 0
+        for center_i in np.argsort(bounds, kind="stable"):
+            if best_fitness is not None and bounds[center_i] >= best_fitness - OPTIMALITY_TOLERANCE:
+                break
+            accompaniment = self._backtrack(centers[center_i])
+            fitness = fitness_function(self.melody, accompaniment)
+            self.centers_num += 1
+            if best_fitness is None or fitness < best_fitness:
+                best_accompaniment, best_fitness = accompaniment, fitness
+        self.gap = max(0, best_fitness - self.lower_bound)
+        self.solve_time = time.perf_counter() - start_time
+        log(f"DP solver:\t{self.summary}", INFO_LEVEL)
+        return best_accompaniment, best_fitness
+
+    def _window_bonuses(self) -> Tuple[np.ndarray, np.ndarray, bool]:
+        """Returns (progression awards of chords at each window position (4 x chords x lows), awards of empty beat at
+        each window position (4,), whether awards are exact).
+
+        Awards are exact when they depend only on the first chord of a window (see ScoreTables.window_scores).
+        Otherwise each position gets its maximum possible share of the award, which gives a lower bound only.
+
+        """
+        tables = self.tables
+        window_bonus = np.zeros((PROGRESSION_LEN, len(self.chords), len(self.lows)))
+        window_empty_bonus = np.zeros(PROGRESSION_LEN)
+        if tables.window_scores is not None:
+            window_bonus[0] = tables.window_scores[:EMPTY_STATE].reshape(len(self.chords), len(self.lows))
+            window_empty_bonus[0] = tables.window_scores[EMPTY_STATE]
+            return window_bonus, window_empty_bonus, True
+        partial_weight = get_weight(PARTIAL_PROGRESSION, ENABLE_PARTIAL_PROGRESSION)
+        completed_weight = get_weight(COMPLETED_PROGRESSION, ENABLE_COMPLETED_PROGRESSION)
+        assert partial_weight <= 0 and completed_weight <= 0, "dp engine requires non-positive progression weights"
+        position_bonus = (partial_weight + completed_weight) / PROGRESSION_LEN
+        anchor_bases = set(base for base, name in tables.state_triads)
+        for position in range(PROGRESSION_LEN):
+            matching_triads = set((anchor_base + progression[position][0], progression[position][1])
+                                  for progression in PROGRESSION_INDEX.progressions if position < len(progression)
+                                  for anchor_base in (anchor_bases if position > 0 else [0]))
+            bonus = np.array([position_bonus if triad in matching_triads else 0 for triad in tables.state_triads])
+            window_bonus[position] = bonus[:EMPTY_STATE].reshape(len(self.chords), len(self.lows))
+            window_empty_bonus[position] = bonus[EMPTY_STATE]
+        return window_bonus, window_empty_bonus, False
+
+    def _tails(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (whether window of the beat is considered, cost of empty beats and windows after the beat) for the
+        last chord placed at each beat."""
+        melody = self.melody
+        min_duration_beats = melody.min_duration // melody.ticks_per_beat if melody.min_duration is not None else 0
+        empty_suffix_costs = np.append(np.cumsum(self.empty_costs[::-1])[::-1], 0)
+        considered = np.zeros(self.beats_num, dtype=bool)
+        tail_costs = np.zeros(self.beats_num)
+        for beat in range(self.beats_num):
+            windows_num = (max(beat + 1, min_duration_beats) + 1) // PROGRESSION_LEN
+            window = beat // PROGRESSION_LEN
+            considered[beat] = window < windows_num
+            tail_costs[beat] = self.constant_cost + empty_suffix_costs[beat + 1] + \
+                max(0, windows_num - window - 1) * self.window_empty_bonus.sum()
+            if considered[beat]:
+                tail_costs[beat] += self.window_empty_bonus[beat % PROGRESSION_LEN + 1:].sum()
+        return considered, tail_costs
+
+    def _forward(self, centers: np.ndarray, store: bool = False) -> Tuple[np.ndarray, np.ndarray, List]:
+        """Returns (lower bound of fitness for each range center, beat of the last chord of each bound, history of
+        beats if store).
+
+        Two variants of costs (centers x chords x lows) of the best beginnings with the given last chord are kept: with
+        awards of the current window and without them, for the case the last chord is too close to the end to consider
+        the window.
+
+        """
+        wide_costs = self.wide_weight * (np.abs(self.lows[None, :] - centers[:, None]) >
+                                         TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES / 2)[:, None, :]
+        costs = [np.full((len(centers), len(self.chords), len(self.lows)), np.inf)] * 2
+        empty_costs = [0.0, 0.0]
+        bounds = np.full(len(centers), np.inf)
+        ending_beats = np.zeros(len(centers), dtype=np.int64)
+        history = []
+        for beat in range(self.beats_num):
+            position = beat % PROGRESSION_LEN
+            if position == 0:
+                costs[1], empty_costs[1] = costs[0], empty_costs[0]
+            chord_costs = self.chord_costs[beat] + wide_costs
+            transition = self._transition(costs[0], empty_costs[0])
+            last_chord_costs = [chord_costs + self.window_bonus[position] + transition,
+                                chord_costs + (transition if position == 0 else
+                                               self._transition(costs[1], empty_costs[1]))]
+            beat_empty_costs = [self.empty_costs[beat] + self.window_empty_bonus[position], self.empty_costs[beat]]
+            ending_costs = last_chord_costs[0 if self.considered[beat] else 1]
+            beat_bounds = ending_costs.reshape(len(centers), -1).min(axis=1) + self.tail_costs[beat]
+            ending_beats[beat_bounds < bounds] = beat
+            bounds = np.minimum(bounds, beat_bounds)
+            costs = [np.minimum(last_chord_costs[i], costs[i] + beat_empty_costs[i]) for i in range(2)]
+            empty_costs = [empty_costs[i] + beat_empty_costs[i] for i in range(2)]
+            if store:
+                history.append((last_chord_costs, costs, empty_costs))
+        return bounds, ending_beats, history
+
+    def _transition(self, costs: np.ndarray, empty_cost: float) -> np.ndarray:
+        """Returns the best cost of beginning before each chord of the current beat, including the chord drop."""
+        best = np.minimum(empty_cost, costs.min(axis=(1, 2))[:, None, None] + self.drop_weight)
+        if self.drop_weight > 0:
+            best = np.minimum(best, self._no_drop_min(costs))
+        return best
+
+    def _no_drop_min(self, costs: np.ndarray) -> np.ndarray:
+        """Returns minimum cost over previous chords without too big drop to each chord of the current beat.
+
+        Chords without drop to a chord with the lowest note m have lowest notes in an interval around m that depends
+        only on widths of both chords, so minimums are taken over intervals with sparse tables of each width.
+
+        """
+        max_delta = TOO_BIG_CHORD_DROP_IN_NOTES - 1
+        widths = sorted(set(self.widths.tolist()))
+        pad = max_delta + widths[-1] - widths[0]
+        centers_num, lows_num = costs.shape[0], len(self.lows)
+        no_drop_by_width = {}
+        for prev_width in widths:
+            padded = np.full((centers_num, lows_num + 2 * pad), np.inf)
+            padded[:, pad:pad + lows_num] = costs[:, self.widths == prev_width].min(axis=1)
+            tables = [padded]
+            while 2 ** len(tables) <= 2 * max_delta + 1:
+                step = 2 ** (len(tables) - 1)
+                tables.append(np.minimum(tables[-1][:, :-step], tables[-1][:, step:]))
+            for width in widths:
+                lo = max(-max_delta, width - prev_width - max_delta)
+                hi = min(max_delta, width - prev_width + max_delta)
+                if lo > hi:
+                    continue
+                level = int(np.log2(hi - lo + 1))
+                table = tables[level]
+                start, end = pad + lo, pad + hi - 2 ** level + 1
+                interval_min = np.minimum(table[:, start:start + lows_num], table[:, end:end + lows_num])
+                no_drop_by_width[width] = np.minimum(no_drop_by_width.get(width, np.inf), interval_min)
+        return np.stack([no_drop_by_width.get(width, np.full((centers_num, lows_num), np.inf))
+                         for width in self.widths.tolist()], axis=1)
+
+    def _drops(self, k: int, low: int) -> np.ndarray:
+        """Returns whether there is too big drop from each chord (chords x lows) to the given chord."""
+        return (np.abs(self.lows[None, :] - low) >= TOO_BIG_CHORD_DROP_IN_NOTES) | \
+               (np.abs(self.lows[None, :] + self.widths[:, None] - low - self.widths[k]) >= TOO_BIG_CHORD_DROP_IN_NOTES)
+
+    def _backtrack(self, center: float) -> Composition:
+        """Returns the best accompaniment for the range center restored from history of its forward pass."""
+        _, ending_beats, history = self._forward(np.array([center]), store=True)
+        beat = int(ending_beats[0])
+        variant = 0 if self.considered[beat] else 1
+        k, low = np.unravel_index(np.argmin(history[beat][0][variant][0]), self.valid.shape)
+        chords = {beat: (k, low)}
+        while beat > 0:
+            # find the previous chord that gives the best cost of the current one
+            variant = 0 if beat % PROGRESSION_LEN == 0 else variant
+            prev_last_chord_costs, prev_costs, prev_empty_costs = history[beat - 1]
+            options = prev_costs[variant][0] + self.drop_weight * self._drops(k, low)
+            if prev_empty_costs[variant] <= options.min():
+                break
+            k, low = np.unravel_index(np.argmin(options), self.valid.shape)
+            beat -= 1
+            # skip empty beats before the previous chord
+            while history[beat][0][variant][0][k, low] != history[beat][1][variant][0][k, low]:
+                variant = 0 if beat % PROGRESSION_LEN == 0 else variant
+                beat -= 1
+            chords[beat] = (k, low)
+        accompaniment = self.melody.clone()
+        ticks_per_beat = self.melody.ticks_per_beat
+        accompaniment.notes = [CompositionNote(note=int(low) + note, start_time=beat * ticks_per_beat,
+                                               duration=ticks_per_beat)
+                               for beat, (k, low) in sorted(chords.items()) for note in self.chords[k]]
+        return accompaniment
@@ -0,0 +1,215 @@
+import os
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from typing import Callable, List, Sequence, Tuple, Union
+
+from genetic_algorithm.genome import Genome
+from genetic_algorithm.melody_context import MelodyContext
+from music_interfaces.composition.composition import Composition
+
+SERIAL_BACKEND = "serial"
+THREAD_BACKEND = "thread"
+PROCESS_BACKEND = "process"
+
+
+class EvaluationBackend:
+    """Serial fitness evaluation of candidates for a given melody. Base class for parallel backends.
+
+    Backend measures CPU time spent on evaluation by all workers (busy_time) and real time of evaluation (wall_time).
+    CPU time of a candidate in a worker is taken as its cost of serial evaluation, so speedup is busy_time divided by
+    wall_time, and utilization is speedup per worker. Real time includes packing and splitting of candidates in the
+    calling process, so this overhead lowers both.
+
+    """
+    name = SERIAL_BACKEND
+
+    def __init__(self, melody: MelodyContext, fitness_function: Callable[[MelodyContext, Composition], float],
+                 batch_fitness_function: Callable[[MelodyContext, List[Composition]], Sequence[float]] = None,
+                 workers_num: int = None, chunk_size: int = None):
+        assert workers_num is None or workers_num >= 1, "workers_num must be positive"
+        assert chunk_size is None or chunk_size >= 1, "chunk_size must be positive"
+        self.melody = melody
+        self.fitness_function = fitness_function
+        self.batch_fitness_function = batch_fitness_function
+        self.workers_num = 1
+        self.chunk_size = chunk_size
+        self.busy_time = 0
+        self.wall_time = 0
+        self.evaluations_num = 0
+
+    @property
+    def speedup(self) -> float:
+        """Returns serial cost of evaluated candidates divided by real time of their evaluation."""
+        return self.busy_time / self.wall_time if self.wall_time > 0 else 0
+
+    @property
+    def utilization(self) -> float:
+        """Returns share of real time of evaluation that workers spent on evaluation, averaged over workers."""
+        return self.speedup / self.workers_num
+
+    @property
+    def summary(self) -> str:
+        """Returns speedup against serial evaluation together with number of workers and cores."""
+        return f"{self.speedup:.2f}x speedup over serial evaluation with {self.workers_num} {self.name} workers on " \
+               f"{os.cpu_count()} cores, {self.utilization:.0%} worker utilization"
+
+    def start(self):
+        """Prepares workers for evaluation."""
+        pass
+
+    def close(self):
+        """Releases workers."""
+        pass
+
+    def evaluate(self, candidates: List[Composition]) -> List[float]:
+        """Returns fitness of each candidate."""
+        start_time = time.perf_counter()
+        fitnesses = []
+        for chunk_fitnesses, chunk_busy_time in self._evaluate_chunks(self._split(candidates)):
+            fitnesses += chunk_fitnesses
+            self.busy_time += chunk_busy_time
+        self.wall_time += time.perf_counter() - start_time
+        self.evaluations_num += len(candidates)
+        return fitnesses
+
+    def submit(self, candidates: List[Composition], callback: Callable[[List[float]], None],
+               error_callback: Callable[[BaseException], None] = None):
+        """Starts evaluation of candidates as one chunk and calls callback with fitness of each candidate when it is
+        done, or error_callback with the error. Pool backends call them from their result thread, serial backend
+        evaluates candidates before return. Real time of asynchronous evaluation is not measured."""
+        def done(result: Tuple[List[float], float]):
+            fitnesses, busy_time = result
+            self.busy_time += busy_time
+            self.evaluations_num += len(fitnesses)
+            callback(fitnesses)
+        self._submit_chunk(candidates, done, error_callback)
+
+    def _submit_chunk(self, chunk: List[Composition], done: Callable[[Tuple[List[float], float]], None],
+                      error_callback: Callable[[BaseException], None]):
+        try:
+            result = _evaluate_chunk(self.melody, self.fitness_function, self.batch_fitness_function, chunk)
+        except Exception as error:
+            if error_callback is None:
+                raise
+            error_callback(error)
+            return
+        done(result)
+
+    def _evaluate_chunks(self, chunks: List[List[Composition]]) -> List[Tuple[List[float], float]]:
+        return [_evaluate_chunk(self.melody, self.fitness_function, self.batch_fitness_function, chunk)
+                for chunk in chunks]
+
+    def _split(self, candidates: List[Composition]) -> List[List[Composition]]:
+        """Returns candidates split to chunks of chunk_size, by default one chunk per worker."""
+        chunk_size = self.chunk_size or max(1, -(-len(candidates) // self.workers_num))
+        return [candidates[i:i + chunk_size] for i in range(0, len(candidates), chunk_size)]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ThreadPoolEvaluationBackend(EvaluationBackend):
+    """Evaluation of candidate chunks in a pool of threads. Effective only for fitness functions that release GIL."""
+    name = THREAD_BACKEND
+
+    def __init__(self, melody: MelodyContext, fitness_function: Callable[[MelodyContext, Composition], float],
+                 batch_fitness_function: Callable[[MelodyContext, List[Composition]], Sequence[float]] = None,
+                 workers_num: int = None, chunk_size: int = None):
+        super().__init__(melody=melody, fitness_function=fitness_function,
+                         batch_fitness_function=batch_fitness_function, workers_num=workers_num, chunk_size=chunk_size)
+        self.workers_num = workers_num or os.cpu_count()
+        self._pool = None
+
+    def start(self):
+        self._pool = ThreadPool(self.workers_num)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _evaluate_chunks(self, chunks: List[List[Composition]]) -> List[Tuple[List[float], float]]:
+        assert self._pool is not None, "backend must be started before evaluation"
+        return self._pool.starmap(
+            _evaluate_chunk,
+            [(self.melody, self.fitness_function, self.batch_fitness_function, chunk) for chunk in chunks]
+        )
+
+    def _submit_chunk(self, chunk: List[Composition], done: Callable[[Tuple[List[float], float]], None],
+                      error_callback: Callable[[BaseException], None]):
+        assert self._pool is not None, "backend must be started before evaluation"
+        self._pool.apply_async(_evaluate_chunk,
+                               (self.melody, self.fitness_function, self.batch_fitness_function, chunk),
+                               callback=done, error_callback=error_callback)
+
+
+class ProcessPoolEvaluationBackend(ThreadPoolEvaluationBackend):
+    """Evaluation of candidate chunks in a pool of processes.
+
+    The melody with its analysis (see MelodyContext) and fitness functions are sent to each worker once at pool start,
+    and candidates are sent in compact form (see Composition.to_compact). Genomes are compact already and are sent
+    as is.
+
+    """
+    name = PROCESS_BACKEND
+
+    def start(self):
+        self._pool = Pool(self.workers_num, initializer=_init_worker,
+                          initargs=(self.melody, self.fitness_function, self.batch_fitness_function))
+
+    def _evaluate_chunks(self, chunks: List[List[Composition]]) -> List[Tuple[List[float], float]]:
+        assert self._pool is not None, "backend must be started before evaluation"
+        return self._pool.map(_evaluate_compact_chunk,
+                              [[candidate.to_compact() if isinstance(candidate, Composition) else candidate
+                                for candidate in chunk] for chunk in chunks], chunksize=1)
+
+    def _submit_chunk(self, chunk: List[Composition], done: Callable[[Tuple[List[float], float]], None],
+                      error_callback: Callable[[BaseException], None]):
+        assert self._pool is not None, "backend must be started before evaluation"
+        self._pool.apply_async(_evaluate_compact_chunk,
+                               ([candidate.to_compact() if isinstance(candidate, Composition) else candidate
+                                 for candidate in chunk],), callback=done, error_callback=error_callback)
+
+
+EVALUATION_BACKENDS = {
+    SERIAL_BACKEND: EvaluationBackend,
+    THREAD_BACKEND: ThreadPoolEvaluationBackend,
+    PROCESS_BACKEND: ProcessPoolEvaluationBackend
+}
+
+# state of process pool worker
+_worker_melody = None
+_worker_fitness_function = None
+_worker_batch_fitness_function = None
+
+
+def _init_worker(melody: MelodyContext, fitness_function: Callable[[MelodyContext, Composition], float],
+                 batch_fitness_function: Callable[[MelodyContext, List[Composition]], Sequence[float]]):
+    global _worker_melody, _worker_fitness_function, _worker_batch_fitness_function
+    _worker_melody = melody
+    _worker_fitness_function = fitness_function
+    _worker_batch_fitness_function = batch_fitness_function
+
+
+def _evaluate_compact_chunk(packed_candidates: List[Union[bytes, Genome]]) -> Tuple[List[float], float]:
+    candidates = [_worker_melody.from_compact(packed_candidate) if isinstance(packed_candidate, bytes)
+                  else packed_candidate for packed_candidate in packed_candidates]
+    return _evaluate_chunk(_worker_melody, _worker_fitness_function, _worker_batch_fitness_function, candidates)
+
+
+def _evaluate_chunk(melody: MelodyContext, fitness_function: Callable[[MelodyContext, Composition], float],
+                    batch_fitness_function: Callable[[MelodyContext, List[Composition]], Sequence[float]],
+                    candidates: List[Composition]) -> Tuple[List[float], float]:
+    """Returns (fitness of each candidate, CPU time spent on evaluation)."""
+    start_time = time.thread_time()
+    if batch_fitness_function is not None:
+        fitnesses = [float(fitness) for fitness in batch_fitness_function(melody, candidates)]
+    else:
+        fitnesses = [fitness_function(melody, candidate) for candidate in candidates]
+    return fitnesses, time.thread_time() - start_time
@@ -0,0 +1,68 @@
+from array import array
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Optional, Union
+
+from genetic_algorithm.genome import Genome
+from music_interfaces.composition.composition import Composition
+
+
+class FitnessCache:
+    """LRU cache of fitness values addressed by content of accompaniments.
+
+    Counters of hits, misses, evictions and duplicates (candidates repeated inside one generation) are kept both for the
+    current generation and for the whole run.
+
+    """
+    def __init__(self, max_size: int):
+        assert max_size >= 1, "max_size must be positive"
+        self.max_size = max_size
+        self._fitnesses = OrderedDict()
+        self.hits = self.misses = self.evictions = self.duplicates = 0
+        self.total_hits = self.total_misses = self.total_evictions = self.total_duplicates = 0
+
+    @staticmethod
+    def key(candidate: Union[Composition, Genome]) -> bytes:
+        """Returns hash of (beat, chord) content of the candidate that does not depend on order of its notes."""
+        if isinstance(candidate, Genome):
+            return candidate.key
+        content = array("I")
+        for start_time_note_duration in sorted(zip(candidate.start_times, candidate.pitches, candidate.durations)):
+            content.extend(start_time_note_duration)
+        return blake2b(content.tobytes(), digest_size=16).digest()
+
+    def get(self, key: bytes) -> Optional[float]:
+        """Returns cached fitness or None if key is missing."""
+        fitness = self._fitnesses.get(key)
+        if fitness is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._fitnesses.move_to_end(key)
+        return fitness
+
+    def put(self, key: bytes, fitness: float):
+        """Caches fitness, evicting least recently used values if the cache is full."""
+        self._fitnesses[key] = fitness
+        self._fitnesses.move_to_end(key)
+        while len(self._fitnesses) > self.max_size:
+            self._fitnesses.popitem(last=False)
+            self.evictions += 1
+
+    def reset_generation_stats(self) -> str:
+        """Returns description of the current generation counters and starts counting next generation."""
+        description = f"hits {self.hits}, misses {self.misses}, evictions {self.evictions}, " \
+                      f"duplicates {self.duplicates}, size {len(self._fitnesses)}"
+        self.total_hits += self.hits
+        self.total_misses += self.misses
+        self.total_evictions += self.evictions
+        self.total_duplicates += self.duplicates
+        self.hits = self.misses = self.evictions = self.duplicates = 0
+        return description
+
+    @property
+    def summary(self) -> str:
+        """Returns description of counters for the whole run."""
+        return f"hits {self.total_hits + self.hits}, misses {self.total_misses + self.misses}, " \
+               f"evictions {self.total_evictions + self.evictions}, " \
+               f"duplicates {self.total_duplicates + self.duplicates}"
@@ -0,0 +1,233 @@
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from app_config import ENABLE_EMPTY_ACCOMPANIMENT, ENABLE_MISSING_ACCOMP_FOR_MELODY_TICK, \
+    ENABLE_EXCESS_ACCOMP_TICK_FOR_MELODY, ENABLE_TOO_BIG_CHORD_DROP, TOO_BIG_CHORD_DROP_IN_NOTES, \
+    ENABLE_ACCOMP_TICK_NOT_BELOW_MELODY, ENABLE_DISSONANCE_INSIDE, EVENT_TO_AWARD_WEIGHTS, \
+    ENABLE_ACCOMPANIMENT_CHORD_EXISTS, ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE, TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES, \
+    ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY, ENABLE_CHORD_INCLUDE_MELODY_NOTE, ENABLE_PARTIAL_PROGRESSION, \
+    ENABLE_COMPLETED_PROGRESSION, ENABLE_TOO_LOW_CHORD, TOO_LOW_NOTE_UPPER_BOUND
+from genetic_algorithm.fitness_function.fitness_constants import MISSING_ACCOMP_FOR_MELODY_TICK, \
+    EXCESS_ACCOMP_TICK_FOR_MELODY, TOO_BIG_CHORD_DROP, ACCOMP_TICK_NOT_BELOW_MELODY, DISSONANCE_INSIDE, \
+    EMPTY_ACCOMPANIMENT, DISSONANCE_WITH_MELODY, ACCOMPANIMENT_CHORD_EXISTS, TOO_WIDE_ACCOMPANIMENT_RANGE, \
+    CORRECT_TRIAD_FOR_MELODY_KEY, CHORD_INCLUDE_MELODY_NOTE, COMPLETED_PROGRESSION, PARTIAL_PROGRESSION, TOO_LOW_CHORD
+from genetic_algorithm.melody_context import MelodyContext, NO_NOTE
+from music_interfaces.composition.composition import Composition
+from music_interfaces.composition.chord_mask import CHORD_NAMES_BY_CODE, MASKS_NUM, NO_CHORD_CODE, PITCH_CLASSES_NUM
+from music_interfaces.composition.composition_constants import NAME_TO_CHORD, PROGRESSION_LEN, UNKNOWN_CHORD_NAME
+from music_interfaces.composition.progression_index import PROGRESSION_INDEX
+
+# ids of NAME_TO_CHORD names indexed by chord code, unknown chords have id len(NAME_TO_CHORD)
+_CHORD_NAME_IDS = np.array([list(NAME_TO_CHORD).index(name) if name is not None else len(NAME_TO_CHORD)
+                            for name in CHORD_NAMES_BY_CODE])
+# number of pitch classes in each pitch class mask
+_POPCOUNTS = np.array([mask.bit_count() for mask in range(MASKS_NUM)], dtype=np.int64)
+
+
+def batch_fitness_function(melody: Union[Composition, MelodyContext], accompaniments: List[Composition]) \
+        -> np.ndarray:
+    """Returns fitness values of the accompaniments. Gives the same values as fitness_function for each of them."""
+    metrics = batch_calculate_metrics(melody, accompaniments)
+    return _batch_event_to_award(metrics, len(accompaniments))
+
+
+def batch_calculate_metrics(melody: Union[Composition, MelodyContext], accompaniments: List[Composition]) \
+        -> Dict[str, np.ndarray]:
+    """Returns fitness metrics for each accompaniment as arrays of shape (population,).
+
+    All metrics are computed on the whole generation at once. Accompaniments are converted to array of shape
+    (population x beats x chord notes), so their notes must be placed at beats, as GA operators do.
+
+    """
+    melody = MelodyContext.of(melody)
+    chords, triads_lens = compositions_to_chords(accompaniments, melody.ticks_per_beat)
+    population_size, beats_num, _ = chords.shape
+    zeros = np.zeros(population_size)
+    metrics = {
+        MISSING_ACCOMP_FOR_MELODY_TICK: zeros,
+        EXCESS_ACCOMP_TICK_FOR_MELODY: zeros,
+        TOO_BIG_CHORD_DROP: zeros,
+        ACCOMP_TICK_NOT_BELOW_MELODY: zeros,
+        DISSONANCE_INSIDE: zeros,
+        EMPTY_ACCOMPANIMENT: zeros,  # accompaniment level metric
+        DISSONANCE_WITH_MELODY: zeros,
+        ACCOMPANIMENT_CHORD_EXISTS: zeros,
+        TOO_WIDE_ACCOMPANIMENT_RANGE: zeros,
+        CORRECT_TRIAD_FOR_MELODY_KEY: zeros,
+        CHORD_INCLUDE_MELODY_NOTE: zeros,
+        COMPLETED_PROGRESSION: zeros,
+        PARTIAL_PROGRESSION: zeros,
+        TOO_LOW_CHORD: zeros
+    }
+    m_onset_ticks = melody.onset_ticks
+    m_lowest_at_beat, m_bucket_pitch_classes = melody.beat_arrays(beats_num)
+    m_onset_at_beat = m_lowest_at_beat != NO_NOTE
+
+    # per-beat chord features
+    valid = chords != NO_NOTE
+    exists = valid[:, :, 0]
+    chords_num = exists.sum(axis=1)
+    lowest = chords[:, :, 0].astype(np.int64)
+    highest = chords.max(axis=2).astype(np.int64)
+    masks, codes = chord_codes(chords)
+
+    # calculate metrics
+    if ENABLE_ACCOMPANIMENT_CHORD_EXISTS:
+        metrics[ACCOMPANIMENT_CHORD_EXISTS] = chords_num.astype(float)
+    if ENABLE_EMPTY_ACCOMPANIMENT:
+        if len(m_onset_ticks) == 0:
+            metrics[EMPTY_ACCOMPANIMENT] = zeros + 1
+    if ENABLE_MISSING_ACCOMP_FOR_MELODY_TICK:
+        # melody ticks that can not have accompaniment chord in array are always missing
+        out_of_beats_onsets_num = np.count_nonzero((m_onset_ticks % melody.ticks_per_beat != 0) |
+                                                   (m_onset_ticks >= beats_num * melody.ticks_per_beat))
+        metrics[MISSING_ACCOMP_FOR_MELODY_TICK] = \
+            out_of_beats_onsets_num + (~exists & m_onset_at_beat).sum(axis=1).astype(float)
+    if ENABLE_EXCESS_ACCOMP_TICK_FOR_MELODY:
+        metrics[EXCESS_ACCOMP_TICK_FOR_MELODY] = (exists & ~m_onset_at_beat).sum(axis=1).astype(float)
+    if ENABLE_PARTIAL_PROGRESSION or ENABLE_COMPLETED_PROGRESSION:
+        done_partial_max = _progressions_done_partial_max(chords, codes, triads_lens)
+        if ENABLE_COMPLETED_PROGRESSION:
+            metrics[COMPLETED_PROGRESSION] = (done_partial_max == PROGRESSION_LEN).sum(axis=1).astype(float)
+        if ENABLE_PARTIAL_PROGRESSION:
+            metrics[PARTIAL_PROGRESSION] = _sequential_sum(done_partial_max / PROGRESSION_LEN)
+    if ENABLE_TOO_LOW_CHORD:
+        metrics[TOO_LOW_CHORD] = (exists & (lowest <= TOO_LOW_NOTE_UPPER_BOUND)).sum(axis=1).astype(float)
+    if ENABLE_CHORD_INCLUDE_MELODY_NOTE:
+        bucket_sizes = m_bucket_pitch_classes.sum(axis=1)
+        # melody buckets as layers of pitch class masks, layer k has pitch classes used more than k times
+        pitch_class_bits = 1 << np.arange(PITCH_CLASSES_NUM)
+        included = np.zeros(masks.shape, dtype=np.int64)
+        for k in range(m_bucket_pitch_classes.max(initial=0)):
+            layer = ((m_bucket_pitch_classes > k) * pitch_class_bits).sum(axis=1)
+            included += _POPCOUNTS[masks & layer[None, :]]
+        shares = np.where(exists & (bucket_sizes > 0), included / np.maximum(bucket_sizes, 1), 0)
+        metrics[CHORD_INCLUDE_MELODY_NOTE] = _sequential_sum(shares)
+    if ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY:
+        beat_keys = melody.keys_at_beats(beats_num)
+        is_allowed = np.zeros(codes.shape, dtype=bool)
+        for key in np.unique(beat_keys).tolist():
+            key_beats = beat_keys == key
+            is_allowed[:, key_beats] = np.isin(codes[:, key_beats], list(melody.key_allowed_triad_codes[key]))
+        metrics[CORRECT_TRIAD_FOR_MELODY_KEY] = (exists & is_allowed).sum(axis=1).astype(float)
+    if ENABLE_TOO_BIG_CHORD_DROP:
+        beat_numbers = np.arange(beats_num)
+        last_chord_beat = np.maximum.accumulate(np.where(exists, beat_numbers, NO_NOTE), axis=1)
+        prev_chord_beat = np.concatenate([np.full((population_size, 1), NO_NOTE), last_chord_beat[:, :-1]], axis=1)
+        has_prev = prev_chord_beat != NO_NOTE
+        prev_chord_beat = np.maximum(prev_chord_beat, 0)
+        prev_lowest = np.take_along_axis(lowest, prev_chord_beat, axis=1)
+        prev_highest = np.take_along_axis(highest, prev_chord_beat, axis=1)
+        is_drop = (np.abs(highest - prev_highest) >= TOO_BIG_CHORD_DROP_IN_NOTES) | \
+                  (np.abs(prev_lowest - lowest) >= TOO_BIG_CHORD_DROP_IN_NOTES)
+        metrics[TOO_BIG_CHORD_DROP] = (exists & has_prev & is_drop).sum(axis=1).astype(float)
+    if ENABLE_ACCOMP_TICK_NOT_BELOW_MELODY:
+        not_below = m_onset_at_beat[None, :] & (m_lowest_at_beat[None, :] <= highest)
+        metrics[ACCOMP_TICK_NOT_BELOW_MELODY] = (exists & not_below).sum(axis=1).astype(float)
+    if ENABLE_DISSONANCE_INSIDE:
+        # includes septimes, seconds, tritons https://ru.wikipedia.org/wiki/Консонанс_и_диссонанс
+        dissonances = np.zeros(population_size)
+        for i1 in range(chords.shape[2]):
+            for i2 in range(i1 + 1, chords.shape[2]):
+                interval = np.abs(chords[:, :, i1] % 12 - chords[:, :, i2] % 12)
+                is_dissonance = (interval == 11) | (interval == 2) | (interval == 6)
+                dissonances += (valid[:, :, i1] & valid[:, :, i2] & is_dissonance).sum(axis=1)
+        metrics[DISSONANCE_INSIDE] = dissonances
+    if ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE:
+        low_notes_median = np.where(exists, lowest, 0).sum(axis=1) / np.maximum(chords_num, 1)
+        too_wide = np.abs(lowest - low_notes_median[:, None]) > TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES / 2
+        metrics[TOO_WIDE_ACCOMPANIMENT_RANGE] = (exists & too_wide).sum(axis=1).astype(float)
+
+    return metrics
+
+
+def compositions_to_chords(compositions: List[Composition], ticks_per_beat: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns (chords, triads_lens).
+
+    chords is array of shape (population x beats x chord notes) of note numbers sorted inside each chord and padded
+    with NO_NOTE. triads_lens is the length of Composition.triad_names_by_beats for each composition.
+
+    """
+    chords_notes = []
+    triads_lens = []
+    beats_num = 0
+    chord_len = max([len(chord) for chord in NAME_TO_CHORD.values()])
+    for composition in compositions:
+        notes_by_beats = {}
+        for note, start_time in zip(composition.pitches, composition.start_times):
+            assert start_time % ticks_per_beat == 0, "accompaniment notes must be placed at beats"
+            notes_by_beats.setdefault(start_time // ticks_per_beat, []).append(note)
+        chords_notes.append(notes_by_beats)
+        triads_lens.append(composition.duration // ticks_per_beat + 1)
+        beats_num = max([beats_num, triads_lens[-1]] + [beat + 1 for beat in notes_by_beats.keys()])
+        chord_len = max([chord_len] + [len(notes) for notes in notes_by_beats.values()])
+    chords = np.full((len(compositions), beats_num, chord_len), NO_NOTE, dtype=np.int64)
+    for i, notes_by_beats in enumerate(chords_notes):
+        for beat, notes in notes_by_beats.items():
+            chords[i, beat, :len(notes)] = sorted(notes)
+    return chords, np.array(triads_lens)
+
+
+def chord_codes(chords: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns (pitch class masks, chord codes) of chords array of compositions_to_chords (see chord_mask)."""
+    valid = chords != NO_NOTE
+    masks = np.bitwise_or.reduce(np.where(valid, 1 << chords % PITCH_CLASSES_NUM, 0), axis=2)
+    lowest = chords[:, :, 0]
+    in_close_position = (_POPCOUNTS[masks] == valid.sum(axis=2)) & \
+        (chords.max(axis=2) - lowest < PITCH_CLASSES_NUM)
+    codes = np.where(in_close_position, np.maximum(lowest, 0) % PITCH_CLASSES_NUM << PITCH_CLASSES_NUM | masks,
+                     NO_CHORD_CODE)
+    return masks, codes
+
+
+def _progressions_done_partial_max(chords: np.ndarray, codes: np.ndarray, triads_lens: np.ndarray) -> np.ndarray:
+    """Returns array (population x 4-beat windows) of the maximal number of matched chords among PROGRESSIONS.
+
+    Windows that are not considered for a composition have zero matches.
+
+    """
+    population_size, beats_num, _ = chords.shape
+    chord_names = list(NAME_TO_CHORD.keys())
+    # triad_names_by_beats as (base_notes, name ids), only chords rooted at C are recognized
+    found = (codes >= 0) & (codes < 1 << PITCH_CLASSES_NUM)
+    names_ids = np.where(found, _CHORD_NAME_IDS[np.where(found, codes, 0)], len(chord_names))
+    found &= names_ids < len(chord_names)
+    base_notes = np.where(found & (chords[:, :, 0] != NO_NOTE), chords[:, :, 0], 0)
+
+    windows_num = beats_num // PROGRESSION_LEN
+    windows_shape = (population_size, windows_num, PROGRESSION_LEN)
+    base_notes = base_notes[:, :windows_num * PROGRESSION_LEN].reshape(windows_shape)
+    names_ids = names_ids[:, :windows_num * PROGRESSION_LEN].reshape(windows_shape)
+    delta_notes = base_notes - base_notes[:, :, :1]
+    # each distinct window is matched once
+    windows, window_ids = np.unique(np.concatenate([delta_notes, names_ids], axis=2).reshape(-1, 2 * PROGRESSION_LEN),
+                                    axis=0, return_inverse=True)
+    names = chord_names + [UNKNOWN_CHORD_NAME]
+    windows_done_partial_max = np.array([
+        PROGRESSION_INDEX.done_partial_max([(delta, names[name_id]) for delta, name_id in
+                                            zip(window[:PROGRESSION_LEN].tolist(), window[PROGRESSION_LEN:].tolist())])
+        for window in windows
+    ], dtype=np.int64)
+    done_partial_max = windows_done_partial_max[window_ids.reshape(-1)].reshape(windows_shape[:2])
+    considered_windows_num = np.where(triads_lens >= PROGRESSION_LEN,
+                                      (triads_lens - PROGRESSION_LEN) // PROGRESSION_LEN + 1, 0)
+    considered = np.arange(windows_num)[None, :] < considered_windows_num[:, None]
+    return np.where(considered, done_partial_max, 0)
+
+
+def _sequential_sum(values: np.ndarray) -> np.ndarray:
+    """Returns sums along the last axis, added up in the same order as the scalar fitness does."""
+    if values.shape[-1] == 0:
+        return np.zeros(values.shape[:-1])
+    return np.cumsum(values, axis=-1)[..., -1]
+
+
+def _batch_event_to_award(metrics: Dict[str, np.ndarray], population_size: int) -> np.ndarray:
+    award = np.zeros(population_size)
+    weights = EVENT_TO_AWARD_WEIGHTS
+    for metric, counts in metrics.items():
+        if metric not in weights:
+            print(f"WARNING: metric {metric} is not in weights")
+        award = award + weights.get(metric, 0) * counts
+    return award
@@ -1,27 +1,37 @@
-from typing import Dict
+from typing import Dict, Union
 
 from app_config import ENABLE_EMPTY_ACCOMPANIMENT, ENABLE_MISSING_ACCOMP_FOR_MELODY_TICK, \
     ENABLE_EXCESS_ACCOMP_TICK_FOR_MELODY, ENABLE_TOO_BIG_CHORD_DROP, TOO_BIG_CHORD_DROP_IN_NOTES, \
     ENABLE_ACCOMP_TICK_NOT_BELOW_MELODY, ENABLE_DISSONANCE_INSIDE, EVENT_TO_AWARD_WEIGHTS, \
     ENABLE_ACCOMPANIMENT_CHORD_EXISTS, ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE, TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES, \
-    ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY, ALLOWED_ACCOMP_TRIADS_FOR_MELODY_TONIC, ENABLE_CHORD_INCLUDE_MELODY_NOTE, \
-    ENABLE_PARTIAL_PROGRESSION, ENABLE_COMPLETED_PROGRESSION, ENABLE_TOO_LOW_CHORD, TOO_LOW_NOTE_UPPER_BOUND
+    ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY, ENABLE_CHORD_INCLUDE_MELODY_NOTE, ENABLE_PARTIAL_PROGRESSION, \
+    ENABLE_COMPLETED_PROGRESSION, ENABLE_TOO_LOW_CHORD, TOO_LOW_NOTE_UPPER_BOUND
+from genetic_algorithm.melody_context import MelodyContext
 from music_interfaces.composition.composition import Composition
 from genetic_algorithm.fitness_function.fitness_constants import MISSING_ACCOMP_FOR_MELODY_TICK, \
     EXCESS_ACCOMP_TICK_FOR_MELODY, TOO_BIG_CHORD_DROP, ACCOMP_TICK_NOT_BELOW_MELODY, DISSONANCE_INSIDE, \
     EMPTY_ACCOMPANIMENT, DISSONANCE_WITH_MELODY, ACCOMPANIMENT_CHORD_EXISTS, TOO_WIDE_ACCOMPANIMENT_RANGE, \
     CORRECT_TRIAD_FOR_MELODY_KEY, CHORD_INCLUDE_MELODY_NOTE, COMPLETED_PROGRESSION, PARTIAL_PROGRESSION, TOO_LOW_CHORD
-from music_interfaces.composition.composition_constants import PROGRESSIONS
+from music_interfaces.composition.chord_mask import chord_code, included_notes_num, pitch_class_mask
+from music_interfaces.composition.composition_constants import PROGRESSION_LEN
+from music_interfaces.composition.progression_index import PROGRESSION_INDEX
 
 
-def fitness_function(melody: Composition, accompaniment: Composition) -> float:
+def fitness_function(melody: Union[Composition, MelodyContext], accompaniment: Composition) -> float:
     """Returns fitness value of the accompaniment. Less fitness means better accompaniment."""
     metrics = calculate_metrics(melody, accompaniment)
     return _event_to_award(metrics)
 
 
-def calculate_metrics(melody: Composition, accompaniment: Composition) -> Dict[str, float]:
-    """Returns fitness metrics for accompaniment."""
+def calculate_metrics(melody: Union[Composition, MelodyContext], accompaniment: Composition,
+                      beat_metrics: Dict[int, Dict[str, float]] = None) -> Dict[str, float]:
+    """Returns fitness metrics for accompaniment. Melody analysis is done on each call unless MelodyContext is given.
+
+    If beat_metrics dict is given, it is filled with metrics of each beat that has any, so that metrics of all beats sum
+    up to the returned ones. Metrics of a chord go to its beat, chord drop goes to the beat of the second chord and
+    progressions go to the first beat of their window. EMPTY_ACCOMPANIMENT is not attributed to beats.
+
+    """
     metrics = {
         MISSING_ACCOMP_FOR_MELODY_TICK: 0,
         EXCESS_ACCOMP_TICK_FOR_MELODY: 0,
@@ -38,24 +48,22 @@ def calculate_metrics(melody: Composition, accompaniment: Composition) -> Dict[s
         PARTIAL_PROGRESSION: 0,
         TOO_LOW_CHORD: 0
     }
+    melody = MelodyContext.of(melody)
     m_notes_at = melody.notes_at
     a_notes_at = accompaniment.notes_at
-    m_key_tonic, m_key_scale = melody.key
-    allowed_triads = []
-    for triad in ALLOWED_ACCOMP_TRIADS_FOR_MELODY_TONIC[m_key_scale]:
-        min_note = triad[0]
-        octave_shift = ((m_key_tonic + min_note) // 12) * 12
-        allowed_triads.append([m_key_tonic + note - octave_shift for note in triad])
+    bucket_mask_layers = melody.bucket_mask_layers
+    bucket_sizes = melody.bucket_sizes.tolist()
+    ticks_per_beat = melody.ticks_per_beat
 
     # preprocess inputs
-    for time, notes in m_notes_at.items():
-        m_notes_at[time] = sorted(notes, key=lambda note: note.note)
-    for time, notes in a_notes_at.items():
-        a_notes_at[time] = sorted(notes, key=lambda note: note.note)
+    a_notes_at = {time: sorted(notes, key=lambda note: note.note) for time, notes in a_notes_at.items()}
 
     # calculate metrics
     if ENABLE_ACCOMPANIMENT_CHORD_EXISTS:
         metrics[ACCOMPANIMENT_CHORD_EXISTS] += len(a_notes_at)
+        if beat_metrics is not None:
+            for a_time in a_notes_at.keys():
+                _add_beat_metric(beat_metrics, a_time // ticks_per_beat, ACCOMPANIMENT_CHORD_EXISTS, 1)
     if ENABLE_EMPTY_ACCOMPANIMENT:
         if len(m_notes_at) == 0:
             metrics[EMPTY_ACCOMPANIMENT] += 1
@@ -63,29 +71,28 @@ def calculate_metrics(melody: Composition, accompaniment: Composition) -> Dict[s
         for m_time in m_notes_at.keys():
             if a_notes_at.get(m_time) is None:
                 metrics[MISSING_ACCOMP_FOR_MELODY_TICK] += 1
+                if beat_metrics is not None:
+                    _add_beat_metric(beat_metrics, m_time // ticks_per_beat, MISSING_ACCOMP_FOR_MELODY_TICK, 1)
     if ENABLE_EXCESS_ACCOMP_TICK_FOR_MELODY:
         for a_time in a_notes_at.keys():
             if m_notes_at.get(a_time) is None:
                 metrics[EXCESS_ACCOMP_TICK_FOR_MELODY] += 1
+                if beat_metrics is not None:
+                    _add_beat_metric(beat_metrics, a_time // ticks_per_beat, EXCESS_ACCOMP_TICK_FOR_MELODY, 1)
     if ENABLE_PARTIAL_PROGRESSION or ENABLE_COMPLETED_PROGRESSION:
         triad_names_by_beats = accompaniment.triad_names_by_beats
-        progression_len = 4
-        for i_four_beats in range(0, len(triad_names_by_beats) - progression_len + 1, progression_len):
-            done_partial_max = 0
-            for progression in PROGRESSIONS:
-                done_partial = 0
-                prev_min_chord_note = triad_names_by_beats[i_four_beats][0]
-                for i in range(4):
-                    delta_note = triad_names_by_beats[i_four_beats + i][0] - prev_min_chord_note
-                    triad = triad_names_by_beats[i_four_beats + i][1]
-                    done_partial += 1 if (delta_note, triad) == progression[i] else 0
-                done_partial_max = max(done_partial_max, done_partial)
-                if done_partial_max == 4:
-                    if ENABLE_COMPLETED_PROGRESSION:
-                        metrics[COMPLETED_PROGRESSION] += 1
-                    break
+        for i_four_beats in range(0, len(triad_names_by_beats) - PROGRESSION_LEN + 1, PROGRESSION_LEN):
+            done_partial_max = PROGRESSION_INDEX.done_partial_max(
+                triad_names_by_beats[i_four_beats:i_four_beats + PROGRESSION_LEN])
+            if done_partial_max == PROGRESSION_LEN and ENABLE_COMPLETED_PROGRESSION:
+                metrics[COMPLETED_PROGRESSION] += 1
+                if beat_metrics is not None:
+                    _add_beat_metric(beat_metrics, i_four_beats, COMPLETED_PROGRESSION, 1)
             if ENABLE_PARTIAL_PROGRESSION:
-                metrics[PARTIAL_PROGRESSION] += done_partial_max / progression_len
+                metrics[PARTIAL_PROGRESSION] += done_partial_max / PROGRESSION_LEN
+                if beat_metrics is not None and done_partial_max > 0:
+                    _add_beat_metric(beat_metrics, i_four_beats, PARTIAL_PROGRESSION,
+                                     done_partial_max / PROGRESSION_LEN)
     if len(a_notes_at) > 0:
         prev_max_chord_note = None
         prev_min_chord_note = None
@@ -97,22 +104,25 @@ def calculate_metrics(melody: Composition, accompaniment: Composition) -> Dict[s
             max_chord_note = a_notes_at[a_time][-1].note
             a_notes_as_numbers = [note.note for note in a_notes_at[a_time]]
             low_notes_sum += min_chord_note
+            beat = a_time // ticks_per_beat
             if ENABLE_TOO_LOW_CHORD:
                 if min_chord_note <= TOO_LOW_NOTE_UPPER_BOUND:
                     metrics[TOO_LOW_CHORD] += 1
+                    if beat_metrics is not None:
+                        _add_beat_metric(beat_metrics, beat, TOO_LOW_CHORD, 1)
             if ENABLE_CHORD_INCLUDE_MELODY_NOTE:
-                melody_notes_included = 0
-                a_notes_as_chord_numbers = [note % 12 for note in a_notes_as_numbers]
-                m_notes_in_bucket = melody.notes_by_buckets.get(a_time, [])
-                for m_note in m_notes_in_bucket:
-                    if m_note.note % 12 in a_notes_as_chord_numbers:
-                        melody_notes_included += 1
-                if len(m_notes_in_bucket) > 0:
-                    metrics[CHORD_INCLUDE_MELODY_NOTE] += melody_notes_included / len(m_notes_in_bucket)
+                if a_time % ticks_per_beat == 0 and beat < len(bucket_sizes) and bucket_sizes[beat] > 0:
+                    melody_notes_included = included_notes_num(pitch_class_mask(a_notes_as_numbers),
+                                                               bucket_mask_layers[beat])
+                    metrics[CHORD_INCLUDE_MELODY_NOTE] += melody_notes_included / bucket_sizes[beat]
+                    if beat_metrics is not None and melody_notes_included > 0:
+                        _add_beat_metric(beat_metrics, beat, CHORD_INCLUDE_MELODY_NOTE,
+                                         melody_notes_included / bucket_sizes[beat])
             if ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY:
-                octave_note = (min_chord_note // 12) * 12
-                if [note.note - octave_note for note in a_notes_at[a_time]] in allowed_triads:
+                if chord_code(a_notes_as_numbers) in melody.allowed_triad_codes_at(beat):
                     metrics[CORRECT_TRIAD_FOR_MELODY_KEY] += 1
+                    if beat_metrics is not None:
+                        _add_beat_metric(beat_metrics, beat, CORRECT_TRIAD_FOR_MELODY_KEY, 1)
             if min_min_chord_note is None or a_notes_at[a_time][0].note < min_min_chord_note:
                 min_min_chord_note = a_notes_at[a_time][0].note
             if max_min_chord_note is None or a_notes_at[a_time][0].note > max_min_chord_note:
@@ -124,11 +134,15 @@ def calculate_metrics(melody: Composition, accompaniment: Composition) -> Dict[s
                      abs(prev_min_chord_note - min_chord_note) >= TOO_BIG_CHORD_DROP_IN_NOTES)
             ):
                 metrics[TOO_BIG_CHORD_DROP] += 1
+                if beat_metrics is not None:
+                    _add_beat_metric(beat_metrics, beat, TOO_BIG_CHORD_DROP, 1)
             if ENABLE_ACCOMP_TICK_NOT_BELOW_MELODY:
                 if m_notes_at.get(a_time) is not None:
                     m_min_chord_note = m_notes_at[a_time][0].note
                     if m_min_chord_note <= max_chord_note:
                         metrics[ACCOMP_TICK_NOT_BELOW_MELODY] += 1
+                        if beat_metrics is not None:
+                            _add_beat_metric(beat_metrics, beat, ACCOMP_TICK_NOT_BELOW_MELODY, 1)
             for i1 in range(len(a_notes_at[a_time])):
                 # if ENABLE_DISSONANCE_WITH_MELODY:
                 #     pass  # TODO
@@ -139,12 +153,10 @@ def calculate_metrics(melody: Composition, accompaniment: Composition) -> Dict[s
                         note2 = a_notes_at[a_time][i2]
                         note1_num = note1.note % 12
                         note2_num = note2.note % 12
-                        if abs(note1_num - note2_num) == 11:  # septima (big septima)
-                            metrics[DISSONANCE_INSIDE] += 1
-                        elif abs(note1_num - note2_num) == 2:  # second (big second)
-                            metrics[DISSONANCE_INSIDE] += 1
-                        elif abs(note1_num - note2_num) == 6:  # triton
+                        if abs(note1_num - note2_num) in (11, 2, 6):  # big septima, big second, triton
                             metrics[DISSONANCE_INSIDE] += 1
+                            if beat_metrics is not None:
+                                _add_beat_metric(beat_metrics, beat, DISSONANCE_INSIDE, 1)
             prev_max_chord_note = max_chord_note
             prev_min_chord_note = min_chord_note
         low_notes_median = low_notes_sum / len(a_notes_at)
@@ -153,10 +165,33 @@ def calculate_metrics(melody: Composition, accompaniment: Composition) -> Dict[s
             if ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE:
                 if abs(min_chord_note - low_notes_median) > TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES / 2:
                     metrics[TOO_WIDE_ACCOMPANIMENT_RANGE] += 1
+                    if beat_metrics is not None:
+                        _add_beat_metric(beat_metrics, a_time // ticks_per_beat, TOO_WIDE_ACCOMPANIMENT_RANGE, 1)
 
     return metrics
 
 
+def beat_penalties(beat_metrics: Dict[int, Dict[str, float]]) -> Dict[int, float]:
+    """Returns penalty of each beat of beat_metrics (see calculate_metrics): award of metrics with positive award
+    values and the missed award of CORRECT_TRIAD_FOR_MELODY_KEY for a chord that is not a triad of melody key."""
+    weights = EVENT_TO_AWARD_WEIGHTS
+    triad_weight = weights.get(CORRECT_TRIAD_FOR_MELODY_KEY, 0) if ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY else 0
+    penalties = {}
+    for beat, metrics in beat_metrics.items():
+        penalty = sum([weights.get(metric, 0) * count for metric, count in metrics.items()
+                       if weights.get(metric, 0) > 0])
+        chords_num = metrics.get(ACCOMPANIMENT_CHORD_EXISTS, 0)
+        if chords_num > 0 and triad_weight < 0:
+            penalty -= triad_weight * (chords_num - metrics.get(CORRECT_TRIAD_FOR_MELODY_KEY, 0))
+        penalties[beat] = penalty
+    return penalties
+
+
+def _add_beat_metric(beat_metrics: Dict[int, Dict[str, float]], beat: int, metric: str, value: float):
+    beat_metrics.setdefault(beat, {})
+    beat_metrics[beat][metric] = beat_metrics[beat].get(metric, 0) + value
+
+
 def _event_to_award(metrics: Dict[str, float]) -> float:
     award = 0
     weights = EVENT_TO_AWARD_WEIGHTS
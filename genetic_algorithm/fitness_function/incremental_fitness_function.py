@@ -0,0 +1,383 @@
+from math import lcm
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from app_config import ENABLE_EMPTY_ACCOMPANIMENT, ENABLE_MISSING_ACCOMP_FOR_MELODY_TICK, \
+    ENABLE_EXCESS_ACCOMP_TICK_FOR_MELODY, ENABLE_TOO_BIG_CHORD_DROP, TOO_BIG_CHORD_DROP_IN_NOTES, \
+    ENABLE_ACCOMP_TICK_NOT_BELOW_MELODY, ENABLE_DISSONANCE_INSIDE, ENABLE_ACCOMPANIMENT_CHORD_EXISTS, \
+    ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE, TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES, ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY, \
+    ENABLE_CHORD_INCLUDE_MELODY_NOTE, ENABLE_PARTIAL_PROGRESSION, ENABLE_COMPLETED_PROGRESSION, ENABLE_TOO_LOW_CHORD, \
+    TOO_LOW_NOTE_UPPER_BOUND
+from genetic_algorithm.fitness_function.fitness_constants import MISSING_ACCOMP_FOR_MELODY_TICK, \
+    EXCESS_ACCOMP_TICK_FOR_MELODY, TOO_BIG_CHORD_DROP, ACCOMP_TICK_NOT_BELOW_MELODY, DISSONANCE_INSIDE, \
+    EMPTY_ACCOMPANIMENT, DISSONANCE_WITH_MELODY, ACCOMPANIMENT_CHORD_EXISTS, TOO_WIDE_ACCOMPANIMENT_RANGE, \
+    CORRECT_TRIAD_FOR_MELODY_KEY, CHORD_INCLUDE_MELODY_NOTE, COMPLETED_PROGRESSION, PARTIAL_PROGRESSION, TOO_LOW_CHORD
+from genetic_algorithm.fitness_function.fitness_function import calculate_metrics, _event_to_award
+from genetic_algorithm.melody_context import MelodyContext, NO_NOTE
+from music_interfaces.composition.composition import Composition
+from music_interfaces.composition.chord_mask import chord_code, chord_name, code_root, included_notes_num, \
+    pitch_class_mask
+from music_interfaces.composition.composition_constants import PROGRESSION_LEN, UNKNOWN_CHORD_NAME
+from music_interfaces.composition.progression_index import PROGRESSION_INDEX
+
+MAX_MIDI_NOTE = 127
+# overrides of SharedBeatValues are merged into its values when they reach this share of them
+MERGED_OVERRIDES_SHARE = 1 / 16
+
+# metrics that depend only on the chord at a beat, in order of BeatFitnessState.local values
+LOCAL_METRICS = [MISSING_ACCOMP_FOR_MELODY_TICK, EXCESS_ACCOMP_TICK_FOR_MELODY, ACCOMP_TICK_NOT_BELOW_MELODY,
+                 DISSONANCE_INSIDE, ACCOMPANIMENT_CHORD_EXISTS, CORRECT_TRIAD_FOR_MELODY_KEY, CHORD_INCLUDE_MELODY_NOTE,
+                 TOO_LOW_CHORD]
+ENABLED_LOCAL_METRICS = [ENABLE_MISSING_ACCOMP_FOR_MELODY_TICK, ENABLE_EXCESS_ACCOMP_TICK_FOR_MELODY,
+                         ENABLE_ACCOMP_TICK_NOT_BELOW_MELODY, ENABLE_DISSONANCE_INSIDE,
+                         ENABLE_ACCOMPANIMENT_CHORD_EXISTS, ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY,
+                         ENABLE_CHORD_INCLUDE_MELODY_NOTE, ENABLE_TOO_LOW_CHORD]
+
+Chord = Tuple[int, ...]
+
+
+class IncrementalFitnessFunction:
+    """Fitness function that rescores only beats of the accompaniment changed since evaluation of its parent.
+
+    Evaluated accompaniment keeps its per-beat metric contributions in fitness_state. GA operators pass the state to
+    children together with dirty_beats, the set of beats where the child differs from the state. Rescoring of a beat
+    updates its own contributions, chord drops to its neighbour chords, its 4-beat progression window and running
+    sums for the accompaniment range. Notes of dirty beats are read from the columns of the accompaniment and children
+    share per-beat values of unchanged beats with the parent state, so rescoring takes time in proportion to dirty
+    beats. Gives the same values as fitness_function.
+
+    Note: accompaniments with notes that are not placed at beats or do not last exactly one beat are evaluated by
+    calculate_metrics.
+
+    """
+    def __init__(self, melody: Union[Composition, MelodyContext]):
+        self.melody = MelodyContext.of(melody)
+        self.ticks_per_beat = self.melody.ticks_per_beat
+        # melody arrays as lists for fast access to single beats
+        self.lowest_notes = self.melody.lowest_notes.tolist()
+        self.bucket_mask_layers = self.melody.bucket_mask_layers
+        self.bucket_sizes = self.melody.bucket_sizes.tolist()
+        # CHORD_INCLUDE_MELODY_NOTE shares are kept as integers scaled by common multiple of bucket sizes
+        self.include_scale = lcm(*[bucket_size for bucket_size in self.bucket_sizes if bucket_size > 0])
+
+    def __call__(self, melody: Union[Composition, MelodyContext], accompaniment: Composition) -> float:
+        return _event_to_award(self.calculate_metrics(accompaniment))
+
+    def calculate_metrics(self, accompaniment: Composition) -> Dict[str, float]:
+        """Returns fitness metrics for accompaniment and keeps its fitness_state for children."""
+        state = self.get_state(accompaniment)
+        if state is None:
+            return calculate_metrics(self.melody, accompaniment)
+        return state.metrics()
+
+    def get_state(self, accompaniment: Composition) -> Optional["BeatFitnessState"]:
+        """Returns per-beat fitness state of the accompaniment, updating the parent state on dirty beats only.
+
+        Returns None if accompaniment chords are not one beat long chords placed at beats.
+
+        """
+        parent_state = accompaniment.fitness_state
+        dirty_beats = accompaniment.dirty_beats
+        state = None
+        if isinstance(parent_state, BeatFitnessState) and parent_state.fitness_function is self and \
+                dirty_beats is not None and parent_state.min_duration == accompaniment.min_duration:
+            chords = self._dirty_chords(accompaniment, dirty_beats) if len(dirty_beats) > 0 else {}
+            if chords is not None:
+                state = parent_state.copy()
+                for beat, chord in chords.items():
+                    state.set_chord(beat, chord)
+        if state is None:
+            chords = {}
+            for time, notes in accompaniment.notes_at.items():
+                chords[time // self.ticks_per_beat] = self._get_chord(notes)
+                if time % self.ticks_per_beat != 0 or chords[time // self.ticks_per_beat] is None:
+                    accompaniment.fitness_state = accompaniment.dirty_beats = None
+                    return None
+            state = BeatFitnessState(self, chords, accompaniment.min_duration)
+        accompaniment.fitness_state = state
+        accompaniment.dirty_beats = set()
+        return state
+
+    def local_values(self, beat: int, chord: Chord) -> Tuple[int, ...]:
+        """Returns contributions of chord placed at the beat to LOCAL_METRICS."""
+        m_lowest_note = self.lowest_notes[beat] if beat < len(self.lowest_notes) else NO_NOTE
+        if len(chord) == 0:
+            return 1 if m_lowest_note != NO_NOTE else 0, 0, 0, 0, 0, 0, 0, 0
+        min_chord_note = chord[0]
+        max_chord_note = chord[-1]
+        dissonances = 0
+        if ENABLE_DISSONANCE_INSIDE:
+            for i1 in range(len(chord)):
+                for i2 in range(i1 + 1, len(chord)):
+                    if abs(chord[i1] % 12 - chord[i2] % 12) in (11, 2, 6):
+                        dissonances += 1
+        included_scaled = 0
+        bucket_notes_num = self.bucket_sizes[beat] if beat < len(self.bucket_sizes) else 0
+        if bucket_notes_num > 0:
+            included = included_notes_num(pitch_class_mask(chord), self.bucket_mask_layers[beat])
+            included_scaled = included * (self.include_scale // bucket_notes_num)
+        return (0,
+                1 if m_lowest_note == NO_NOTE else 0,
+                1 if m_lowest_note != NO_NOTE and m_lowest_note <= max_chord_note else 0,
+                dissonances,
+                1,
+                1 if chord_code(chord) in self.melody.allowed_triad_codes_at(beat) else 0,
+                included_scaled,
+                1 if min_chord_note <= TOO_LOW_NOTE_UPPER_BOUND else 0)
+
+    def triad(self, chord: Chord) -> Tuple[int, str]:
+        """Returns (base_note, chord_name) of the chord as Composition.triad_names_by_beats does."""
+        code = chord_code(chord)
+        name = chord_name(code) if code_root(code) == 0 else None
+        return (chord[0] if len(chord) > 0 else 0, name) if name is not None else (0, UNKNOWN_CHORD_NAME)
+
+    def _dirty_chords(self, accompaniment: Composition, dirty_beats: Set[int]) -> Optional[Dict[int, Chord]]:
+        """Returns chords of dirty beats read from columns of the accompaniment by Composition.at_beats offsets, or
+        None if its notes are not ordered by beats or not placed at beats."""
+        start_times = accompaniment.columns[1]
+        beats_num = int(start_times[-1]) // self.ticks_per_beat + 1 if len(start_times) > 0 else 0
+        ordered, offsets = accompaniment.at_beats(beats_num)
+        if ordered is not accompaniment:
+            return None
+        chords = {}
+        for beat in sorted(dirty_beats):
+            chords[beat] = self._get_chord(accompaniment.notes_slice(offsets[beat], offsets[beat + 1])
+                                           if beat < beats_num else [])
+            if chords[beat] is None:
+                return None
+        return chords
+
+    def _get_chord(self, notes: list) -> Optional[Chord]:
+        """Returns sorted note numbers of one beat long chord or None for other notes."""
+        for note in notes:
+            if note.duration != self.ticks_per_beat:
+                return None
+        return tuple(sorted([note.note for note in notes]))
+
+
+class BeatFitnessState:
+    """Per-beat contributions to fitness metrics of an accompaniment with running sums of them."""
+    def __init__(self, fitness_function: IncrementalFitnessFunction, chords: Dict[int, Chord], min_duration: int):
+        self.fitness_function = fitness_function
+        self.min_duration = min_duration
+        self.last_chord_beat = max([beat for beat, chord in chords.items() if len(chord) > 0], default=-1)
+        beats_num = max(self.last_chord_beat + 2, self._triads_len(), len(fitness_function.lowest_notes))
+        beats_num = -(-beats_num // PROGRESSION_LEN) * PROGRESSION_LEN
+        chords = [chords.get(beat, ()) for beat in range(beats_num)]
+        local = [fitness_function.local_values(beat, chord) for beat, chord in enumerate(chords)]
+        self.chords = SharedBeatValues(chords)
+        self.local = SharedBeatValues(local)
+        self.local_sums = [sum(values) for values in zip(*local)]
+        # accompaniment range
+        self.low_notes_counts = [0] * (MAX_MIDI_NOTE + 1)
+        self.low_notes_sum = 0
+        self.chords_num = 0
+        # chord drops
+        drops = [0] * beats_num
+        prev_chord = None
+        for beat, chord in enumerate(chords):
+            if len(chord) > 0:
+                self.low_notes_counts[chord[0]] += 1
+                self.low_notes_sum += chord[0]
+                self.chords_num += 1
+                drops[beat] = self._is_drop(prev_chord, chord)
+                prev_chord = chord
+        self.drops = SharedBeatValues(drops)
+        self.drops_num = sum(drops)
+        # progressions
+        windows = [self._window_done_partial_max(window) for window in range(beats_num // PROGRESSION_LEN)]
+        self.windows = SharedBeatValues(windows)
+        self.considered_windows_num = self._considered_windows_num()
+        self.done_partial_sum = sum(windows[:self.considered_windows_num])
+        self.completed_num = windows[:self.considered_windows_num].count(PROGRESSION_LEN)
+
+    def copy(self) -> "BeatFitnessState":
+        """Returns copy of the state that can be changed independently. Per-beat values of unchanged beats are shared
+        with this state (see SharedBeatValues)."""
+        copy = object.__new__(BeatFitnessState)
+        copy.__dict__.update(self.__dict__)
+        copy.chords = self.chords.copy()
+        copy.local = self.local.copy()
+        copy.local_sums = self.local_sums.copy()
+        copy.low_notes_counts = self.low_notes_counts.copy()
+        copy.drops = self.drops.copy()
+        copy.windows = self.windows.copy()
+        return copy
+
+    def set_chord(self, beat: int, chord: Chord):
+        """Replaces chord at the beat and rescores metrics that depend on it."""
+        if beat >= len(self.chords) - 1:
+            self._extend(beat + 2)
+        old_chord = self.chords[beat]
+        if old_chord == chord:
+            return
+        self.chords[beat] = chord
+        new_local = self.fitness_function.local_values(beat, chord)
+        self.local_sums = [total - old + new for total, old, new in zip(self.local_sums, self.local[beat], new_local)]
+        self.local[beat] = new_local
+        for sign, changed_chord in ((-1, old_chord), (1, chord)):
+            if len(changed_chord) > 0:
+                self.low_notes_counts[changed_chord[0]] += sign
+                self.low_notes_sum += sign * changed_chord[0]
+                self.chords_num += sign
+        if len(chord) > 0 and beat > self.last_chord_beat:
+            self.last_chord_beat = beat
+        elif len(chord) == 0 and beat == self.last_chord_beat:
+            self.last_chord_beat = self._prev_chord_beat(beat)
+        self._update_drop(beat)
+        next_chord_beat = self._next_chord_beat(beat)
+        if next_chord_beat is not None:
+            self._update_drop(next_chord_beat)
+        self._update_window(beat // PROGRESSION_LEN)
+        self._update_considered_windows()
+
+    def metrics(self) -> Dict[str, float]:
+        """Returns fitness metrics in the same form as calculate_metrics does."""
+        metrics = {
+            MISSING_ACCOMP_FOR_MELODY_TICK: 0,
+            EXCESS_ACCOMP_TICK_FOR_MELODY: 0,
+            TOO_BIG_CHORD_DROP: 0,
+            ACCOMP_TICK_NOT_BELOW_MELODY: 0,
+            DISSONANCE_INSIDE: 0,
+            EMPTY_ACCOMPANIMENT: 0,  # accompaniment level metric
+            DISSONANCE_WITH_MELODY: 0,
+            ACCOMPANIMENT_CHORD_EXISTS: 0,
+            TOO_WIDE_ACCOMPANIMENT_RANGE: 0,
+            CORRECT_TRIAD_FOR_MELODY_KEY: 0,
+            CHORD_INCLUDE_MELODY_NOTE: 0,
+            COMPLETED_PROGRESSION: 0,
+            PARTIAL_PROGRESSION: 0,
+            TOO_LOW_CHORD: 0
+        }
+        for metric, enabled, total in zip(LOCAL_METRICS, ENABLED_LOCAL_METRICS, self.local_sums):
+            if enabled:
+                metrics[metric] = total
+        if ENABLE_MISSING_ACCOMP_FOR_MELODY_TICK:
+            metrics[MISSING_ACCOMP_FOR_MELODY_TICK] += self.fitness_function.melody.out_of_beats_onsets_num
+        if ENABLE_CHORD_INCLUDE_MELODY_NOTE:
+            metrics[CHORD_INCLUDE_MELODY_NOTE] = self.local_sums[LOCAL_METRICS.index(CHORD_INCLUDE_MELODY_NOTE)] / \
+                self.fitness_function.include_scale
+        if ENABLE_EMPTY_ACCOMPANIMENT and len(self.fitness_function.melody.onset_ticks) == 0:
+            metrics[EMPTY_ACCOMPANIMENT] = 1
+        if ENABLE_COMPLETED_PROGRESSION:
+            metrics[COMPLETED_PROGRESSION] = self.completed_num
+        if ENABLE_PARTIAL_PROGRESSION:
+            metrics[PARTIAL_PROGRESSION] = self.done_partial_sum / PROGRESSION_LEN
+        if ENABLE_TOO_BIG_CHORD_DROP:
+            metrics[TOO_BIG_CHORD_DROP] = self.drops_num
+        if ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE and self.chords_num > 0:
+            low_notes_median = self.low_notes_sum / self.chords_num
+            in_range_num = 0
+            lowest_considered_note = max(0, int(low_notes_median) - TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES)
+            highest_considered_note = min(MAX_MIDI_NOTE, int(low_notes_median) + TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES)
+            for low_note in range(lowest_considered_note, highest_considered_note + 1):
+                if abs(low_note - low_notes_median) <= TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES / 2:
+                    in_range_num += self.low_notes_counts[low_note]
+            metrics[TOO_WIDE_ACCOMPANIMENT_RANGE] = self.chords_num - in_range_num
+        return metrics
+
+    def _extend(self, beats_num: int):
+        beats_num = -(-beats_num // PROGRESSION_LEN) * PROGRESSION_LEN
+        new_beats = range(len(self.chords), beats_num)
+        new_local = [self.fitness_function.local_values(beat, ()) for beat in new_beats]
+        self.chords.extend([()] * len(new_beats))
+        self.local.extend(new_local)
+        self.local_sums = [total + sum(values) for total, values in zip(self.local_sums, zip(*new_local))] \
+            if len(new_local) > 0 else self.local_sums
+        self.drops.extend([0] * len(new_beats))
+        self.windows.extend([self._window_done_partial_max(window)
+                             for window in range(len(self.windows), beats_num // PROGRESSION_LEN)])
+
+    def _prev_chord_beat(self, beat: int) -> int:
+        beat -= 1
+        while beat >= 0 and len(self.chords[beat]) == 0:
+            beat -= 1
+        return beat
+
+    def _next_chord_beat(self, beat: int) -> Optional[int]:
+        for next_beat in range(beat + 1, self.last_chord_beat + 1):
+            if len(self.chords[next_beat]) > 0:
+                return next_beat
+        return None
+
+    @staticmethod
+    def _is_drop(prev_chord: Optional[Chord], chord: Chord) -> int:
+        return 1 if prev_chord is not None and len(chord) > 0 and (
+                abs(chord[-1] - prev_chord[-1]) >= TOO_BIG_CHORD_DROP_IN_NOTES or
+                abs(prev_chord[0] - chord[0]) >= TOO_BIG_CHORD_DROP_IN_NOTES) else 0
+
+    def _update_drop(self, beat: int):
+        prev_chord_beat = self._prev_chord_beat(beat)
+        drop = self._is_drop(self.chords[prev_chord_beat] if prev_chord_beat >= 0 else None, self.chords[beat])
+        self.drops_num += drop - self.drops[beat]
+        self.drops[beat] = drop
+
+    def _triads_len(self) -> int:
+        """Returns length of Composition.triad_names_by_beats for the accompaniment."""
+        duration = max([(self.last_chord_beat + 1) * self.fitness_function.ticks_per_beat] +
+                       ([self.min_duration] if self.min_duration is not None else []))
+        return duration // self.fitness_function.ticks_per_beat + 1
+
+    def _considered_windows_num(self) -> int:
+        return min(self._triads_len() // PROGRESSION_LEN, len(self.windows))
+
+    def _window_done_partial_max(self, window: int) -> int:
+        triads = [self.fitness_function.triad(self.chords[beat])
+                  for beat in range(window * PROGRESSION_LEN, min((window + 1) * PROGRESSION_LEN, len(self.chords)))]
+        return PROGRESSION_INDEX.done_partial_max(triads)
+
+    def _update_window(self, window: int):
+        done_partial_max = self._window_done_partial_max(window)
+        if window < self.considered_windows_num:
+            self.done_partial_sum += done_partial_max - self.windows[window]
+            self.completed_num += (done_partial_max == PROGRESSION_LEN) - (self.windows[window] == PROGRESSION_LEN)
+        self.windows[window] = done_partial_max
+
+    def _update_considered_windows(self):
+        considered_windows_num = self._considered_windows_num()
+        sign = 1 if considered_windows_num > self.considered_windows_num else -1
+        for window in range(min(considered_windows_num, self.considered_windows_num),
+                            max(considered_windows_num, self.considered_windows_num)):
+            self.done_partial_sum += sign * self.windows[window]
+            self.completed_num += sign * (self.windows[window] == PROGRESSION_LEN)
+        self.considered_windows_num = considered_windows_num
+
+
+class SharedBeatValues:
+    """Per-beat values that share values of unchanged beats with values they are copied from.
+
+    Changed values are kept in overrides of the copy and merged into its own list of values when there are
+    MERGED_OVERRIDES_SHARE of them, so a copy takes time in proportion to beats changed since the last merge.
+
+    """
+    __slots__ = ("values", "overrides")
+
+    def __init__(self, values: list):
+        self.values = values  # shared between copies and never changed in place
+        self.overrides = {}
+
+    def copy(self) -> "SharedBeatValues":
+        """Returns copy of the values that can be changed independently."""
+        copy = object.__new__(SharedBeatValues)
+        copy.values = self.values
+        copy.overrides = self.overrides.copy()
+        return copy
+
+    def extend(self, values: list):
+        """Appends values after the last beat."""
+        self.values = self.values + values
+
+    def __getitem__(self, beat: int):
+        overrides = self.overrides
+        return overrides[beat] if beat in overrides else self.values[beat]
+
+    def __setitem__(self, beat: int, value):
+        self.overrides[beat] = value
+        if len(self.overrides) >= len(self.values) * MERGED_OVERRIDES_SHARE:
+            values = self.values.copy()
+            for overridden_beat, overridden_value in self.overrides.items():
+                values[overridden_beat] = overridden_value
+            self.values = values
+            self.overrides = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
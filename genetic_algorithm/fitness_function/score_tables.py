@@ -0,0 +1,192 @@
+import time
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from app_config import ENABLE_EMPTY_ACCOMPANIMENT, ENABLE_MISSING_ACCOMP_FOR_MELODY_TICK, \
+    ENABLE_EXCESS_ACCOMP_TICK_FOR_MELODY, TOO_BIG_CHORD_DROP_IN_NOTES, \
+    ENABLE_ACCOMP_TICK_NOT_BELOW_MELODY, ENABLE_DISSONANCE_INSIDE, EVENT_TO_AWARD_WEIGHTS, \
+    ENABLE_ACCOMPANIMENT_CHORD_EXISTS, ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY, ENABLE_CHORD_INCLUDE_MELODY_NOTE, \
+    ENABLE_PARTIAL_PROGRESSION, ENABLE_COMPLETED_PROGRESSION, ENABLE_TOO_LOW_CHORD, TOO_LOW_NOTE_UPPER_BOUND, MAX_NOTE
+from genetic_algorithm.fitness_function.fitness_constants import MISSING_ACCOMP_FOR_MELODY_TICK, \
+    EXCESS_ACCOMP_TICK_FOR_MELODY, ACCOMP_TICK_NOT_BELOW_MELODY, DISSONANCE_INSIDE, \
+    EMPTY_ACCOMPANIMENT, ACCOMPANIMENT_CHORD_EXISTS, CORRECT_TRIAD_FOR_MELODY_KEY, CHORD_INCLUDE_MELODY_NOTE, \
+    COMPLETED_PROGRESSION, PARTIAL_PROGRESSION, TOO_LOW_CHORD
+from genetic_algorithm.melody_context import MelodyContext, NO_NOTE
+from music_interfaces.composition.composition import Composition
+from music_interfaces.composition.chord_mask import chord_code
+from music_interfaces.composition.composition_constants import ACCOMPANIMENT_CHORDS, NAME_TO_CHORD, PROGRESSION_LEN, \
+    EMPTY_CHORD_NAME, UNKNOWN_CHORD_NAME
+from music_interfaces.composition.progression_index import PROGRESSION_INDEX
+
+# beat states: chord shape with its lowest note (shape * LOWS_NUM + lowest note) or EMPTY_STATE
+CHORD_SHAPES = [chord for chord in ACCOMPANIMENT_CHORDS if len(chord) > 0]
+SHAPE_WIDTHS = np.array([max(chord) for chord in CHORD_SHAPES])
+LOWS_NUM = MAX_NOTE + 1
+EMPTY_STATE = len(CHORD_SHAPES) * LOWS_NUM
+STATES_NUM = EMPTY_STATE + 1
+STATE_SHAPES = np.append(np.repeat(np.arange(len(CHORD_SHAPES)), LOWS_NUM), NO_NOTE)
+STATE_LOWS = np.append(np.tile(np.arange(LOWS_NUM), len(CHORD_SHAPES)), NO_NOTE)
+
+
+def get_weight(metric: str, enabled: bool) -> float:
+    """Returns award value of the metric or 0 if the metric is disabled."""
+    return EVENT_TO_AWARD_WEIGHTS.get(metric, 0) if enabled else 0
+
+
+class ScoreTables:
+    """Weighted fitness scores precomputed once per melody, so fitness of chords placed at beats is found by lookups.
+
+    local_scores (beats x STATES_NUM) holds the award of beat-local metrics for each state at each beat: chord exists,
+    missing and excessive accompaniment tick, accompaniment tick not below melody, dissonance inside, correct triad for
+    melody key at the beat (see MelodyContext.beat_keys), chord include melody note and too low chord. drop_table
+    (shapes x shapes x lowest notes difference) tells whether the step between two consecutive chords is too big chord
+    drop. window_scores (STATES_NUM,) holds progression awards of a 4-beat window by its first state, or is None if
+    other window positions may match (see _window_scores). constant_score is the award that does not depend on
+    accompaniment.
+
+    """
+    def __init__(self, melody: Union[Composition, MelodyContext]):
+        start_time = time.perf_counter()
+        self.melody = MelodyContext.of(melody)
+        self.beats_num = self.melody.beats_num
+        shape_names = _shape_names()
+        # triad_names_by_beats values of states
+        self.state_triads = [(low, shape_names[shape]) if low % 12 == 0 else (0, UNKNOWN_CHORD_NAME)
+                             for shape, low in zip(STATE_SHAPES[:EMPTY_STATE].tolist(),
+                                                   STATE_LOWS[:EMPTY_STATE].tolist())] + [(0, EMPTY_CHORD_NAME)]
+        self.constant_score, self.local_scores = self._local_scores()
+        self.drop_table = self._drop_table()
+        self.window_scores = self._window_scores()
+        self.build_time = time.perf_counter() - start_time
+
+    @property
+    def nbytes(self) -> int:
+        """Returns memory used by the tables in bytes."""
+        return self.local_scores.nbytes + self.drop_table.nbytes + \
+            (self.window_scores.nbytes if self.window_scores is not None else 0)
+
+    @property
+    def summary(self) -> str:
+        """Returns description of the tables size and build time."""
+        return f"{self.beats_num} beats x {STATES_NUM} states, {self.nbytes / 2 ** 20:.2f} MiB, " \
+               f"built in {self.build_time:.3f}s"
+
+    def _local_scores(self) -> Tuple[float, np.ndarray]:
+        """Returns (award that does not depend on accompaniment, awards of beat-local metrics (beats x states))."""
+        melody = self.melody
+        lowest_notes, bucket_pitch_classes = melody.beat_arrays(self.beats_num)
+        onsets = lowest_notes != NO_NOTE
+        bucket_sizes = bucket_pitch_classes.sum(axis=1)
+        shapes_num = len(CHORD_SHAPES)
+        lows = np.arange(LOWS_NUM)
+        chord_pitch_classes = np.zeros((shapes_num, LOWS_NUM, 12), dtype=np.int64)
+        # keys at beats as indices of key_allowed_triad_codes
+        keys, beat_key_indices = np.unique(melody.keys_at_beats(self.beats_num), return_inverse=True)
+        key_correct_triads = np.zeros((len(keys), shapes_num, LOWS_NUM))
+        dissonances = np.zeros((shapes_num, LOWS_NUM))
+        for k, chord in enumerate(CHORD_SHAPES):
+            for low in lows:
+                pitch_classes = [(low + note) % 12 for note in chord]
+                chord_pitch_classes[k, low, pitch_classes] = 1
+                code = chord_code([low + note for note in chord])
+                key_correct_triads[:, k, low] = [code in melody.key_allowed_triad_codes[key] for key in keys.tolist()]
+                dissonances[k, low] = sum(abs(pitch_classes[i1] - pitch_classes[i2]) in (11, 2, 6)
+                                          for i1 in range(len(chord)) for i2 in range(i1 + 1, len(chord)))
+        correct_triads = key_correct_triads[beat_key_indices]
+        included = np.einsum("bp,klp->bkl", bucket_pitch_classes, chord_pitch_classes)
+        included_shares = included / np.maximum(bucket_sizes, 1)[:, None, None]
+        not_below = onsets[:, None, None] & (lowest_notes[:, None, None] <= lows[None, None, :] + SHAPE_WIDTHS[:, None])
+
+        chord_scores = get_weight(ACCOMPANIMENT_CHORD_EXISTS, ENABLE_ACCOMPANIMENT_CHORD_EXISTS) + \
+            get_weight(EXCESS_ACCOMP_TICK_FOR_MELODY, ENABLE_EXCESS_ACCOMP_TICK_FOR_MELODY) * ~onsets[:, None, None] + \
+            get_weight(TOO_LOW_CHORD, ENABLE_TOO_LOW_CHORD) * (lows <= TOO_LOW_NOTE_UPPER_BOUND)[None, None, :] + \
+            get_weight(CHORD_INCLUDE_MELODY_NOTE, ENABLE_CHORD_INCLUDE_MELODY_NOTE) * included_shares + \
+            get_weight(CORRECT_TRIAD_FOR_MELODY_KEY, ENABLE_CORRECT_TRIAD_FOR_MELODY_KEY) * correct_triads + \
+            get_weight(ACCOMP_TICK_NOT_BELOW_MELODY, ENABLE_ACCOMP_TICK_NOT_BELOW_MELODY) * not_below + \
+            get_weight(DISSONANCE_INSIDE, ENABLE_DISSONANCE_INSIDE) * dissonances[None]
+        missing_weight = get_weight(MISSING_ACCOMP_FOR_MELODY_TICK, ENABLE_MISSING_ACCOMP_FOR_MELODY_TICK)
+        local_scores = np.concatenate([chord_scores.reshape(self.beats_num, EMPTY_STATE),
+                                       (missing_weight * onsets)[:, None]], axis=1)
+        # melody onsets that can not be covered by a chord at a beat
+        uncovered_onsets_num = len(melody.onset_ticks) - np.count_nonzero(onsets)
+        constant_score = missing_weight * uncovered_onsets_num + \
+            get_weight(EMPTY_ACCOMPANIMENT, ENABLE_EMPTY_ACCOMPANIMENT) * (len(melody.notes_at) == 0)
+        return constant_score, local_scores
+
+    def _drop_table(self) -> np.ndarray:
+        """Returns whether there is too big chord drop from a chord shape to a chord shape for each difference of their
+        lowest notes from -MAX_NOTE to MAX_NOTE."""
+        low_deltas = np.arange(-MAX_NOTE, MAX_NOTE + 1)
+        width_deltas = SHAPE_WIDTHS[None, :] - SHAPE_WIDTHS[:, None]
+        return (np.abs(low_deltas)[None, None, :] >= TOO_BIG_CHORD_DROP_IN_NOTES) | \
+               (np.abs(low_deltas[None, None, :] + width_deltas[:, :, None]) >= TOO_BIG_CHORD_DROP_IN_NOTES)
+
+    def _window_scores(self) -> Union[np.ndarray, None]:
+        """Returns progression awards of a window by its first state or None if positions after the first may match.
+
+        triad_names_by_beats recognizes only chords with the lowest note divisible by 12, so no state matches window
+        positions after the first one for progressions whose steps are not multiples of octave, and the award of a
+        window depends only on its first state.
+
+        """
+        partial_weight = get_weight(PARTIAL_PROGRESSION, ENABLE_PARTIAL_PROGRESSION)
+        completed_weight = get_weight(COMPLETED_PROGRESSION, ENABLE_COMPLETED_PROGRESSION)
+        if partial_weight > 0 or completed_weight > 0 or self.later_positions_match():
+            return None
+        first_award = partial_weight / PROGRESSION_LEN + (completed_weight if PROGRESSION_LEN == 1 else 0)
+        first_triads = set((0, progression[0][1]) for progression in PROGRESSION_INDEX.progressions)
+        return np.array([first_award if (0, name) in first_triads else 0 for base, name in self.state_triads])
+
+    def later_positions_match(self) -> bool:
+        """Returns whether some state may match a progression at window position after the first one."""
+        anchor_bases = set(base for base, name in self.state_triads)
+        triads = set(self.state_triads)
+        return any((delta_base + delta, name) in triads
+                   for progression in PROGRESSION_INDEX.progressions for delta, name in progression[1:PROGRESSION_LEN]
+                   for delta_base in anchor_bases)
+
+    def states_of(self, chords: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (states (population x beats), whether all chords of a composition have states (population,)) for
+        chords array of compositions_to_chords."""
+        population_size, beats_num, chord_len = chords.shape
+        chords = np.concatenate([chords, np.full((population_size, beats_num, max(0, 3 - chord_len)), NO_NOTE)],
+                                axis=2)
+        notes_nums = (chords != NO_NOTE).sum(axis=2)
+        lows = chords[:, :, 0]
+        intervals = chords[:, :, 1:3] - lows[:, :, None]
+        known_intervals = ((intervals >= 0) & (intervals < _SHAPE_IDS.shape[0])).all(axis=2)
+        intervals = np.where(known_intervals[:, :, None], intervals, 0)
+        shapes = np.where(known_intervals, _SHAPE_IDS[intervals[:, :, 0], intervals[:, :, 1]], NO_NOTE)
+        is_chord = (notes_nums == 3) & (shapes != NO_NOTE) & (lows <= MAX_NOTE)
+        has_state = is_chord | (notes_nums == 0)
+        states = np.where(is_chord, shapes * LOWS_NUM + lows, EMPTY_STATE)
+        in_tables = np.arange(beats_num) < self.beats_num
+        return states, (has_state & (in_tables | (notes_nums == 0))).all(axis=1)
+
+
+def _shape_names() -> List[str]:
+    return [next(name for name, chord in NAME_TO_CHORD.items() if chord == shape) for shape in CHORD_SHAPES]
+
+
+def _shape_ids() -> np.ndarray:
+    """Returns shape ids indexed by intervals from the lowest note to the second and the third notes of chord."""
+    shape_ids = np.full((max(SHAPE_WIDTHS) + 1, max(SHAPE_WIDTHS) + 1), NO_NOTE)
+    for k, chord in enumerate(CHORD_SHAPES):
+        if len(chord) == 3:
+            shape_ids[chord[1], chord[2]] = k
+    return shape_ids
+
+
+_SHAPE_IDS = _shape_ids()
+
+
+def _state_chords() -> np.ndarray:
+    """Returns notes of each state padded with NO_NOTE, as chords of compositions_to_chords."""
+    state_chords = np.full((STATES_NUM, max(len(chord) for chord in CHORD_SHAPES)), NO_NOTE)
+    for k, chord in enumerate(CHORD_SHAPES):
+        state_chords[k * LOWS_NUM:(k + 1) * LOWS_NUM, :len(chord)] = np.arange(LOWS_NUM)[:, None] + np.array(chord)
+    return state_chords
+
+
+STATE_CHORDS = _state_chords()
@@ -0,0 +1,114 @@
+from typing import List, Union
+
+import numpy as np
+
+from app_config import ENABLE_TOO_BIG_CHORD_DROP, ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE, \
+    TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES, ENABLE_PARTIAL_PROGRESSION, ENABLE_COMPLETED_PROGRESSION, MAX_NOTE
+from genetic_algorithm.fitness_function.batch_fitness_function import chord_codes, compositions_to_chords, \
+    _progressions_done_partial_max
+from genetic_algorithm.fitness_function.fitness_constants import TOO_BIG_CHORD_DROP, TOO_WIDE_ACCOMPANIMENT_RANGE, \
+    COMPLETED_PROGRESSION, PARTIAL_PROGRESSION
+from genetic_algorithm.fitness_function.fitness_function import fitness_function
+from genetic_algorithm.fitness_function.score_tables import ScoreTables, EMPTY_STATE, STATE_SHAPES, STATE_LOWS, \
+    STATE_CHORDS, get_weight
+from genetic_algorithm.genome import Genome
+from genetic_algorithm.melody_context import MelodyContext, NO_NOTE
+from music_interfaces.composition.composition import Composition
+from music_interfaces.composition.composition_constants import PROGRESSION_LEN
+
+
+class TableFitnessFunction:
+    """Fitness function that gathers beat-local awards and chord drops from ScoreTables of the melody and adds
+    progression and accompaniment range terms. Gives the same values as fitness_function up to rounding of float sums.
+
+    Works on the whole generation at once when batch is used as batch_fitness_function.
+
+    Note: accompaniments with chords that have no state in the tables are evaluated by fitness_function.
+
+    """
+    def __init__(self, melody: Union[Composition, MelodyContext]):
+        self.tables = ScoreTables(melody)
+        self.melody = self.tables.melody
+        self.drop_weight = get_weight(TOO_BIG_CHORD_DROP, ENABLE_TOO_BIG_CHORD_DROP)
+        self.wide_weight = get_weight(TOO_WIDE_ACCOMPANIMENT_RANGE, ENABLE_TOO_WIDE_ACCOMPANIMENT_RANGE)
+        self.partial_weight = get_weight(PARTIAL_PROGRESSION, ENABLE_PARTIAL_PROGRESSION)
+        self.completed_weight = get_weight(COMPLETED_PROGRESSION, ENABLE_COMPLETED_PROGRESSION)
+
+    def __call__(self, melody: Union[Composition, MelodyContext], accompaniment: Union[Composition, Genome]) -> float:
+        return float(self.batch(melody, [accompaniment])[0])
+
+    def batch(self, melody: Union[Composition, MelodyContext], accompaniments: Union[List[Composition], List[Genome]]) \
+            -> np.ndarray:
+        """Returns fitness values of the accompaniments. Notes must be placed at beats, as GA operators do. Genomes are
+        evaluated from their states without decoding."""
+        tables = self.tables
+        if len(accompaniments) > 0 and isinstance(accompaniments[0], Genome):
+            triads_lens = np.array([genome.triads_len(self.melody) for genome in accompaniments])
+            states = np.stack([genome.states for genome in accompaniments]).astype(np.int64)
+            # states are padded to the length of triad_names_by_beats, as compositions_to_chords pads chords, so the
+            # last progression window is considered when it ends after the last beat
+            states = np.pad(states, ((0, 0), (0, max(0, int(triads_lens.max()) - states.shape[1]))),
+                            constant_values=EMPTY_STATE)
+            chords = STATE_CHORDS[states]
+            has_states = np.ones(len(accompaniments), dtype=bool)
+        else:
+            chords, triads_lens = compositions_to_chords(accompaniments, self.melody.ticks_per_beat)
+            states, has_states = tables.states_of(chords)
+        population_size, beats_num = states.shape
+        exists = states != EMPTY_STATE
+        chords_num = exists.sum(axis=1)
+        shapes = STATE_SHAPES[states]
+        lows = STATE_LOWS[states]
+
+        table_states = np.full((population_size, tables.beats_num), EMPTY_STATE)
+        shared_beats_num = min(beats_num, tables.beats_num)
+        table_states[:, :shared_beats_num] = states[:, :shared_beats_num]
+        fitnesses = tables.constant_score + \
+            tables.local_scores[np.arange(tables.beats_num)[None, :], table_states].sum(axis=1)
+
+        beat_numbers = np.arange(beats_num)
+        last_chord_beat = np.maximum.accumulate(np.where(exists, beat_numbers, NO_NOTE), axis=1)
+        prev_chord_beat = np.concatenate([np.full((population_size, 1), NO_NOTE), last_chord_beat[:, :-1]], axis=1)
+        prev_states = np.take_along_axis(states, np.maximum(prev_chord_beat, 0), axis=1)
+        is_drop = tables.drop_table[STATE_SHAPES[prev_states], shapes, lows - STATE_LOWS[prev_states] + MAX_NOTE]
+        fitnesses += self.drop_weight * (exists & (prev_chord_beat != NO_NOTE) & is_drop).sum(axis=1)
+
+        low_notes_median = np.where(exists, lows, 0).sum(axis=1) / np.maximum(chords_num, 1)
+        too_wide = np.abs(lows - low_notes_median[:, None]) > TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES / 2
+        fitnesses += self.wide_weight * (exists & too_wide).sum(axis=1)
+
+        windows_num = beats_num // PROGRESSION_LEN
+        considered = np.arange(windows_num)[None, :] < (triads_lens // PROGRESSION_LEN)[:, None]
+        if tables.window_scores is not None:
+            first_states = states[:, :windows_num * PROGRESSION_LEN:PROGRESSION_LEN]
+            fitnesses += np.where(considered, tables.window_scores[first_states], 0).sum(axis=1)
+        else:
+            _, codes = chord_codes(chords)
+            done_partial_max = _progressions_done_partial_max(chords, codes, triads_lens)
+            fitnesses += self.partial_weight * (done_partial_max / PROGRESSION_LEN).sum(axis=1) + \
+                self.completed_weight * (done_partial_max == PROGRESSION_LEN).sum(axis=1)
+
+        for i in np.nonzero(~has_states | (chords_num == 0))[0]:
+            accompaniment = accompaniments[i]
+            fitnesses[i] = fitness_function(self.melody, accompaniment.to_composition(self.melody)
+                                            if isinstance(accompaniment, Genome) else accompaniment)
+        return fitnesses
+
+    def beat_penalties(self, states: np.ndarray) -> np.ndarray:
+        """Returns penalties of beats of genome states (candidates x beats): excess of beat-local award of the state
+        over the best beat-local award at the beat and award of too big chord drop from the previous chord."""
+        tables = self.tables
+        population_size, beats_num = states.shape
+        states = states.astype(np.int64)
+        shared_beats_num = min(beats_num, tables.beats_num)
+        local_scores = tables.local_scores[:shared_beats_num]
+        penalties = np.zeros((population_size, beats_num))
+        penalties[:, :shared_beats_num] = local_scores[np.arange(shared_beats_num)[None, :],
+                                                       states[:, :shared_beats_num]] - local_scores.min(axis=1)
+        exists = states != EMPTY_STATE
+        last_chord_beat = np.maximum.accumulate(np.where(exists, np.arange(beats_num), NO_NOTE), axis=1)
+        prev_chord_beat = np.concatenate([np.full((population_size, 1), NO_NOTE), last_chord_beat[:, :-1]], axis=1)
+        prev_states = np.take_along_axis(states, np.maximum(prev_chord_beat, 0), axis=1)
+        is_drop = tables.drop_table[STATE_SHAPES[prev_states], STATE_SHAPES[states],
+                                    STATE_LOWS[states] - STATE_LOWS[prev_states] + MAX_NOTE]
+        return penalties + self.drop_weight * (exists & (prev_chord_beat != NO_NOTE) & is_drop)
@@ -1,42 +1,151 @@
+import heapq
 import random
-from typing import Callable, List, Tuple
+import time
+from contextlib import nullcontext
+from typing import Callable, List, Sequence, Tuple, Union
 
+from genetic_algorithm.evaluation_backend import EVALUATION_BACKENDS, SERIAL_BACKEND
+from genetic_algorithm.fitness_cache import FitnessCache
+from genetic_algorithm.local_search import LocalSearch
+from genetic_algorithm.melody_context import MelodyContext
 from genetic_algorithm.mutation_strategy import get_random_candidate
+from genetic_algorithm.population_operators import PopulationOperators
+from genetic_algorithm.selection_strategy import select_truncation
+from genetic_algorithm.snapshot_writer import SnapshotWriter
+from genetic_algorithm.stagnation_detector import StagnationDetector, STOP_ACTION, RERANDOMIZE_ACTION
 from logging.logging import log
 from logging.logging_constants import INFO_LEVEL
 from music_interfaces.composition.composition import Composition
 
 
+def without_worst(candidates_fitness: List[Tuple[Composition, float]], worst_num: int) \
+        -> List[Tuple[Composition, float]]:
+    """Returns evaluated candidates without worst_num worst ones, found by partial selection. Of candidates with equal
+    fitness the later ones are worse."""
+    worst_indices = set(heapq.nlargest(worst_num, range(len(candidates_fitness)),
+                                       key=lambda i: (candidates_fitness[i][1], i)))
+    return [candidate_fitness for i, candidate_fitness in enumerate(candidates_fitness) if i not in worst_indices]
+
+
 class GeneticAlgorithm:
-    """Implementation of genetic algorithm for generating accompaniment for a given melody."""
-    def __init__(self, melody: Composition, fitness_function: Callable[[Composition, Composition], float],
+    """Implementation of genetic algorithm for generating accompaniment for a given melody.
+
+    Melody is analysed once to MelodyContext that is passed to fitness functions and operators instead of the melody.
+    Candidates are Compositions or Genomes, depending on operators given. If population_operators are given, they
+    replace random_candidate_strategy, crossover_strategy and mutation_strategy and make whole generation at once.
+
+    Best-so-far candidate, its fitness and fitness_curve of (seconds since start, generation, best-so-far fitness) at
+    each improvement are kept during the run. If snapshot_writer is given, it is offered the best-so-far candidate after
+    each generation. If stagnation_detector is given, it is updated with each generation, and actions it returns are
+    performed. If local_search is given, it improves the best candidates of generations when it is due.
+
+    Parents are chosen by selection_strategy (see selection_strategy.py). elite_num best candidates of each generation
+    are carried over to the next one with their known fitness in place of as many children. Evaluated generations are
+    not sorted: the best candidate, the elite and the worst candidates are found by partial selection.
+
+    """
+    def __init__(self, melody: Union[Composition, MelodyContext],
+                 fitness_function: Callable[[MelodyContext, Composition], float],
                  crossover_strategy: Callable[[Composition, Composition, float], Tuple[Composition, Composition]],
-                 mutation_strategy: Callable[[Composition, float], Composition]):
+                 mutation_strategy: Callable[[Composition, float], Composition],
+                 batch_fitness_function: Callable[[MelodyContext, List[Composition]], Sequence[float]] = None,
+                 evaluation_backend: str = SERIAL_BACKEND, workers_num: int = None, chunk_size: int = None,
+                 fitness_cache_size: int = None,
+                 random_candidate_strategy: Callable[[MelodyContext], Composition] = get_random_candidate,
+                 population_operators: PopulationOperators = None, snapshot_writer: SnapshotWriter = None,
+                 stagnation_detector: StagnationDetector = None, local_search: LocalSearch = None,
+                 selection_strategy: Callable[[List[Tuple[Composition, float]], int, int],
+                                              List[Tuple[Composition, float]]] = select_truncation,
+                 elite_num: int = 0):
+        assert elite_num >= 0, "elite_num must not be negative"
         self.melody = melody
+        self.melody_context = MelodyContext.of(melody)
         self.fitness_function = fitness_function
         self.crossover_strategy = crossover_strategy
         self.mutation_strategy = mutation_strategy
+        self.batch_fitness_function = batch_fitness_function
+        self.random_candidate_strategy = random_candidate_strategy
+        self.population_operators = population_operators
+        self.snapshot_writer = snapshot_writer
+        self.stagnation_detector = stagnation_detector
+        self.local_search = local_search
+        self.selection_strategy = selection_strategy
+        self.elite_num = elite_num
+        self.selection_time = 0
+        self.selections_num = 0
+        self.best_candidate = None
+        self.best_fitness = None
+        self.fitness_curve = []
+        self.start_time = None
+        assert evaluation_backend in EVALUATION_BACKENDS, \
+            f"evaluation_backend must be one of {list(EVALUATION_BACKENDS.keys())}"
+        self.evaluation_backend = EVALUATION_BACKENDS[evaluation_backend](
+            melody=self.melody_context, fitness_function=fitness_function,
+            batch_fitness_function=batch_fitness_function, workers_num=workers_num, chunk_size=chunk_size)
+        self.fitness_cache = FitnessCache(fitness_cache_size) if fitness_cache_size else None
+
+    @property
+    def selection_summary(self) -> str:
+        """Returns mean time of parents selection per generation."""
+        mean_time = self.selection_time / self.selections_num if self.selections_num > 0 else 0
+        return f"{mean_time * 1000:.3f} ms per generation for {self.selections_num} generations"
 
     def get_init_generation(self, candidates_num: int) -> List[Composition]:
         """Return randomly generated accompaniments."""
-        return [get_random_candidate(self.melody) for i in range(candidates_num)]
+        if self.population_operators is not None:
+            return self.population_operators.init_generation(candidates_num)
+        return [self.random_candidate_strategy(self.melody_context) for i in range(candidates_num)]
+
+    def evaluate(self, candidates: List[Composition]) -> List[Tuple[Composition, float]]:
+        """Returns (candidate, fitness) pairs in order of candidates.
+
+        Candidates are evaluated by evaluation_backend in chunks. Whole chunk is evaluated at once if
+        batch_fitness_function is given, otherwise fitness_function is called for each candidate. If fitness_cache is
+        used, only candidates with content that is neither cached nor repeated in the generation are evaluated.
+
+        """
+        if self.fitness_cache is None:
+            fitnesses = self.evaluation_backend.evaluate(candidates)
+        else:
+            keys = [FitnessCache.key(candidate) for candidate in candidates]
+            fitness_by_key = {}
+            candidate_by_key = {}
+            for key, candidate in zip(keys, candidates):
+                if key in fitness_by_key or key in candidate_by_key:
+                    self.fitness_cache.duplicates += 1
+                    continue
+                fitness = self.fitness_cache.get(key)
+                if fitness is None:
+                    candidate_by_key[key] = candidate
+                else:
+                    fitness_by_key[key] = fitness
+            for key, fitness in zip(candidate_by_key.keys(),
+                                    self.evaluation_backend.evaluate(list(candidate_by_key.values()))):
+                self.fitness_cache.put(key, fitness)
+                fitness_by_key[key] = fitness
+            fitnesses = [fitness_by_key[key] for key in keys]
+            log(f"\tFitness cache:\t{self.fitness_cache.reset_generation_stats()}")
+        return list(zip(candidates, fitnesses))
 
-    def get_next_generation(self, candidates_fitness_sorted: List[Tuple[Composition, float]], mutation_chance: float,
+    def get_next_generation(self, candidates_fitness: List[Tuple[Composition, float]], mutation_chance: float,
                             best_parents_num: int, random_parents_num: int, generation_size: int,
                             similarity_to_single_parent: float) -> List[Composition]:
         """Returns Compositions as a result of mutation on results of crossover of given candidates.
 
-        Compositions for crossover (parents) are selected among the best and random candidates, the number of which is
-        given by parameters best_parents_num and random_parents_num, respectively. The offspring is obtained as a result
-        of a crossover between random pairs of parents.
+        Compositions for crossover (parents) are selected by selection_strategy, by default among the best and random
+        candidates, the number of which is given by parameters best_parents_num and random_parents_num, respectively.
+        The offspring is obtained as a result of a crossover between random pairs of parents.
 
         """
         parents_num = best_parents_num + random_parents_num
         assert parents_num >= 2, "at least two parents should be provided to make crossover"
-        assert len(candidates_fitness_sorted) >= parents_num, "parents_num can not exceed size of population"
-        random_parents = random.sample(candidates_fitness_sorted[best_parents_num:], random_parents_num)
-        best_parents = candidates_fitness_sorted[:best_parents_num]
-        parents = best_parents + random_parents
+        assert len(candidates_fitness) >= parents_num, "parents_num can not exceed size of population"
+        start_time = time.perf_counter()
+        parents = self.selection_strategy(candidates_fitness, best_parents_num, random_parents_num)
+        self.selection_time += time.perf_counter() - start_time
+        self.selections_num += 1
+        best_parents = parents[:best_parents_num]
+        random_parents = parents[best_parents_num:]
 
         log(f"\tAverage parents fitness:\t"
             f"{sum([fitn for cand, fitn in parents]) / parents_num}\n"
@@ -44,6 +153,10 @@ class GeneticAlgorithm:
             f"{(sum([fitn for cand, fitn in best_parents]) / best_parents_num) if best_parents_num != 0 else 0}\n"
             f"\tAverage random parents fitness:\t"
             f"{(sum([fitn for cand, fitn in random_parents]) / random_parents_num) if random_parents_num != 0 else 0}")
+        if self.population_operators is not None:
+            return self.population_operators.next_generation(
+                [parent for parent, fitness in parents], generation_size=generation_size,
+                similarity_to_single_parent=similarity_to_single_parent, mutation_chance=mutation_chance)
         # crossover children
         children = []
         while len(children) < generation_size:
@@ -60,42 +173,102 @@ class GeneticAlgorithm:
         return children
 
     def solve(self, generation_size: int, mutation_chance: float, best_parents_num: int, random_parents_num: int,
-              similarity_to_single_parent: float, target_fitness: float = None, iterations_num: int = None) \
-            -> (Composition, float):
-        """Return best accompaniment of last offspring and its fitness value.
+              similarity_to_single_parent: float, target_fitness: float = None, iterations_num: int = None,
+              time_budget: float = None) -> (Composition, float):
+        """Return best accompaniment found in all offsprings and its fitness value.
 
-        Algorithm generate new offsprings until desired number of iterations is reached or target fitness is obtained.
+        Algorithm generate new offsprings until desired number of iterations is reached, target fitness is obtained or
+        time_budget seconds pass. The generation that is being made when time_budget ends is finished.
 
         """
-        assert target_fitness is not None or iterations_num is not None
+        assert target_fitness is not None or iterations_num is not None or time_budget is not None
+        self.best_candidate, self.best_fitness, self.fitness_curve = None, None, []
+        self.start_time = time.perf_counter()
+        deadline = self.start_time + time_budget if time_budget is not None else None
+        with self.evaluation_backend, self.snapshot_writer or nullcontext():
+            return self._solve(generation_size=generation_size, mutation_chance=mutation_chance,
+                               best_parents_num=best_parents_num, random_parents_num=random_parents_num,
+                               similarity_to_single_parent=similarity_to_single_parent, target_fitness=target_fitness,
+                               iterations_num=iterations_num, deadline=deadline)
+
+    def _solve(self, generation_size: int, mutation_chance: float, best_parents_num: int, random_parents_num: int,
+               similarity_to_single_parent: float, target_fitness: float, iterations_num: int, deadline: float) \
+            -> (Composition, float):
         log(f"Genetic algorithm init", INFO_LEVEL)
-        candidates_fitness = sorted(
-            [
-                (candidate, self.fitness_function(self.melody, candidate))
-                for candidate in self.get_init_generation(generation_size)
-            ],
-            key=lambda candidate_fitness: candidate_fitness[1]
-        )
-        best_candidate, best_fitness = candidates_fitness[0]
+        candidates_fitness = self.evaluate(self.get_init_generation(generation_size))
+        best_candidate, best_fitness = min(candidates_fitness, key=lambda candidate_fitness: candidate_fitness[1])
         log(f"Init generation info:\n\tBest fitness:\t{best_fitness}\n\tAverage fitness:\t"
             f"{sum([fitn for cand, fitn in candidates_fitness]) / len(candidates_fitness)}")
+        self.record(0, candidates_fitness)
+        self.evolve(candidates_fitness, generation_size=generation_size, mutation_chance=mutation_chance,
+                    best_parents_num=best_parents_num, random_parents_num=random_parents_num,
+                    similarity_to_single_parent=similarity_to_single_parent, target_fitness=target_fitness,
+                    iterations_num=iterations_num, deadline=deadline)
+        return self.best_candidate, self.best_fitness
+
+    def evolve(self, candidates_fitness: List[Tuple[Composition, float]], generation_size: int, mutation_chance: float,
+               best_parents_num: int, random_parents_num: int, similarity_to_single_parent: float,
+               target_fitness: float = None, iterations_num: int = None, first_iteration: int = 0,
+               deadline: float = None) -> Tuple[List[Tuple[Composition, float]], int]:
+        """Returns last evaluated generation and number of performed iterations.
+
+        Generations are made from given evaluated candidates until number of iterations is reached, target fitness is
+        obtained, time.perf_counter() passes deadline or stagnation_detector stops the run. first_iteration is used to
+        number generations.
+
+        """
+        best_candidate, best_fitness = min(candidates_fitness, key=lambda candidate_fitness: candidate_fitness[1])
         i = 0
         while (target_fitness is None or (target_fitness is not None and best_fitness > target_fitness)) and \
-              (iterations_num is None or (iterations_num is not None and i < iterations_num)):
-            candidates_fitness = sorted(
-                [
-                    (candidate, self.fitness_function(self.melody, candidate))
-                    for candidate in self.get_next_generation(candidates_fitness_sorted=candidates_fitness,
-                                                              mutation_chance=mutation_chance,
-                                                              best_parents_num=best_parents_num,
-                                                              random_parents_num=random_parents_num,
-                                                              generation_size=generation_size,
-                                                              similarity_to_single_parent=similarity_to_single_parent)
-                ],
-                key=lambda candidate_fitness: candidate_fitness[1]
-            )
-            best_candidate, best_fitness = candidates_fitness[0]
-            log(f"{i+1}\t generation info:\n\tBest fitness:\t{best_fitness}\n\tAverage fitness:\t"
+              (iterations_num is None or (iterations_num is not None and i < iterations_num)) and \
+              (deadline is None or time.perf_counter() < deadline):
+            elite = heapq.nsmallest(min(self.elite_num, generation_size), candidates_fitness,
+                                    key=lambda candidate_fitness: candidate_fitness[1])
+            candidates_fitness = elite + self.evaluate(
+                self.get_next_generation(candidates_fitness=candidates_fitness,
+                                         mutation_chance=self.stagnation_detector.mutation_chance(mutation_chance)
+                                         if self.stagnation_detector is not None else mutation_chance,
+                                         best_parents_num=best_parents_num,
+                                         random_parents_num=random_parents_num,
+                                         generation_size=generation_size - len(elite),
+                                         similarity_to_single_parent=similarity_to_single_parent)
+            ) if len(elite) < generation_size else elite
+            best_candidate, best_fitness = min(candidates_fitness, key=lambda candidate_fitness: candidate_fitness[1])
+            log(f"{first_iteration + i + 1}\t generation info:\n\tBest fitness:\t{best_fitness}\n\tAverage fitness:\t"
                 f"{sum([fitn for cand, fitn in candidates_fitness]) / len(candidates_fitness)}")
             i += 1
-        return best_candidate, best_fitness
+            if self.local_search is not None:
+                candidates_fitness = self.local_search.improve(first_iteration + i, candidates_fitness)
+            self.record(first_iteration + i, candidates_fitness)
+            action = self.stagnation_detector.update(first_iteration + i, candidates_fitness) \
+                if self.stagnation_detector is not None else None
+            if action is not None:
+                log(f"Stagnation at {first_iteration + i} generation:\t{action}", INFO_LEVEL)
+            if action == STOP_ACTION:
+                if iterations_num is not None:
+                    self.stagnation_detector.generations_saved += iterations_num - i
+                if deadline is not None:
+                    self.stagnation_detector.seconds_saved += max(0.0, deadline - time.perf_counter())
+                break
+            if action == RERANDOMIZE_ACTION:
+                candidates_fitness = self.rerandomize(candidates_fitness,
+                                                      self.stagnation_detector.rerandomized_share)
+        return candidates_fitness, i
+
+    def rerandomize(self, candidates_fitness: List[Tuple[Composition, float]], share: float) \
+            -> List[Tuple[Composition, float]]:
+        """Returns evaluated generation where given share of the worst candidates is replaced by random ones."""
+        random_candidates_num = max(1, int(len(candidates_fitness) * share))
+        return without_worst(candidates_fitness, random_candidates_num) + \
+            self.evaluate(self.get_init_generation(random_candidates_num))
+
+    def record(self, generation: int, candidates_fitness: List[Tuple[Composition, float]]):
+        """Updates best-so-far candidate and fitness_curve by evaluated generation and offers snapshot."""
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        candidate, fitness = min(candidates_fitness, key=lambda candidate_fitness: candidate_fitness[1])
+        if self.best_fitness is None or fitness < self.best_fitness:
+            self.best_candidate, self.best_fitness = candidate, fitness
+            self.fitness_curve.append((time.perf_counter() - self.start_time, generation, fitness))
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.offer(generation, self.best_candidate, self.best_fitness)
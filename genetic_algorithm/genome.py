@@ -0,0 +1,52 @@
+from hashlib import blake2b
+
+import numpy as np
+
+from genetic_algorithm.fitness_function.score_tables import CHORD_SHAPES, EMPTY_STATE, STATE_SHAPES, STATE_LOWS
+from genetic_algorithm.melody_context import MelodyContext
+from music_interfaces.composition.composition import Composition
+from music_interfaces.note import CompositionNote
+
+GENOME_DTYPE = np.int16
+
+
+class Genome:
+    """Compact GA candidate that keeps one chord state per beat of the melody (see ScoreTables) in NumPy buffer.
+
+    State of a beat is chord shape id with the lowest note of the chord or EMPTY_STATE. Chords last one beat, as chords
+    of GA operators on Composition do. Genome is converted to Composition by to_composition for results only.
+
+    """
+    __slots__ = ("states",)
+
+    def __init__(self, states: np.ndarray):
+        self.states = states
+
+    @property
+    def key(self) -> bytes:
+        """Returns hash of the states, see FitnessCache.key."""
+        return blake2b(self.states.tobytes(), digest_size=16).digest()
+
+    def triads_len(self, melody: MelodyContext) -> int:
+        """Returns length of Composition.triad_names_by_beats for the decoded genome."""
+        chord_beats = np.nonzero(self.states != EMPTY_STATE)[0]
+        duration = max([(int(chord_beats[-1]) + 1) * melody.ticks_per_beat if len(chord_beats) > 0 else 0] +
+                       ([melody.min_duration] if melody.min_duration is not None else []))
+        return duration // melody.ticks_per_beat + 1
+
+    def clone(self) -> "Genome":
+        """Returns exact copy of the Genome."""
+        return Genome(self.states.copy())
+
+    def to_composition(self, melody: MelodyContext) -> Composition:
+        """Returns accompaniment Composition with chords of the genome placed at beats of the melody."""
+        ticks_per_beat = melody.ticks_per_beat
+        composition = melody.clone()
+        composition.notes = [CompositionNote(note=low + note, start_time=beat * ticks_per_beat, duration=ticks_per_beat)
+                             for beat, (shape, low) in enumerate(zip(STATE_SHAPES[self.states].tolist(),
+                                                                     STATE_LOWS[self.states].tolist()))
+                             if shape >= 0 for note in CHORD_SHAPES[shape]]
+        return composition
+
+    def __len__(self) -> int:
+        return len(self.states)
@@ -0,0 +1,278 @@
+import heapq
+import os
+import random
+import time
+from contextlib import nullcontext
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from genetic_algorithm.genetic_algorithm import GeneticAlgorithm, without_worst
+from genetic_algorithm.genome import Genome
+from logging.logging import log
+from logging.logging_constants import INFO_LEVEL
+from music_interfaces.composition.composition import Composition
+
+RING_TOPOLOGY = "ring"
+FULL_TOPOLOGY = "full"
+TOPOLOGIES = [RING_TOPOLOGY, FULL_TOPOLOGY]
+
+
+class IslandModel:
+    """Island mode of GeneticAlgorithm: sub-populations (islands) evolve in separate processes and every
+    migration_interval generations each island sends copies of its migrants_num best candidates to its neighbours.
+
+    In ring topology island i sends migrants to island i + 1, in full topology to all other islands. Migrants replace
+    the worst candidates of the receiving island with their known fitness. Each island has its own random streams
+    spawned from the seed and its own mutation_chance and similarity_to_single_parent.
+
+    Best fitness of all islands is kept in fitness_curve at each improvement as in GeneticAlgorithm, and snapshot_writer
+    of gen_alg is offered the best-so-far candidate after each migration round.
+
+    Islands are synchronized at migrations. Migration overhead is the real time of a migration round that is not spent
+    on evolution by the slowest island, i.e. on waiting, transfer of migrants and their reception. Islands also report
+    counters of their evaluation backends and fitness caches, which are summed up in evaluation_summary and
+    fitness_cache_summary, since the backend and the cache of gen_alg itself are not used.
+
+    If gen_alg has a stagnation_detector, each island has its own copy of it. The run is stopped after the round in
+    which any island is stopped by its detector, and stagnation_summary sums up actions of islands and generations they
+    have not performed.
+
+    """
+    def __init__(self, gen_alg: GeneticAlgorithm, islands_num: int, migration_interval: int, migrants_num: int,
+                 topology: str = RING_TOPOLOGY, seed: int = None):
+        assert islands_num >= 1, "islands_num must be positive"
+        assert migration_interval >= 1, "migration_interval must be positive"
+        assert migrants_num >= 1, "migrants_num must be positive"
+        assert topology in TOPOLOGIES, f"topology must be one of {TOPOLOGIES}"
+        self.gen_alg = gen_alg
+        self.islands_num = islands_num
+        self.migration_interval = migration_interval
+        self.migrants_num = migrants_num
+        self.topology = topology
+        self.seed_sequences = np.random.SeedSequence(seed).spawn(islands_num)
+        self.best_fitnesses = [None] * islands_num
+        self.fitness_curve = []
+        self.migration_overhead = 0
+        self.wall_time = 0
+        self.island_counters = [None] * islands_num
+        self.island_stagnations = [None] * islands_num
+        self.island_generations = [0] * islands_num
+        self.stagnation_seconds_saved = 0
+        self.iterations_num = None
+
+    @property
+    def summary(self) -> str:
+        """Returns best fitness of each island and migration overhead."""
+        return f"best fitness by islands {self.best_fitnesses}, migration overhead {self.migration_overhead:.3f} s " \
+               f"of {self.wall_time:.3f} s with {self.topology} topology"
+
+    @property
+    def evaluation_summary(self) -> str:
+        """Returns speedup of evaluation on all islands against serial evaluation together with number of workers and
+        cores (see EvaluationBackend.summary). Islands evaluate at the same time, so real time of evaluation is the mean
+        one of islands."""
+        backend = self.gen_alg.evaluation_backend
+        counters = [island_counters for island_counters in self.island_counters if island_counters is not None]
+        busy_time = sum(island_counters[0] for island_counters in counters)
+        wall_time = sum(island_counters[1] for island_counters in counters)
+        evaluations_num = sum(island_counters[2] for island_counters in counters)
+        speedup = busy_time * self.islands_num / wall_time if wall_time > 0 else 0
+        utilization = speedup / (self.islands_num * backend.workers_num)
+        return f"{speedup:.2f}x speedup over serial evaluation with {self.islands_num} islands of " \
+               f"{backend.workers_num} {backend.name} workers on {os.cpu_count()} cores, {utilization:.0%} worker " \
+               f"utilization, {evaluations_num} evaluations"
+
+    @property
+    def fitness_cache_summary(self) -> Optional[str]:
+        """Returns counters of fitness caches of all islands for the whole run or None if there is no cache."""
+        if self.gen_alg.fitness_cache is None:
+            return None
+        counters = [island_counters[3] for island_counters in self.island_counters if island_counters is not None]
+        hits, misses, evictions, duplicates = [sum(values) for values in zip(*counters)] if len(counters) > 0 \
+            else [0] * 4
+        return f"hits {hits}, misses {misses}, evictions {evictions}, duplicates {duplicates}"
+
+    @property
+    def stagnation_summary(self) -> Optional[str]:
+        """Returns number of stagnation actions of all islands and generations and time of time budget saved by early
+        stop, summed over islands, or None if there is no stagnation_detector."""
+        detector = self.gen_alg.stagnation_detector
+        if detector is None:
+            return None
+        actions_num = sum(island_stagnation[0] for island_stagnation in self.island_stagnations
+                          if island_stagnation is not None)
+        stopped = any(island_stagnation is not None and island_stagnation[1]
+                      for island_stagnation in self.island_stagnations)
+        generations_saved = sum(self.iterations_num - generations_num for generations_num in self.island_generations) \
+            if stopped and self.iterations_num is not None else 0
+        return f"{actions_num} {detector.action} actions on {self.islands_num} islands, {generations_saved} " \
+               f"generations and {self.stagnation_seconds_saved:.3f} s saved"
+
+    def neighbours(self, island: int) -> List[int]:
+        """Returns islands that receive migrants of the island."""
+        if self.topology == RING_TOPOLOGY:
+            return [(island + 1) % self.islands_num] if self.islands_num > 1 else []
+        return [neighbour for neighbour in range(self.islands_num) if neighbour != island]
+
+    def solve(self, generation_size: int, mutation_chances: Sequence[float], best_parents_num: int,
+              random_parents_num: int, similarities_to_single_parent: Sequence[float], target_fitness: float = None,
+              iterations_num: int = None, time_budget: float = None) -> (Composition, float):
+        """Return best accompaniment found by all islands and its fitness value.
+
+        generation_size is size of each island. mutation_chances and similarities_to_single_parent are given per
+        island. Islands evolve until each of them performs iterations_num generations, target fitness is obtained by
+        any island or time_budget seconds pass.
+
+        """
+        assert target_fitness is not None or iterations_num is not None or time_budget is not None
+        assert len(mutation_chances) == self.islands_num, "mutation_chance must be given for each island"
+        assert len(similarities_to_single_parent) == self.islands_num, \
+            "similarity_to_single_parent must be given for each island"
+        start_time = time.perf_counter()
+        deadline = start_time + time_budget if time_budget is not None else None
+        self.fitness_curve = []
+        self.iterations_num = iterations_num
+        connections = []
+        processes = []
+        for island in range(self.islands_num):
+            connection, island_connection = Pipe()
+            process = Process(target=_run_island, args=(
+                self.gen_alg, island_connection, self.seed_sequences[island],
+                dict(generation_size=generation_size, mutation_chance=mutation_chances[island],
+                     best_parents_num=best_parents_num, random_parents_num=random_parents_num,
+                     similarity_to_single_parent=similarities_to_single_parent[island],
+                     target_fitness=target_fitness)))
+            process.start()
+            connections.append(connection)
+            processes.append(process)
+        try:
+            with self.gen_alg.snapshot_writer or nullcontext():
+                best_candidate, best_fitness = self._migrate(connections, target_fitness, iterations_num, start_time,
+                                                             deadline)
+        finally:
+            for connection, process in zip(connections, processes):
+                if process.is_alive():
+                    connection.send(None)
+                process.join()
+        self.wall_time += time.perf_counter() - start_time
+        return best_candidate, best_fitness
+
+    def _migrate(self, connections: List[Connection], target_fitness: float, iterations_num: int, start_time: float,
+                 deadline: float) -> (Composition, float):
+        """Runs rounds of evolution and migration on started islands, returns best candidate and its fitness."""
+        best_candidate, best_fitness = None, None
+        inboxes = [[] for island in range(self.islands_num)]
+        iteration = 0
+        stopped = False
+        while not stopped and (target_fitness is None or best_fitness is None or best_fitness > target_fitness) and \
+              (iterations_num is None or iteration < iterations_num) and \
+              (deadline is None or time.perf_counter() < deadline):
+            generations_num = self.migration_interval if iterations_num is None else \
+                min(self.migration_interval, iterations_num - iteration)
+            round_start_time = time.perf_counter()
+            for connection, inbox in zip(connections, inboxes):
+                connection.send((generations_num, self.migrants_num, inbox, iteration,
+                                 deadline - round_start_time if deadline is not None else None))
+            replies = [connection.recv() for connection in connections]
+            round_time = time.perf_counter() - round_start_time
+            inboxes = [[] for island in range(self.islands_num)]
+            improved = False
+            for island, (migrants, (packed_candidate, fitness), iterations_done, evolution_time, counters,
+                         stagnation) in enumerate(replies):
+                self.island_counters[island] = counters
+                self.island_stagnations[island] = stagnation
+                self.island_generations[island] += iterations_done
+                stopped = stopped or stagnation is not None and stagnation[1]
+                for neighbour in self.neighbours(island):
+                    inboxes[neighbour] += migrants
+                self.best_fitnesses[island] = fitness
+                if best_fitness is None or fitness < best_fitness:
+                    best_candidate, best_fitness = packed_candidate, fitness
+                    improved = True
+            self.migration_overhead += round_time - max(reply[3] for reply in replies)
+            iteration += max(reply[2] for reply in replies)
+            if improved:
+                self.fitness_curve.append((time.perf_counter() - start_time, iteration, best_fitness))
+            if self.gen_alg.snapshot_writer is not None:
+                self.gen_alg.snapshot_writer.offer(iteration, _unpack(self.gen_alg, best_candidate), best_fitness)
+            log(f"Islands after {iteration} generations:\n\tBest fitness by islands:\t{self.best_fitnesses}",
+                INFO_LEVEL)
+            if stopped:
+                log(f"Islands stopped by stagnation after {iteration} generations", INFO_LEVEL)
+                if deadline is not None:
+                    self.stagnation_seconds_saved += max(0.0, deadline - time.perf_counter())
+        return _unpack(self.gen_alg, best_candidate), best_fitness
+
+
+def _pack(candidate: Union[Composition, Genome]) -> Union[bytes, Genome]:
+    return candidate.to_compact() if isinstance(candidate, Composition) else candidate
+
+
+def _unpack(gen_alg: GeneticAlgorithm, packed_candidate: Union[bytes, Genome]) -> Union[Composition, Genome]:
+    return gen_alg.melody_context.from_compact(packed_candidate) if isinstance(packed_candidate, bytes) \
+        else packed_candidate
+
+
+def _run_island(gen_alg: GeneticAlgorithm, connection: Connection, seed_sequence: np.random.SeedSequence,
+                params: Dict):
+    """Evolves island on requests (generations_num, migrants_num, migrants, first_iteration, time_budget) sent to the
+    connection until None is sent. Replies with best migrants_num (packed candidate, fitness) pairs of the last
+    generation, best-so-far (packed candidate, fitness), number of performed generations, time of evolution, counters
+    of the island (see _counters) and its (stagnation actions number, whether it is stopped) or None if there is no
+    stagnation_detector."""
+    random.seed(int(seed_sequence.generate_state(1)[0]))
+    # best-so-far candidates of islands are saved by the coordinator
+    gen_alg.snapshot_writer = None
+    if gen_alg.population_operators is not None:
+        gen_alg.population_operators.rng = np.random.default_rng(seed_sequence)
+    generation_size = params["generation_size"]
+    with gen_alg.evaluation_backend:
+        candidates_fitness = None
+        while True:
+            request = connection.recv()
+            if request is None:
+                break
+            generations_num, migrants_num, migrants, first_iteration, time_budget = request
+            start_time = time.perf_counter()
+            deadline = start_time + time_budget if time_budget is not None else None
+            if candidates_fitness is None:
+                candidates_fitness = gen_alg.evaluate(gen_alg.get_init_generation(generation_size))
+                gen_alg.record(0, candidates_fitness)
+            else:
+                candidates_fitness = _receive(gen_alg, candidates_fitness, migrants)
+                start_time = time.perf_counter()
+            candidates_fitness, iterations_done = gen_alg.evolve(
+                candidates_fitness, iterations_num=generations_num, first_iteration=first_iteration,
+                deadline=deadline, **params)
+            evolution_time = time.perf_counter() - start_time
+            best_candidates_fitness = heapq.nsmallest(migrants_num, candidates_fitness,
+                                                      key=lambda candidate_fitness: candidate_fitness[1])
+            connection.send(([(_pack(candidate), fitness) for candidate, fitness in best_candidates_fitness],
+                             (_pack(gen_alg.best_candidate), gen_alg.best_fitness), iterations_done, evolution_time,
+                             _counters(gen_alg), (gen_alg.stagnation_detector.actions_num,
+                                                  gen_alg.stagnation_detector.stopped)
+                             if gen_alg.stagnation_detector is not None else None))
+
+
+def _counters(gen_alg: GeneticAlgorithm) -> Tuple[float, float, int, Optional[Tuple[int, int, int, int]]]:
+    """Returns (busy time, wall time and number of evaluations of the evaluation backend, (hits, misses, evictions,
+    duplicates) of the fitness cache or None if there is no cache) for the whole run."""
+    backend = gen_alg.evaluation_backend
+    cache = gen_alg.fitness_cache
+    cache_counters = (cache.total_hits + cache.hits, cache.total_misses + cache.misses,
+                      cache.total_evictions + cache.evictions, cache.total_duplicates + cache.duplicates) \
+        if cache is not None else None
+    return backend.busy_time, backend.wall_time, backend.evaluations_num, cache_counters
+
+
+def _receive(gen_alg: GeneticAlgorithm, candidates_fitness: List[Tuple[Composition, float]],
+             migrants: List[Tuple[Union[bytes, Genome], float]]) -> List[Tuple[Composition, float]]:
+    """Returns candidates where the worst ones are replaced by migrants."""
+    if len(migrants) == 0:
+        return candidates_fitness
+    migrants = migrants[:len(candidates_fitness)]
+    return without_worst(candidates_fitness, len(migrants)) + \
+        [(_unpack(gen_alg, packed_candidate), fitness) for packed_candidate, fitness in migrants]
@@ -0,0 +1,168 @@
+import heapq
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from app_config import TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES, MAX_NOTE
+from genetic_algorithm.fitness_function.score_tables import EMPTY_STATE, STATES_NUM, STATE_SHAPES, STATE_LOWS, \
+    SHAPE_WIDTHS
+from genetic_algorithm.fitness_function.table_fitness_function import TableFitnessFunction
+from genetic_algorithm.genome import Genome, GENOME_DTYPE
+from genetic_algorithm.melody_context import NO_NOTE
+from music_interfaces.composition.composition_constants import PROGRESSION_LEN
+
+# states with all notes not above MAX_NOTE, as GA operators make them
+VALID_STATES = np.array([state for state in range(STATES_NUM) if state == EMPTY_STATE or
+                         STATE_LOWS[state] + SHAPE_WIDTHS[STATE_SHAPES[state]] <= MAX_NOTE])
+
+
+class LocalSearch:
+    """Memetic step of genetic algorithm: greedy per-beat improvement of the best genomes of a generation.
+
+    Every interval generations each of elite_num best genomes gets a pass over its beats, or over worst_beats_num beats
+    with the largest beat-local award if given. At each beat every valid chord state is tried, and the one that lowers
+    fitness the most is kept. Fitness change of all states at a beat is found at once from ScoreTables of
+    fitness_function: beat-local award, chord drops to the neighbour chords, accompaniment range and progression
+    windows. If the tables do not give progression awards by window (see ScoreTables.window_scores), fitness of all
+    states at a beat is evaluated by fitness_function.batch.
+
+    """
+    def __init__(self, fitness_function: TableFitnessFunction, interval: int, elite_num: int,
+                 worst_beats_num: int = None):
+        assert interval >= 1, "interval must be positive"
+        assert elite_num >= 1, "elite_num must be positive"
+        assert worst_beats_num is None or worst_beats_num >= 1, "worst_beats_num must be positive"
+        self.fitness_function = fitness_function
+        self.tables = fitness_function.tables
+        self.melody = fitness_function.melody
+        self.interval = interval
+        self.elite_num = elite_num
+        self.worst_beats_num = worst_beats_num
+        self.passes_num = 0
+        self.changes_num = 0
+        self.fitness_gain = 0
+        self.time = 0
+
+    @property
+    def summary(self) -> str:
+        """Returns number of passes and kept changes, total fitness gain and time spent."""
+        return f"{self.passes_num} passes, {self.changes_num} changes, fitness gain {self.fitness_gain}, " \
+               f"{self.time:.3f} s"
+
+    def improve(self, generation: int, candidates_fitness: List[Tuple[Genome, float]]) -> List[Tuple[Genome, float]]:
+        """Returns evaluated generation with improved best genomes if local search is due at the generation."""
+        if generation % self.interval != 0:
+            return candidates_fitness
+        start_time = time.perf_counter()
+        improved = {}
+        candidates_fitness = list(candidates_fitness)
+        best_indices = heapq.nsmallest(self.elite_num, range(len(candidates_fitness)),
+                                       key=lambda i: candidates_fitness[i][1])
+        for i in best_indices:
+            genome, fitness = candidates_fitness[i]
+            # generations often repeat the best genomes
+            key = genome.key
+            if key not in improved:
+                improved[key] = self.improve_genome(genome, fitness)
+            candidates_fitness[i] = improved[key]
+        self.time += time.perf_counter() - start_time
+        return candidates_fitness
+
+    def improve_genome(self, genome: Genome, fitness: float) -> Tuple[Genome, float]:
+        """Returns genome after greedy pass over its beats and its fitness."""
+        self.passes_num += 1
+        states = genome.states.astype(np.int64)
+        for beat in self._pass_beats(states):
+            deltas = self.beat_deltas(states, beat, fitness)
+            best = int(np.argmin(deltas))
+            if deltas[best] < 0:
+                states[beat] = VALID_STATES[best]
+                fitness += float(deltas[best])
+                self.fitness_gain -= float(deltas[best])
+                self.changes_num += 1
+        return Genome(states.astype(GENOME_DTYPE)), fitness
+
+    def beat_deltas(self, states: np.ndarray, beat: int, fitness: float) -> np.ndarray:
+        """Returns change of fitness of the genome states for each of VALID_STATES placed at the beat. Changes that
+        leave accompaniment without chords are infinite."""
+        tables = self.tables
+        fitness_function = self.fitness_function
+        current_state = states[beat]
+        # current state goes first, so differences are taken against it
+        alternatives = np.concatenate([[current_state], VALID_STATES])
+        exists = states != EMPTY_STATE
+        others = exists.copy()
+        others[beat] = False
+        others_num = int(others.sum())
+        alternative_exists = alternatives != EMPTY_STATE
+        if tables.window_scores is None:
+            candidates = np.repeat(states[None, :], len(VALID_STATES), axis=0)
+            candidates[:, beat] = VALID_STATES
+            deltas = fitness_function.batch(self.melody, [Genome(candidate) for candidate in candidates]) - fitness
+            return np.where(alternative_exists[1:] | (others_num > 0), deltas, np.inf)
+        alternative_lows = STATE_LOWS[alternatives]
+
+        scores = np.zeros(len(alternatives))
+        if beat < tables.beats_num:
+            scores += tables.local_scores[beat, alternatives]
+
+        chord_beats = np.nonzero(others)[0]
+        prev_beats = chord_beats[chord_beats < beat]
+        next_beats = chord_beats[chord_beats > beat]
+        prev_state = states[prev_beats[-1]] if len(prev_beats) > 0 else None
+        next_state = states[next_beats[0]] if len(next_beats) > 0 else None
+        # empty state is replaced by any chord, its drops are not counted
+        chord_alternatives = np.where(alternative_exists, alternatives, 0)
+        drops = np.zeros(len(alternatives))
+        if prev_state is not None:
+            drops += self._drops(np.full(len(alternatives), prev_state), chord_alternatives)
+        if next_state is not None:
+            drops += self._drops(chord_alternatives, np.full(len(alternatives), next_state))
+        drops = np.where(alternative_exists, drops, 0)
+        if prev_state is not None and next_state is not None:
+            drops = np.where(alternative_exists, drops, self._drops(np.array([prev_state]), np.array([next_state])))
+        scores += fitness_function.drop_weight * drops
+
+        others_lows = STATE_LOWS[states[others]]
+        chords_num = others_num + alternative_exists
+        low_notes_median = (others_lows.sum() + np.where(alternative_exists, alternative_lows, 0)) / \
+            np.maximum(chords_num, 1)
+        half_range = TOO_WIDE_ACCOMPANIMENT_RANGE_IN_NOTES / 2
+        too_wide_num = (np.abs(others_lows[None, :] - low_notes_median[:, None]) > half_range).sum(axis=1) + \
+            (alternative_exists & (np.abs(alternative_lows - low_notes_median) > half_range))
+        scores += fitness_function.wide_weight * too_wide_num
+
+        last_chord_beat = np.maximum(chord_beats[-1] if len(chord_beats) > 0 else NO_NOTE,
+                                     np.where(alternative_exists, beat, NO_NOTE))
+        ticks_per_beat = self.melody.ticks_per_beat
+        durations = np.where(last_chord_beat != NO_NOTE, (last_chord_beat + 1) * ticks_per_beat, 0)
+        if self.melody.min_duration is not None:
+            durations = np.maximum(durations, self.melody.min_duration)
+        # windows of triad_names_by_beats (see Genome.triads_len), the last one may end after the last beat
+        considered_num = (durations // ticks_per_beat + 1) // PROGRESSION_LEN
+        windows_num = int(considered_num.max())
+        first_states = np.full(windows_num, EMPTY_STATE)
+        states_windows_num = min(windows_num, (len(states) - 1) // PROGRESSION_LEN + 1)
+        first_states[:states_windows_num] = states[:states_windows_num * PROGRESSION_LEN:PROGRESSION_LEN]
+        window_scores = tables.window_scores[first_states]
+        scores += np.concatenate([[0], np.cumsum(window_scores)])[considered_num]
+        if beat % PROGRESSION_LEN == 0 and beat // PROGRESSION_LEN < windows_num:
+            window = beat // PROGRESSION_LEN
+            scores += (window < considered_num) * (tables.window_scores[alternatives] - window_scores[window])
+
+        deltas = scores[1:] - scores[0]
+        return np.where(chords_num[1:] > 0, deltas, np.inf)
+
+    def _drops(self, prev_states: np.ndarray, next_states: np.ndarray) -> np.ndarray:
+        """Returns whether there is too big chord drop between the states, states must be chords."""
+        return self.tables.drop_table[STATE_SHAPES[prev_states], STATE_SHAPES[next_states],
+                                      STATE_LOWS[next_states] - STATE_LOWS[prev_states] + MAX_NOTE]
+
+    def _pass_beats(self, states: np.ndarray) -> List[int]:
+        """Returns beats to improve: all beats or beats with the largest beat-local award."""
+        if self.worst_beats_num is None:
+            return list(range(len(states)))
+        beats_num = min(len(states), self.tables.beats_num)
+        local_scores = self.tables.local_scores[np.arange(beats_num), states[:beats_num]]
+        return sorted(np.argsort(-local_scores, kind="stable")[:self.worst_beats_num].tolist())
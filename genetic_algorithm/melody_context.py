@@ -0,0 +1,153 @@
+from types import MappingProxyType
+from typing import FrozenSet, Tuple, Union
+
+import numpy as np
+
+from app_config import ALLOWED_ACCOMP_TRIADS_FOR_MELODY_TONIC, KEY_DETECTION, KEY_WINDOW_BEATS
+from music_interfaces.composition.chord_mask import NO_CHORD_CODE, chord_code, mask_layers
+from music_interfaces.composition.composition import Composition
+from music_interfaces.composition.composition_constants import LEGACY_KEY_DETECTION, GLOBAL_KEY_DETECTION, \
+    WINDOWED_KEY_DETECTION
+from music_interfaces.composition.key_analysis import estimate_key, key_index, key_name, pitch_class_histogram, \
+    windowed_keys
+
+NO_NOTE = -1
+
+
+class MelodyContext:
+    """Immutable analysis of a melody that is done once per run.
+
+    Fitness functions and GA operators accept MelodyContext in place of the melody Composition: it provides
+    ticks_per_beat, tempo, min_duration, duration, clone() and from_compact() of the melody. Per-beat arrays are
+    indexed by beat number and cover every beat that has melody notes. Melody buckets and allowed triads are also kept
+    as pitch class masks (see chord_mask). key is the key of the whole melody, beat_keys are keys at beats (see
+    key_analysis) that are the same key unless KEY_DETECTION is WINDOWED_KEY_DETECTION. Mappings are read-only and
+    arrays are not writeable, and the melody Composition itself is kept private.
+
+    """
+    def __init__(self, melody: Composition):
+        ticks_per_beat = melody.ticks_per_beat
+        notes_at = {time: tuple(sorted(notes, key=lambda note: note.note)) for time, notes in melody.notes_at.items()}
+        notes_by_buckets = {bucket_tick: tuple(notes) for bucket_tick, notes in melody.notes_by_buckets.items()}
+        duration = melody.duration
+        analysis_beats_num = max([round(duration / ticks_per_beat)] +
+                                 [time // ticks_per_beat + 1 for time in list(notes_at.keys()) +
+                                  list(notes_by_buckets.keys())])
+        lowest_notes = np.full(analysis_beats_num, NO_NOTE, dtype=np.int64)
+        for time, notes in notes_at.items():
+            if time % ticks_per_beat == 0:
+                lowest_notes[time // ticks_per_beat] = notes[0].note
+        bucket_pitch_classes = np.zeros((analysis_beats_num, 12), dtype=np.int64)
+        for bucket_tick, notes in notes_by_buckets.items():
+            for note in notes:
+                bucket_pitch_classes[bucket_tick // ticks_per_beat, note.note % 12] += 1
+        assert KEY_DETECTION in (LEGACY_KEY_DETECTION, GLOBAL_KEY_DETECTION, WINDOWED_KEY_DETECTION), \
+            f"unknown key detection {KEY_DETECTION}"
+        if KEY_DETECTION == LEGACY_KEY_DETECTION:
+            key_tonic, key_scale = melody.key
+        else:
+            key_tonic, key_scale = key_name(estimate_key(pitch_class_histogram(melody.pitches)))
+        key = key_index(key_tonic, key_scale)
+        if KEY_DETECTION == WINDOWED_KEY_DETECTION:
+            beat_keys = windowed_keys(bucket_pitch_classes, KEY_WINDOW_BEATS, key)
+        else:
+            beat_keys = np.full(analysis_beats_num, key, dtype=np.int64)
+        allowed_triads = _allowed_triads(key_tonic, key_scale)
+        key_allowed_triad_codes = {beat_key: _allowed_triad_codes(*key_name(beat_key))
+                                   for beat_key in set(beat_keys.tolist())}
+        key_allowed_triad_codes[key] = allowed_triad_codes = _allowed_triad_codes(key_tonic, key_scale)
+        onset_ticks = np.array(sorted(notes_at.keys()), dtype=np.int64)
+
+        self._set("_melody", melody.clone())
+        self._set("ticks_per_beat", ticks_per_beat)
+        self._set("tempo", melody.tempo)
+        self._set("min_duration", melody.min_duration)
+        self._set("duration", duration)
+        self._set("beats_num", round(duration / ticks_per_beat))
+        self._set("notes_at", MappingProxyType(notes_at))
+        self._set("notes_by_buckets", MappingProxyType(notes_by_buckets))
+        self._set("onset_ticks", _read_only(onset_ticks))
+        self._set("out_of_beats_onsets_num", int(np.count_nonzero(onset_ticks % ticks_per_beat)))
+        self._set("lowest_notes", _read_only(lowest_notes))
+        self._set("bucket_pitch_classes", _read_only(bucket_pitch_classes))
+        self._set("bucket_sizes", _read_only(bucket_pitch_classes.sum(axis=1)))
+        self._set("bucket_mask_layers", tuple(mask_layers(counts) for counts in bucket_pitch_classes.tolist()))
+        self._set("pitch_class_sets", tuple(frozenset(np.nonzero(counts)[0].tolist())
+                                            for counts in bucket_pitch_classes))
+        self._set("key", (key_tonic, key_scale))
+        self._set("allowed_triads", allowed_triads)
+        self._set("allowed_triad_codes", allowed_triad_codes)
+        self._set("beat_keys", _read_only(beat_keys))
+        self._set("key_allowed_triad_codes", MappingProxyType(key_allowed_triad_codes))
+        self._set("beat_allowed_triad_codes", tuple(key_allowed_triad_codes[beat_key]
+                                                       for beat_key in beat_keys.tolist()))
+
+    @staticmethod
+    def of(melody: Union[Composition, "MelodyContext"]) -> "MelodyContext":
+        """Returns the melody if it is MelodyContext already, otherwise analysis of the melody."""
+        return melody if isinstance(melody, MelodyContext) else MelodyContext(melody)
+
+    def clone(self) -> Composition:
+        """Returns copy of the melody Composition."""
+        return self._melody.clone()
+
+    def from_compact(self, packed_notes: bytes) -> Composition:
+        """Returns Composition with melody metadata and notes unpacked from Composition.to_compact result."""
+        return self._melody.from_compact(packed_notes)
+
+    def beat_arrays(self, beats_num: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (lowest_notes, bucket_pitch_classes) cut or padded to beats_num beats."""
+        lowest_notes = np.full(beats_num, NO_NOTE, dtype=np.int64)
+        bucket_pitch_classes = np.zeros((beats_num, 12), dtype=np.int64)
+        shared_beats_num = min(beats_num, len(self.lowest_notes))
+        lowest_notes[:shared_beats_num] = self.lowest_notes[:shared_beats_num]
+        bucket_pitch_classes[:shared_beats_num] = self.bucket_pitch_classes[:shared_beats_num]
+        return lowest_notes, bucket_pitch_classes
+
+    def keys_at_beats(self, beats_num: int) -> np.ndarray:
+        """Returns beat_keys cut or padded with the key of the melody to beats_num beats."""
+        keys = np.full(beats_num, key_index(*self.key), dtype=np.int64)
+        shared_beats_num = min(beats_num, len(self.beat_keys))
+        keys[:shared_beats_num] = self.beat_keys[:shared_beats_num]
+        return keys
+
+    def allowed_triad_codes_at(self, beat: int) -> FrozenSet[int]:
+        """Returns codes of triads allowed in the key at the beat."""
+        return self.beat_allowed_triad_codes[beat] if beat < len(self.beat_allowed_triad_codes) else \
+            self.allowed_triad_codes
+
+    def __getstate__(self):
+        # mapping proxies can not be pickled, they are restored by __setstate__
+        return {name: dict(value) if isinstance(value, MappingProxyType) else value
+                for name, value in self.__dict__.items()}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            self._set(name, MappingProxyType(value) if isinstance(value, dict) else value)
+
+    def _set(self, name: str, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value):
+        raise AttributeError("MelodyContext is immutable")
+
+
+def _allowed_triads(key_tonic: int, key_scale: str) -> Tuple[Tuple[int, ...], ...]:
+    """Returns triads of ALLOWED_ACCOMP_TRIADS_FOR_MELODY_TONIC in the key, moved to the lowest octave."""
+    allowed_triads = []
+    for triad in ALLOWED_ACCOMP_TRIADS_FOR_MELODY_TONIC[key_scale]:
+        octave_shift = ((key_tonic + triad[0]) // 12) * 12
+        allowed_triads.append(tuple(key_tonic + note - octave_shift for note in triad))
+    return tuple(allowed_triads)
+
+
+def _allowed_triad_codes(key_tonic: int, key_scale: str) -> FrozenSet[int]:
+    """Returns codes of allowed triads in the key."""
+    allowed_triad_codes = frozenset(chord_code(triad) for triad in _allowed_triads(key_tonic, key_scale))
+    assert NO_CHORD_CODE not in allowed_triad_codes, "allowed triads must be in close position"
+    return allowed_triad_codes
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    array.flags.writeable = False
+    return array
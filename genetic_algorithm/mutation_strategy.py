@@ -1,18 +1,25 @@
 import random
-from typing import List, Union
+from typing import List, Sequence, Union
 
-from app_config import MAX_MUTATION_SHIFT, MAX_NOTE
+import numpy as np
+
+from app_config import MAX_MUTATION_SHIFT, MAX_NOTE, TARGETED_MUTATION_BASE_SHARE
+from genetic_algorithm.fitness_function.fitness_function import calculate_metrics, beat_penalties
+from genetic_algorithm.fitness_function.score_tables import CHORD_SHAPES, SHAPE_WIDTHS, LOWS_NUM, EMPTY_STATE
+from genetic_algorithm.genome import Genome, GENOME_DTYPE
+from genetic_algorithm.melody_context import MelodyContext
 from music_interfaces.composition.composition import Composition
-from music_interfaces.composition.composition_constants import MAJOR_TRIAD, MINOR_TRIAD, MAJOR_TRIAD_1I, \
-    MAJOR_TRIAD_2I, MINOR_TRIAD_1I, MINOR_TRIAD_2I, DIMINISHED_CHORD, SUS2_CHORD, SUS4_CHORD, EMPTY_CHORD
+from music_interfaces.composition.composition_constants import ACCOMPANIMENT_CHORDS
 from music_interfaces.note import CompositionNote
 
+UNIFORM_TARGETING = "uniform"
+PENALTY_TARGETING = "penalty"
+TARGETINGS = [UNIFORM_TARGETING, PENALTY_TARGETING]
+
 
 def get_random_chord() -> List[int]:
     """Return randomly chosen triad chord as list of offsets from first note."""
-    chords = [MAJOR_TRIAD, MINOR_TRIAD, MAJOR_TRIAD_1I, MAJOR_TRIAD_2I, MINOR_TRIAD_1I, MINOR_TRIAD_2I,
-              DIMINISHED_CHORD, SUS2_CHORD, SUS4_CHORD, EMPTY_CHORD]
-    return random.choice(chords)
+    return random.choice(ACCOMPANIMENT_CHORDS)
 
 
 def get_random_absolute_chord() -> List[int]:
@@ -34,7 +41,7 @@ def _get_random_chord_position(chord: Union[List[CompositionNote], List[int]]) -
     return random_position
 
 
-def get_random_candidate(melody: Composition) -> Composition:
+def get_random_candidate(melody: Union[Composition, MelodyContext]) -> Composition:
     """Returns Composition of random chords placed at each beat in random keys."""
     chord_duration = melody.ticks_per_beat
     duration_in_chords = round(melody.duration / chord_duration)
@@ -46,24 +53,81 @@ def get_random_candidate(melody: Composition) -> Composition:
     return candidate
 
 
-def make_mutation(candidate: Composition, mutation_chance: float) -> Composition:
-    """Return mutated Composition. Chord at each beat is mutated with given probability."""
+def get_random_genome(melody: Union[Composition, MelodyContext]) -> Genome:
+    """Returns Genome of random chords placed at each beat in random keys, as get_random_candidate does."""
+    states = []
+    for i in range(round(melody.duration / melody.ticks_per_beat)):
+        shape = random.choice(_ACCOMPANIMENT_SHAPES)
+        states.append(shape * LOWS_NUM + random.randrange(0, MAX_NOTE - _SHAPE_WIDTHS[shape] + 1)
+                      if shape is not None else EMPTY_STATE)
+    return Genome(np.array(states, dtype=GENOME_DTYPE))
+
+
+def make_mutation(candidate: Composition, mutation_chance: float, beat_chances: Sequence[float] = None) \
+        -> Composition:
+    """Return mutated Composition. Chord at each beat is mutated with given probability, or with its probability of
+    beat_chances if they are given.
+
+    Notes of other beats are copied from columns of the candidate by slices, and Composition without mutated beats
+    shares columns with the candidate. Mutated Composition keeps fitness_state of the candidate, and mutated beats are
+    added to its dirty_beats.
+
+    """
     assert 0 <= mutation_chance <= 1, "mutation_chance must belong to [0:1] interval"
     chord_duration = candidate.ticks_per_beat
     duration_in_chords = round(candidate.duration / chord_duration)
-    c_notes_at = candidate.notes_at
-    notes = []
+    ordered, offsets = candidate.at_beats(duration_in_chords)
+    chords = {}
     for i in range(duration_in_chords):
-        time = i * chord_duration
-        if random.random() < mutation_chance:
-            c_notes_at[time] = c_notes_at.get(time, [])
-            c_notes_at[time] = mutate_chord(c_notes_at[time], start_time=time, duration=chord_duration)
-        notes += c_notes_at.get(time, [])
-    mutated_candidate = candidate.clone()
-    mutated_candidate.notes = notes
+        if random.random() < (beat_chances[i] if beat_chances is not None else mutation_chance):
+            chords[i] = mutate_chord(ordered.notes_slice(offsets[i], offsets[i + 1]), start_time=i * chord_duration,
+                                     duration=chord_duration)
+    mutated_candidate = ordered.replace_beats(chords, offsets) if len(chords) > 0 else ordered.clone()
+    if candidate.fitness_state is not None and candidate.dirty_beats is not None:
+        mutated_candidate.fitness_state = candidate.fitness_state
+        mutated_candidate.dirty_beats = candidate.dirty_beats | set(chords)
     return mutated_candidate
 
 
+class TargetedMutation:
+    """Mutation strategy that mutates chords at beats with larger penalties more often.
+
+    Penalties of beats are found by calculate_metrics and beat_penalties, and mutation chances of beats are given by
+    targeted_chances, so the expected number of mutated beats is the same as in make_mutation.
+
+    """
+    def __init__(self, melody: Union[Composition, MelodyContext], base_share: float = TARGETED_MUTATION_BASE_SHARE):
+        assert 0 <= base_share <= 1, "base_share must belong to [0:1] interval"
+        self.melody = MelodyContext.of(melody)
+        self.base_share = base_share
+
+    def __call__(self, candidate: Composition, mutation_chance: float) -> Composition:
+        beat_metrics = {}
+        calculate_metrics(self.melody, candidate, beat_metrics)
+        penalties = np.zeros(round(candidate.duration / candidate.ticks_per_beat))
+        for beat, penalty in beat_penalties(beat_metrics).items():
+            if beat < len(penalties):
+                penalties[beat] = penalty
+        return make_mutation(candidate, mutation_chance,
+                             beat_chances=targeted_chances(penalties, mutation_chance, self.base_share).tolist())
+
+
+def targeted_chances(penalties: np.ndarray, mutation_chance: float, base_share: float = TARGETED_MUTATION_BASE_SHARE) \
+        -> np.ndarray:
+    """Returns mutation chances of beats given penalties of beats (... x beats).
+
+    base_share of mutation_chance is given to all beats, and the rest is shared by beats in proportion to their
+    penalties, so the mean chance stays mutation_chance unless chances of the worst beats reach 1. Beats of candidates
+    without penalties get mutation_chance.
+
+    """
+    penalties = np.maximum(penalties, 0)
+    beats_num = penalties.shape[-1]
+    totals = penalties.sum(axis=-1, keepdims=True)
+    shares = np.divide(penalties * beats_num, totals, out=np.ones_like(penalties, dtype=float), where=totals > 0)
+    return np.minimum(mutation_chance * (base_share + (1 - base_share) * shares), 1)
+
+
 def mutate_chord(chord: List[CompositionNote], **context) -> List[CompositionNote]:
     """Return mutated chord. Apply random mutation on chord from [shift chord, teleport chord, replace chord]."""
     actions = [_randomly_shift_chord, _randomly_teleport_chord, _replace_chord_type_by_random]
@@ -107,3 +171,41 @@ def _replace_chord_type_by_random(chord: List[CompositionNote], **context) -> Li
     replaced_chord = [CompositionNote(note=chord_lowest_note + note + shift, start_time=start_time, duration=duration)
                       for note in random_chord]
     return replaced_chord
+
+
+def make_genome_mutation(candidate: Genome, mutation_chance: float) -> Genome:
+    """Return mutated Genome. Chord at each beat is mutated with given probability as make_mutation does."""
+    assert 0 <= mutation_chance <= 1, "mutation_chance must belong to [0:1] interval"
+    mutated_candidate = candidate.clone()
+    states = mutated_candidate.states
+    for i in range(len(states)):
+        if random.random() < mutation_chance:
+            states[i] = mutate_state(int(states[i]))
+    return mutated_candidate
+
+
+def mutate_state(state: int) -> int:
+    """Returns mutated chord state. Apply random mutation on state from [shift chord, lift chord, replace chord]."""
+    shape, low = divmod(state, LOWS_NUM) if state != EMPTY_STATE else (None, 0)
+    action = random.randrange(3)
+    if action == 2:
+        # replace chord type keeping the lowest note, chord is moved down if it does not fit
+        new_shape = random.choice(_ACCOMPANIMENT_SHAPES)
+        if new_shape is None:
+            return EMPTY_STATE
+        return new_shape * LOWS_NUM + min(low, MAX_NOTE - _SHAPE_WIDTHS[new_shape])
+    if shape is None:
+        return EMPTY_STATE
+    width = _SHAPE_WIDTHS[shape]
+    if action == 0:
+        shift = random.randrange(max(0, low - MAX_MUTATION_SHIFT) - low,
+                                 min(MAX_NOTE, low + width + MAX_MUTATION_SHIFT) - (low + width) + 1)
+    else:
+        # _randomly_teleport_chord adds random position to the notes of the chord
+        shift = random.randrange(0, MAX_NOTE - (low + width) + 1)
+    return shape * LOWS_NUM + low + shift
+
+
+# ACCOMPANIMENT_CHORDS as shape ids of genome states, None for empty chord
+_ACCOMPANIMENT_SHAPES = [CHORD_SHAPES.index(chord) if len(chord) > 0 else None for chord in ACCOMPANIMENT_CHORDS]
+_SHAPE_WIDTHS = SHAPE_WIDTHS.tolist()
@@ -0,0 +1,104 @@
+from typing import Callable, List, Union
+
+import numpy as np
+
+from app_config import MAX_MUTATION_SHIFT, MAX_NOTE
+from genetic_algorithm.fitness_function.score_tables import CHORD_SHAPES, SHAPE_WIDTHS, LOWS_NUM, EMPTY_STATE
+from genetic_algorithm.genome import Genome, GENOME_DTYPE
+from genetic_algorithm.melody_context import MelodyContext
+from genetic_algorithm.mutation_strategy import targeted_chances
+from music_interfaces.composition.composition import Composition
+from music_interfaces.composition.composition_constants import ACCOMPANIMENT_CHORDS
+
+# ACCOMPANIMENT_CHORDS as shape ids of genome states, NO_SHAPE for empty chord
+NO_SHAPE = -1
+ACCOMPANIMENT_SHAPES = np.array([CHORD_SHAPES.index(chord) if len(chord) > 0 else NO_SHAPE
+                                 for chord in ACCOMPANIMENT_CHORDS])
+# widths of shapes with width of empty chord at index NO_SHAPE
+SHAPE_WIDTHS_WITH_EMPTY = np.append(SHAPE_WIDTHS, 0)
+
+
+class PopulationOperators:
+    """Generation-wide GA operators on genomes: all random decisions of a generation are drawn at once from NumPy
+    Generator.
+
+    Operators follow get_random_genome, make_genome_crossover and make_genome_mutation. Mutation sites of the whole
+    generation are sampled by a binomial draw of their number instead of a coin flip per beat, and uniform crossover
+    uses a boolean mask over all children. Runs with the same seed of the Generator are reproducible.
+
+    If beat_penalties (e.g. TableFitnessFunction.beat_penalties) are given, mutation is targeted as in
+    TargetedMutation: each state is mutated with its chance given by targeted_chances.
+
+    """
+    def __init__(self, melody: Union[Composition, MelodyContext], rng: np.random.Generator = None,
+                 beat_penalties: Callable[[np.ndarray], np.ndarray] = None):
+        self.beats_num = round(melody.duration / melody.ticks_per_beat)
+        self.rng = rng or np.random.default_rng()
+        self.beat_penalties = beat_penalties
+
+    def init_generation(self, candidates_num: int) -> List[Genome]:
+        """Returns genomes of random chords placed at each beat in random keys."""
+        shapes = ACCOMPANIMENT_SHAPES[self.rng.integers(len(ACCOMPANIMENT_SHAPES),
+                                                        size=(candidates_num, self.beats_num))]
+        lows = self.rng.integers(0, MAX_NOTE - SHAPE_WIDTHS_WITH_EMPTY[shapes] + 1)
+        return self._to_genomes(np.where(shapes != NO_SHAPE, shapes * LOWS_NUM + lows, EMPTY_STATE))
+
+    def next_generation(self, parents: List[Genome], generation_size: int, similarity_to_single_parent: float,
+                        mutation_chance: float) -> List[Genome]:
+        """Returns mutated children of uniform crossover of random pairs of different parents."""
+        assert len(parents) >= 2, "at least two parents should be provided to make crossover"
+        assert 0 <= mutation_chance <= 1, "mutation_chance must belong to [0:1] interval"
+        parents_states = np.stack([parent.states for parent in parents])
+        pairs_num = -(-generation_size // 2)
+        first_parents = self.rng.integers(len(parents), size=pairs_num)
+        second_parents = (first_parents + self.rng.integers(1, len(parents), size=pairs_num)) % len(parents)
+        swapped = self.rng.random((pairs_num, self.beats_num)) > similarity_to_single_parent
+        first_states = parents_states[first_parents]
+        second_states = parents_states[second_parents]
+        # children of a pair follow each other, as in GeneticAlgorithm.get_next_generation
+        children = np.stack([np.where(swapped, second_states, first_states),
+                             np.where(swapped, first_states, second_states)], axis=1)
+        children = children.reshape(2 * pairs_num, self.beats_num)[:generation_size]
+        return self._to_genomes(self.mutate(children, mutation_chance))
+
+    def mutate(self, states: np.ndarray, mutation_chance: float) -> np.ndarray:
+        """Returns mutated chord states of the generation (candidates x beats). Each state is mutated with given
+        probability, or with its targeted chance if beat_penalties are given."""
+        sites = self._mutation_sites(states, mutation_chance)
+        sites_num = len(sites)
+        if sites_num == 0:
+            return states
+        flat_states = states.flatten()
+        site_states = flat_states[sites].astype(np.int64)
+        is_empty = site_states == EMPTY_STATE
+        shapes = np.where(is_empty, NO_SHAPE, site_states // LOWS_NUM)
+        lows = np.where(is_empty, 0, site_states % LOWS_NUM)
+        highs = lows + SHAPE_WIDTHS_WITH_EMPTY[shapes]
+        actions = self.rng.integers(3, size=sites_num)
+        # shift chord by limited amount
+        shifts = self.rng.integers(np.maximum(0, lows - MAX_MUTATION_SHIFT) - lows,
+                                   np.minimum(MAX_NOTE, highs + MAX_MUTATION_SHIFT) - highs + 1)
+        # lift chord by unlimited amount, as _randomly_teleport_chord does for chords of notes
+        lifts = self.rng.integers(0, MAX_NOTE - highs + 1)
+        moved_states = shapes * LOWS_NUM + lows + np.where(actions == 0, shifts, lifts)
+        # replace chord type keeping the lowest note, chord is moved down if it does not fit
+        new_shapes = ACCOMPANIMENT_SHAPES[self.rng.integers(len(ACCOMPANIMENT_SHAPES), size=sites_num)]
+        replaced_states = np.where(new_shapes != NO_SHAPE, new_shapes * LOWS_NUM +
+                                   np.minimum(lows, MAX_NOTE - SHAPE_WIDTHS_WITH_EMPTY[new_shapes]), EMPTY_STATE)
+        flat_states[sites] = np.where(actions == 2, replaced_states, np.where(is_empty, EMPTY_STATE, moved_states))
+        return flat_states.reshape(states.shape)
+
+    def _mutation_sites(self, states: np.ndarray, mutation_chance: float) -> np.ndarray:
+        """Returns flat indices of mutated states of the generation."""
+        if self.beat_penalties is not None:
+            return np.flatnonzero(self.rng.random(states.shape) <
+                                  targeted_chances(self.beat_penalties(states), mutation_chance))
+        sites_num = self.rng.binomial(states.size, mutation_chance)
+        if sites_num == 0:
+            return np.empty(0, dtype=np.int64)
+        return self.rng.choice(states.size, size=sites_num, replace=False)
+
+    @staticmethod
+    def _to_genomes(states: np.ndarray) -> List[Genome]:
+        states = states.astype(GENOME_DTYPE)
+        return [Genome(candidate_states) for candidate_states in states]
@@ -0,0 +1,62 @@
+import heapq
+import random
+from typing import List, Tuple, Union
+
+from app_config import TOURNAMENT_SIZE
+from genetic_algorithm.genome import Genome
+from music_interfaces.composition.composition import Composition
+
+TRUNCATION_SELECTION = "truncation"
+TOURNAMENT_SELECTION = "tournament"
+RANK_SELECTION = "rank"
+
+
+def select_truncation(candidates_fitness: List[Tuple[Union[Composition, Genome], float]], best_parents_num: int,
+                      random_parents_num: int) -> List[Tuple[Union[Composition, Genome], float]]:
+    """Returns best_parents_num best candidates and random_parents_num random other candidates.
+
+    The best candidates are found by partial selection, so candidates need not be sorted. For sorted candidates the
+    parents are the same as the first best_parents_num candidates and a random sample of the rest.
+
+    """
+    best_indices = heapq.nsmallest(best_parents_num, range(len(candidates_fitness)),
+                                   key=lambda i: candidates_fitness[i][1])
+    best_indices_set = set(best_indices)
+    others = [candidate_fitness for i, candidate_fitness in enumerate(candidates_fitness) if i not in best_indices_set]
+    return [candidates_fitness[i] for i in best_indices] + random.sample(others, random_parents_num)
+
+
+def select_tournament(candidates_fitness: List[Tuple[Union[Composition, Genome], float]], best_parents_num: int,
+                      random_parents_num: int, tournament_size: int = TOURNAMENT_SIZE) \
+        -> List[Tuple[Union[Composition, Genome], float]]:
+    """Returns best_parents_num + random_parents_num different parents, each of them is the best of tournament_size
+    random candidates that are not parents yet."""
+    assert tournament_size >= 1, "tournament_size must be positive"
+    remaining = list(range(len(candidates_fitness)))
+    parents = []
+    for i in range(best_parents_num + random_parents_num):
+        contestants = random.sample(range(len(remaining)), min(tournament_size, len(remaining)))
+        winner = min(contestants, key=lambda contestant: candidates_fitness[remaining[contestant]][1])
+        parents.append(candidates_fitness[remaining[winner]])
+        # winner is removed in constant time, order of remaining candidates does not matter
+        remaining[winner] = remaining[-1]
+        remaining.pop()
+    return parents
+
+
+def select_rank(candidates_fitness: List[Tuple[Union[Composition, Genome], float]], best_parents_num: int,
+                random_parents_num: int) -> List[Tuple[Union[Composition, Genome], float]]:
+    """Returns best_parents_num + random_parents_num different parents drawn with probability proportional to
+    linear rank weight: n for the best of n candidates and 1 for the worst one."""
+    order = sorted(range(len(candidates_fitness)), key=lambda i: candidates_fitness[i][1])
+    # weighted sampling without replacement: the largest random() ** (1 / weight) values are taken
+    keys = [random.random() ** (1 / (len(order) - rank)) for rank in range(len(order))]
+    chosen_ranks = heapq.nlargest(best_parents_num + random_parents_num, range(len(order)), key=keys.__getitem__)
+    return [candidates_fitness[order[rank]] for rank in sorted(chosen_ranks)]
+
+
+SELECTION_STRATEGIES = {
+    TRUNCATION_SELECTION: select_truncation,
+    TOURNAMENT_SELECTION: select_tournament,
+    RANK_SELECTION: select_rank
+}
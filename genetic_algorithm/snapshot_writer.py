@@ -0,0 +1,95 @@
+import threading
+from typing import Callable, Union
+
+from genetic_algorithm.genome import Genome
+from logging.logging import log
+from logging.logging_constants import WARNING_LEVEL
+from music_interfaces.composition.composition import Composition
+
+
+class SnapshotWriter:
+    """Background thread that saves the best-so-far candidate while genetic algorithm runs.
+
+    Snapshot is taken when the best fitness has improved since the last snapshot, at every generation or, if
+    generations_interval is given, at every generations_interval-th generation. Only the latest snapshot waits for
+    saving, so evolution never waits for slow saving and outdated snapshots are skipped. Pending snapshot and the
+    best-so-far candidate are saved on close.
+
+    """
+    def __init__(self, save: Callable[[Union[Composition, Genome], float, int], None],
+                 generations_interval: int = None):
+        assert generations_interval is None or generations_interval >= 1, "generations_interval must be positive"
+        self.save = save
+        self.generations_interval = generations_interval
+        self.saved_num = 0
+        self.skipped_num = 0
+        self._saved_fitness = None
+        self._unsaved = None
+        self._pending = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @property
+    def summary(self) -> str:
+        """Returns number of saved and skipped snapshots."""
+        return f"{self.saved_num} saved, {self.skipped_num} skipped as outdated"
+
+    def start(self):
+        """Starts the writer thread."""
+        self._closed = False
+        self._saved_fitness = self._unsaved = self._pending = None
+        self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Saves pending snapshot and snapshot of the best-so-far candidate if it is not saved yet and stops the writer
+        thread."""
+        if self._unsaved is not None:
+            self._take(*self._unsaved)
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def offer(self, generation: int, best_candidate: Union[Composition, Genome], best_fitness: float):
+        """Takes snapshot of the best-so-far candidate after the generation if it is due. Does not wait for saving."""
+        if self._saved_fitness is not None and best_fitness >= self._saved_fitness:
+            return
+        self._unsaved = (best_candidate, best_fitness, generation)
+        if self.generations_interval is None or generation % self.generations_interval == 0:
+            self._take(best_candidate, best_fitness, generation)
+
+    def _take(self, best_candidate: Union[Composition, Genome], best_fitness: float, generation: int):
+        self._saved_fitness = best_fitness
+        self._unsaved = None
+        with self._condition:
+            if self._pending is not None:
+                self.skipped_num += 1
+            self._pending = (best_candidate, best_fitness, generation)
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                snapshot, self._pending = self._pending, None
+                closed = self._closed
+            if snapshot is not None:
+                try:
+                    self.save(*snapshot)
+                    self.saved_num += 1
+                except Exception as error:
+                    log(f"Snapshot of generation {snapshot[2]} was not saved: {error}", WARNING_LEVEL)
+            if closed and snapshot is None:
+                return
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,123 @@
+import math
+from collections import Counter
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from app_config import STAGNATION_MUTATION_FACTOR, STAGNATION_MAX_MUTATION_CHANCE, STAGNATION_RERANDOMIZED_SHARE
+from genetic_algorithm.genome import Genome
+from music_interfaces.composition.composition import Composition
+
+STOP_ACTION = "stop"
+RAMP_UP_ACTION = "ramp_up"
+RERANDOMIZE_ACTION = "rerandomize"
+ACTIONS = [STOP_ACTION, RAMP_UP_ACTION, RERANDOMIZE_ACTION]
+
+
+class StagnationDetector:
+    """Detects stagnation of genetic algorithm and chooses action against it.
+
+    Population stagnates if neither best nor mean fitness has improved for window generations or if its diversity (see
+    beat_diversity) is below min_diversity. On stagnation the run is stopped, mutation_chance is multiplied by
+    mutation_factor up to max_mutation_chance until the best fitness improves, or rerandomized_share of the worst
+    candidates are replaced by random ones. Window starts again after each action, and next action is not taken
+    earlier than window generations later.
+
+    """
+    def __init__(self, window: int, action: str = STOP_ACTION, min_diversity: float = None,
+                 mutation_factor: float = STAGNATION_MUTATION_FACTOR,
+                 max_mutation_chance: float = STAGNATION_MAX_MUTATION_CHANCE,
+                 rerandomized_share: float = STAGNATION_RERANDOMIZED_SHARE):
+        assert window >= 1, "window must be positive"
+        assert action in ACTIONS, f"action must be one of {ACTIONS}"
+        assert min_diversity is None or 0 <= min_diversity <= 1, "min_diversity must belong to [0:1] interval"
+        assert mutation_factor >= 1, "mutation_factor must not be less than 1"
+        assert 0 < rerandomized_share <= 1, "rerandomized_share must belong to (0:1] interval"
+        self.window = window
+        self.action = action
+        self.min_diversity = min_diversity
+        self.mutation_factor = mutation_factor
+        self.max_mutation_chance = max_mutation_chance
+        self.rerandomized_share = rerandomized_share
+        self.ramp_ups = 0
+        self.actions_num = 0
+        self.generations_saved = 0
+        self.seconds_saved = 0
+        self.stopped = False
+        self.diversity = None
+        self._best_fitness = None
+        self._mean_fitness = None
+        self._last_improvement = 0
+        self._last_action = None
+
+    @property
+    def summary(self) -> str:
+        """Returns number of actions taken and generations and time of time budget saved by early stop."""
+        summary = f"{self.actions_num} {self.action} actions, {self.generations_saved} generations and " \
+                  f"{self.seconds_saved:.3f} s saved"
+        return summary + (f", last diversity {self.diversity:.3f}" if self.diversity is not None else "")
+
+    def mutation_chance(self, mutation_chance: float) -> float:
+        """Returns mutation_chance ramped up against stagnation."""
+        if self.ramp_ups == 0:
+            return mutation_chance
+        return max(mutation_chance,
+                   min(self.max_mutation_chance, mutation_chance * self.mutation_factor ** self.ramp_ups))
+
+    def update(self, generation: int, candidates_fitness: List[Tuple[Union[Composition, Genome], float]]) \
+            -> Optional[str]:
+        """Returns action if the evaluated generation stagnates, otherwise None."""
+        best_fitness = min(fitness for candidate, fitness in candidates_fitness)
+        mean_fitness = sum([fitness for candidate, fitness in candidates_fitness]) / len(candidates_fitness)
+        if self._best_fitness is None or best_fitness < self._best_fitness:
+            self._best_fitness = best_fitness
+            self._last_improvement = generation
+            self.ramp_ups = 0
+        if self._mean_fitness is None or mean_fitness < self._mean_fitness:
+            self._mean_fitness = mean_fitness
+            self._last_improvement = generation
+        if self.min_diversity is not None:
+            self.diversity = beat_diversity([candidate for candidate, fitness in candidates_fitness])
+        if generation - self._last_improvement < self.window and \
+                (self.diversity is None or self.diversity >= self.min_diversity):
+            return None
+        if self._last_action is not None and generation - self._last_action < self.window:
+            return None
+        self._last_improvement = self._last_action = generation
+        self._mean_fitness = None
+        self.actions_num += 1
+        if self.action == RAMP_UP_ACTION:
+            self.ramp_ups += 1
+        if self.action == STOP_ACTION:
+            self.stopped = True
+        return self.action
+
+
+def beat_diversity(candidates: Sequence[Union[Composition, Genome]]) -> float:
+    """Returns mean entropy of chord distribution of candidates at each beat normalized to [0:1] interval.
+
+    Diversity is 0 if all candidates are equal and 1 if all chords at each beat are different.
+
+    """
+    if len(candidates) < 2:
+        return 0.0
+    if isinstance(candidates[0], Genome):
+        states = np.stack([candidate.states for candidate in candidates])
+        beat_counts = [np.unique(beat_states, return_counts=True)[1] for beat_states in states.T]
+    else:
+        beat_chords = {}
+        for candidate in candidates:
+            ticks_per_beat = candidate.ticks_per_beat
+            for time, notes in candidate.notes_at.items():
+                beat_chords.setdefault(time // ticks_per_beat, Counter())[tuple(sorted(note.note for note in notes))] \
+                    += 1
+        # candidates without chord at a beat share empty chord, beats without chords in all candidates are not listed
+        beat_counts = [list(chords.values()) + [len(candidates) - sum(chords.values())]
+                       for chords in beat_chords.values()]
+    beats_num = max(len(beat_counts), round(candidates[0].duration / candidates[0].ticks_per_beat)) \
+        if isinstance(candidates[0], Composition) else len(beat_counts)
+    if beats_num == 0:
+        return 0.0
+    entropies = [-sum([count / len(candidates) * math.log(count / len(candidates)) for count in counts if count > 0])
+                 for counts in beat_counts]
+    return sum(entropies) / beats_num / math.log(len(candidates))
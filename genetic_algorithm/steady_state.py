@@ -0,0 +1,145 @@
+import bisect
+import queue
+import time
+from contextlib import nullcontext
+from typing import List, Tuple, Union
+
+from genetic_algorithm.fitness_cache import FitnessCache
+from genetic_algorithm.genetic_algorithm import GeneticAlgorithm
+from genetic_algorithm.genome import Genome
+from logging.logging import log
+from logging.logging_constants import INFO_LEVEL
+from music_interfaces.composition.composition import Composition
+
+
+class SteadyStateGA:
+    """Steady-state mode of GeneticAlgorithm without a barrier between generations.
+
+    Population is kept sorted by fitness. Batches of batch_size children are bred from it by operators of gen_alg and
+    submitted to its evaluation_backend, at most batches_in_flight at once, so pool workers get a new batch as soon as
+    they return one. Each returned child replaces the worst member of the population if it is better and is not in the
+    population yet, and a new batch is bred right away. Children with cached fitness (see FitnessCache) are not
+    submitted.
+
+    Every generation_size evaluated children count as a generation for iterations_num, fitness_curve and snapshots of
+    gen_alg. local_search and stagnation_detector of gen_alg are not used.
+
+    """
+    def __init__(self, gen_alg: GeneticAlgorithm, batch_size: int, batches_in_flight: int = None):
+        assert batch_size >= 1, "batch_size must be positive"
+        assert batches_in_flight is None or batches_in_flight >= 1, "batches_in_flight must be positive"
+        self.gen_alg = gen_alg
+        self.batch_size = batch_size
+        # a batch waits in the pool queue for each busy worker
+        self.batches_in_flight = batches_in_flight or 2 * gen_alg.evaluation_backend.workers_num
+        self.replacements_num = 0
+        self.children_num = 0
+        self.wall_time = 0
+
+    @property
+    def summary(self) -> str:
+        """Returns number of children, share of them that replaced population members and throughput."""
+        throughput = self.children_num / self.wall_time if self.wall_time > 0 else 0
+        return f"{self.children_num} children in batches of {self.batch_size}, {self.replacements_num} replaced " \
+               f"population members, {throughput:.0f} children/s with {self.batches_in_flight} batches in flight"
+
+    def solve(self, generation_size: int, mutation_chance: float, best_parents_num: int, random_parents_num: int,
+              similarity_to_single_parent: float, target_fitness: float = None, iterations_num: int = None,
+              time_budget: float = None) -> (Union[Composition, Genome], float):
+        """Return best accompaniment found and its fitness value.
+
+        Population of generation_size candidates evolves until iterations_num * generation_size children are
+        evaluated, target fitness is obtained or time_budget seconds pass. Batches in flight at the stop are evaluated
+        and taken into account.
+
+        """
+        assert target_fitness is not None or iterations_num is not None or time_budget is not None
+        gen_alg = self.gen_alg
+        gen_alg.best_candidate, gen_alg.best_fitness, gen_alg.fitness_curve = None, None, []
+        gen_alg.start_time = time.perf_counter()
+        deadline = gen_alg.start_time + time_budget if time_budget is not None else None
+        with gen_alg.evaluation_backend, gen_alg.snapshot_writer or nullcontext():
+            log(f"Steady-state genetic algorithm init", INFO_LEVEL)
+            population = sorted(gen_alg.evaluate(gen_alg.get_init_generation(generation_size)),
+                                key=lambda candidate_fitness: candidate_fitness[1])
+            gen_alg.record(0, population)
+            start_time = time.perf_counter()
+            self._evolve(population, generation_size=generation_size, mutation_chance=mutation_chance,
+                         best_parents_num=best_parents_num, random_parents_num=random_parents_num,
+                         similarity_to_single_parent=similarity_to_single_parent, target_fitness=target_fitness,
+                         children_limit=iterations_num * generation_size if iterations_num is not None else None,
+                         deadline=deadline)
+            self.wall_time += time.perf_counter() - start_time
+            gen_alg.evaluation_backend.wall_time += time.perf_counter() - start_time
+        return gen_alg.best_candidate, gen_alg.best_fitness
+
+    def _evolve(self, population: List[Tuple[Union[Composition, Genome], float]], generation_size: int,
+                mutation_chance: float, best_parents_num: int, random_parents_num: int,
+                similarity_to_single_parent: float, target_fitness: float, children_limit: int, deadline: float):
+        """Breeds, evaluates and inserts batches of children into the sorted population until a stop condition."""
+        gen_alg = self.gen_alg
+        fitness_cache = gen_alg.fitness_cache
+        population_keys = {FitnessCache.key(candidate) for candidate, fitness in population}
+        results = queue.Queue()
+        in_flight = 0
+        submitted_num = 0
+        children_num = 0
+        while True:
+            while in_flight < self.batches_in_flight and \
+                    (target_fitness is None or population[0][1] > target_fitness) and \
+                    (children_limit is None or submitted_num < children_limit) and \
+                    (deadline is None or time.perf_counter() < deadline):
+                children = gen_alg.get_next_generation(
+                    population, mutation_chance=mutation_chance, best_parents_num=best_parents_num,
+                    random_parents_num=random_parents_num, similarity_to_single_parent=similarity_to_single_parent,
+                    generation_size=min(self.batch_size, children_limit - submitted_num)
+                    if children_limit is not None else self.batch_size)
+                submitted_num += len(children)
+                in_flight += 1
+                self._submit(children, results)
+            if in_flight == 0:
+                break
+            result = results.get()
+            in_flight -= 1
+            if isinstance(result, BaseException):
+                raise result
+            for key, child, fitness in result:
+                if fitness_cache is not None and key is not None:
+                    fitness_cache.put(key, fitness)
+                if fitness >= population[-1][1]:
+                    continue
+                key = key or FitnessCache.key(child)
+                if key not in population_keys:
+                    population_keys.discard(FitnessCache.key(population.pop()[0]))
+                    bisect.insort(population, (child, fitness), key=lambda candidate_fitness: candidate_fitness[1])
+                    population_keys.add(key)
+                    self.replacements_num += 1
+            previous_generation = children_num // generation_size
+            children_num += len(result)
+            self.children_num += len(result)
+            if children_num // generation_size > previous_generation:
+                log(f"{children_num // generation_size}\t generation info:\n\tBest fitness:\t{population[0][1]}\n"
+                    f"\tAverage fitness:\t{sum([fitn for cand, fitn in population]) / len(population)}")
+            gen_alg.record(children_num // generation_size, population)
+
+    def _submit(self, children: List[Union[Composition, Genome]], results: queue.Queue):
+        """Puts (key, child, fitness) triples of children to results: at once for cached fitness and when evaluation
+        backend is done for the others. Keys are given if fitness cache is used."""
+        fitness_cache = self.gen_alg.fitness_cache
+        keys = [FitnessCache.key(child) for child in children] if fitness_cache is not None else [None] * len(children)
+        known = []
+        unknown = []
+        for key, child in zip(keys, children):
+            fitness = fitness_cache.get(key) if fitness_cache is not None else None
+            if fitness is None:
+                unknown.append((key, child))
+            else:
+                known.append((key, child, fitness))
+        if len(unknown) == 0:
+            results.put(known)
+            return
+        self.gen_alg.evaluation_backend.submit(
+            [child for key, child in unknown],
+            callback=lambda fitnesses: results.put(known + [(key, child, fitness) for (key, child), fitness
+                                                            in zip(unknown, fitnesses)]),
+            error_callback=results.put)
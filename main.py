@@ -1,15 +1,35 @@
 import os
+import random
 import time
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from functools import partial
+from typing import Any, Callable, Dict, Union
 
 import mido
+import numpy as np
 
-from app_config import EVENT_TO_AWARD_WEIGHTS
-from genetic_algorithm.crossover_strategy import make_crossover
+from app_config import EVENT_TO_AWARD_WEIGHTS, TOURNAMENT_SIZE
+from genetic_algorithm.crossover_strategy import make_crossover, make_genome_crossover
+from genetic_algorithm.dp_solver import DPSolver
+from genetic_algorithm.evaluation_backend import SERIAL_BACKEND, PROCESS_BACKEND, EVALUATION_BACKENDS
+from genetic_algorithm.fitness_function.batch_fitness_function import batch_fitness_function
 from genetic_algorithm.fitness_function.fitness_function import fitness_function, calculate_metrics
+from genetic_algorithm.fitness_function.incremental_fitness_function import IncrementalFitnessFunction
+from genetic_algorithm.fitness_function.table_fitness_function import TableFitnessFunction
 from genetic_algorithm.genetic_algorithm import GeneticAlgorithm
-from genetic_algorithm.mutation_strategy import make_mutation
-from music_interfaces.composition.composition import Composition, save_two_compostitions
+from genetic_algorithm.melody_context import MelodyContext
+from genetic_algorithm.genome import Genome
+from genetic_algorithm.island_model import IslandModel, RING_TOPOLOGY, TOPOLOGIES
+from genetic_algorithm.local_search import LocalSearch
+from genetic_algorithm.mutation_strategy import make_mutation, make_genome_mutation, get_random_candidate, \
+    get_random_genome, TargetedMutation, UNIFORM_TARGETING, PENALTY_TARGETING, TARGETINGS
+from genetic_algorithm.population_operators import PopulationOperators
+from genetic_algorithm.selection_strategy import SELECTION_STRATEGIES, TRUNCATION_SELECTION, TOURNAMENT_SELECTION, \
+    select_tournament
+from genetic_algorithm.snapshot_writer import SnapshotWriter
+from genetic_algorithm.stagnation_detector import StagnationDetector, ACTIONS, STOP_ACTION
+from genetic_algorithm.steady_state import SteadyStateGA
+from music_interfaces.composition.composition import Composition, save_two_compostitions, save_with_accompaniment
 
 
 GENERATION_SIZE_DEFAULT = 200
@@ -20,6 +40,41 @@ ITERATIONS_NUM_DEFAULT = 1000
 TARGET_FITNESS_DEFAULT = None
 SIMILARITY_TO_SINGLE_PARENT_DEFAULT = 0.5
 SAVE_DIR_PATH_DEFAULT = "output/"
+GA_ENGINE = "ga"
+DP_ENGINE = "dp"
+STEADY_STATE_ENGINE = "steady_state"
+ENGINE_DEFAULT = GA_ENGINE
+SCALAR_FITNESS = "scalar"
+BATCH_FITNESS = "batch"
+INCREMENTAL_FITNESS = "incremental"
+TABLE_FITNESS = "table"
+FITNESS_FUNCTION_DEFAULT = BATCH_FITNESS
+EVALUATION_BACKEND_DEFAULT = SERIAL_BACKEND
+WORKERS_NUM_DEFAULT = None
+CHUNK_SIZE_DEFAULT = None
+FITNESS_CACHE_SIZE_DEFAULT = 10000
+COMPOSITION_REPRESENTATION = "composition"
+GENOME_REPRESENTATION = "genome"
+REPRESENTATION_DEFAULT = COMPOSITION_REPRESENTATION
+SEED_DEFAULT = None
+ISLANDS_NUM_DEFAULT = None
+MIGRATION_INTERVAL_DEFAULT = 10
+MIGRANTS_NUM_DEFAULT = 2
+TOPOLOGY_DEFAULT = RING_TOPOLOGY
+TIME_BUDGET_DEFAULT = None
+SNAPSHOT_INTERVAL_DEFAULT = None
+STAGNATION_WINDOW_DEFAULT = None
+STAGNATION_ACTION_DEFAULT = STOP_ACTION
+MIN_DIVERSITY_DEFAULT = None
+LOCAL_SEARCH_INTERVAL_DEFAULT = None
+LOCAL_SEARCH_ELITE_NUM_DEFAULT = 2
+LOCAL_SEARCH_WORST_BEATS_NUM_DEFAULT = None
+MUTATION_TARGETING_DEFAULT = UNIFORM_TARGETING
+STEADY_STATE_BATCH_SIZE_DEFAULT = 50
+BATCHES_IN_FLIGHT_DEFAULT = None
+SELECTION_DEFAULT = TRUNCATION_SELECTION
+TOURNAMENT_SIZE_DEFAULT = TOURNAMENT_SIZE
+ELITE_NUM_DEFAULT = 0
 
 # Specify inputs
 parser = ArgumentParser()
@@ -29,7 +84,8 @@ parser.add_argument("-gs", "--generation_size", dest="generation_size",
                     help=f"Number of accompaniments in one generation. Default: {GENERATION_SIZE_DEFAULT}",
                     metavar="INT")
 parser.add_argument("-mc", "--mutation_chance", dest="mutation_chance",
-                    help=f"Chance that a chord in an accompaniment will be mutated. Default: {MUTATION_CHANCE_DEFAULT}",
+                    help=f"Chance that a chord in an accompaniment will be mutated, comma-separated values are given "
+                         f"to islands in turn. Default: {MUTATION_CHANCE_DEFAULT}",
                     metavar="FLOAT")
 parser.add_argument("-bpn", "--best_parents_num", dest="best_parents_num",
                     help=f"Number of best accompaniments in a generation that will be used as parents for next "
@@ -45,68 +101,407 @@ parser.add_argument("-tf", "--target_fitness", dest="target_fitness",
                          f"Default: {TARGET_FITNESS_DEFAULT}",
                     metavar="FLOAT")
 parser.add_argument("-stsp", "--similarity_to_single_parent", dest="similarity_to_single_parent",
-                    help=f"Probability of performing a change of a chord in the crossover. "
+                    help=f"Probability of performing a change of a chord in the crossover, comma-separated values are "
+                         f"given to islands in turn. "
                          f"Default: {SIMILARITY_TO_SINGLE_PARENT_DEFAULT}", metavar="FLOAT")
 parser.add_argument("-sdp", "--save_dir_path", dest="save_dir_path",
                     help=f"Path to save directory. Default: {SAVE_DIR_PATH_DEFAULT}", metavar="PATH")
-args = parser.parse_args()
-
-generation_size = int(args.generation_size or GENERATION_SIZE_DEFAULT)
-mutation_chance = float(args.mutation_chance or MUTATION_CHANCE_DEFAULT)
-best_parents_num = int(args.best_parents_num or BEST_PARENTS_NUM_DEFAULT)
-random_parents_num = int(args.random_parents_num or RANDOM_PARENTS_NUM_DEFAULT)
-iterations_num = int(args.iterations_num or ITERATIONS_NUM_DEFAULT)
-target_fitness = float(args.target_fitness) if args.target_fitness is not None else TARGET_FITNESS_DEFAULT
-similarity_to_single_parent = float(args.similarity_to_single_parent or SIMILARITY_TO_SINGLE_PARENT_DEFAULT)
-input_file_path = args.input_file_path
-assert input_file_path is not None, "Specify input_file_path by \"python3 main.py -ifp PATH\""
-save_dir_path = args.save_dir_path or SAVE_DIR_PATH_DEFAULT
-
-input_file_path_normpath = os.path.normpath(input_file_path)
-input_file_path_dir = input_file_path_normpath.split(os.sep)
-input_file_name = os.path.splitext(input_file_path_dir[-1])[0]
-
-save_dir_path_normpath = os.path.normpath(save_dir_path)
-print(save_dir_path_normpath)
-
-
-# Run algorithm
-start_time = time.time()
-melody = Composition(midi_file=mido.MidiFile(input_file_path_normpath))
-gen_alg = GeneticAlgorithm(melody=melody, fitness_function=fitness_function, crossover_strategy=make_crossover,
-                           mutation_strategy=make_mutation)
-accompaniment, fitness = gen_alg.solve(generation_size=generation_size, mutation_chance=mutation_chance,
-                                       best_parents_num=best_parents_num, random_parents_num=random_parents_num,
-                                       similarity_to_single_parent=similarity_to_single_parent,
-                                       target_fitness=target_fitness, iterations_num=iterations_num)
-execution_time = time.time() - start_time
-print(f"Execution time: {execution_time}")
-print(f"Accompaniment fitness: {fitness}")
-
-# Save results
-os.makedirs(save_dir_path_normpath, exist_ok=True)
-i = 1
-while os.path.isdir(f"{save_dir_path_normpath}/{i}"):
-    i += 1
-save_dir_path = f"{save_dir_path_normpath}/{i}"
-os.makedirs(save_dir_path, exist_ok=True)
-melody.MIDI_TEMPLATE_PATH = input_file_path
-save_two_compostitions(melody, accompaniment, f"{save_dir_path}/{input_file_name}_with_accompaniment.mid")
-accompaniment.MIDI_TEMPLATE_PATH = input_file_path
-accompaniment.save_midi(f"{save_dir_path}/{input_file_name}_accompaniment.mid")
-with open(f"{save_dir_path}/result_description.txt", "w") as description_file:
-    description_file.write(f"Config:\n"
-                           f"\tgeneration_size = {generation_size}\n"
-                           f"\tmutation_chance = {mutation_chance}\n"
-                           f"\tbest_parents_num = {best_parents_num}\n"
-                           f"\trandom_parents_num = {random_parents_num}\n"
-                           f"\tsimilarity_to_single_parent = {similarity_to_single_parent}\n"
-                           f"\titerations_num = {iterations_num}\n"
-                           f"\ttarget_fitness = {target_fitness}\n"
-                           f"\tEVENT_TO_AWARD_WEIGHTS = {EVENT_TO_AWARD_WEIGHTS}\n"
-                           f"\n"
-                           f"Results:\n"
-                           f"\tAccompaniment fitness: {fitness}\n"
-                           f"\tExecution time: {execution_time}\n"
-                           f"\tMetrics: {calculate_metrics(melody, accompaniment)}")
-print(f"Results were saved to {save_dir_path}")
+parser.add_argument("-e", "--engine", dest="engine", choices=[GA_ENGINE, STEADY_STATE_ENGINE, DP_ENGINE],
+                    help=f"Search engine: genetic algorithm, steady-state genetic algorithm that replaces the worst "
+                         f"accompaniments by children as soon as they are evaluated or exact dynamic programming over "
+                         f"beats, which ignores genetic algorithm parameters. Default: {ENGINE_DEFAULT}")
+parser.add_argument("-ff", "--fitness_function", dest="fitness_function",
+                    choices=[SCALAR_FITNESS, BATCH_FITNESS, INCREMENTAL_FITNESS, TABLE_FITNESS],
+                    help=f"Way to evaluate fitness: each accompaniment separately, whole generation at once, only "
+                         f"beats changed since parent evaluation or whole generation at once by lookups in score "
+                         f"tables precomputed for the melody. Default: {FITNESS_FUNCTION_DEFAULT}")
+parser.add_argument("-eb", "--evaluation_backend", dest="evaluation_backend", choices=list(EVALUATION_BACKENDS.keys()),
+                    help=f"Backend for fitness evaluation of generation. Default: {EVALUATION_BACKEND_DEFAULT}")
+parser.add_argument("-wn", "--workers_num", dest="workers_num",
+                    help="Number of workers of thread or process evaluation backend. Default: number of cores",
+                    metavar="INT")
+parser.add_argument("-cs", "--chunk_size", dest="chunk_size",
+                    help="Number of accompaniments evaluated by a worker at once. Default: generation is split equally "
+                         "between workers", metavar="INT")
+parser.add_argument("-fcs", "--fitness_cache_size", dest="fitness_cache_size",
+                    help=f"Number of fitness values of distinct accompaniments kept in LRU cache, 0 disables cache. "
+                         f"Default: {FITNESS_CACHE_SIZE_DEFAULT}", metavar="INT")
+parser.add_argument("-r", "--representation", dest="representation",
+                    choices=[COMPOSITION_REPRESENTATION, GENOME_REPRESENTATION],
+                    help=f"Representation of accompaniments in genetic algorithm: Composition with notes or genome "
+                         f"with chord state per beat, which is made by generation-wide operators and requires table "
+                         f"fitness function. "
+                         f"Default: {REPRESENTATION_DEFAULT}")
+parser.add_argument("-s", "--seed", dest="seed",
+                    help=f"Seed of random generators that makes runs reproducible. Default: {SEED_DEFAULT}",
+                    metavar="INT")
+parser.add_argument("-isn", "--islands_num", dest="islands_num",
+                    help=f"Number of islands of genetic algorithm that evolve in separate processes and exchange best "
+                         f"accompaniments, generation_size is size of each island. Default: {ISLANDS_NUM_DEFAULT}",
+                    metavar="INT")
+parser.add_argument("-mi", "--migration_interval", dest="migration_interval",
+                    help=f"Number of generations between migrations of islands. Default: {MIGRATION_INTERVAL_DEFAULT}",
+                    metavar="INT")
+parser.add_argument("-mn", "--migrants_num", dest="migrants_num",
+                    help=f"Number of best accompaniments that an island sends at migration. "
+                         f"Default: {MIGRANTS_NUM_DEFAULT}", metavar="INT")
+parser.add_argument("-it", "--island_topology", dest="island_topology", choices=TOPOLOGIES,
+                    help=f"Islands that receive migrants: next island or all other islands. "
+                         f"Default: {TOPOLOGY_DEFAULT}")
+parser.add_argument("-tb", "--time_budget", dest="time_budget",
+                    help=f"Seconds after which genetic algorithm stops and returns the best accompaniment found. "
+                         f"Default: {TIME_BUDGET_DEFAULT}", metavar="FLOAT")
+parser.add_argument("-snp", "--snapshots", dest="snapshots", action="store_true",
+                    help="Save the best-so-far accompaniment with melody to the results directory while genetic "
+                         "algorithm runs, whenever its fitness improves.")
+parser.add_argument("-si", "--snapshot_interval", dest="snapshot_interval",
+                    help=f"Save snapshot of improved accompaniment only every given number of generations. "
+                         f"Default: {SNAPSHOT_INTERVAL_DEFAULT}", metavar="INT")
+parser.add_argument("-sw", "--stagnation_window", dest="stagnation_window",
+                    help=f"Number of generations without improvement of best or mean fitness after which genetic "
+                         f"algorithm is considered stagnating. Default: {STAGNATION_WINDOW_DEFAULT}", metavar="INT")
+parser.add_argument("-sa", "--stagnation_action", dest="stagnation_action", choices=ACTIONS,
+                    help=f"Action on stagnation: stop, ramp up mutation_chance or replace the worst accompaniments by "
+                         f"random ones. Default: {STAGNATION_ACTION_DEFAULT}")
+parser.add_argument("-mdv", "--min_diversity", dest="min_diversity",
+                    help=f"Diversity of chords at beats in generation from 0 to 1 below which genetic algorithm is "
+                         f"considered stagnating, requires stagnation_window. Default: {MIN_DIVERSITY_DEFAULT}",
+                    metavar="FLOAT")
+parser.add_argument("-lsi", "--local_search_interval", dest="local_search_interval",
+                    help=f"Number of generations between greedy per-beat improvements of the best accompaniments, "
+                         f"requires genome representation. Default: {LOCAL_SEARCH_INTERVAL_DEFAULT}", metavar="INT")
+parser.add_argument("-lse", "--local_search_elite_num", dest="local_search_elite_num",
+                    help=f"Number of the best accompaniments improved by local search. "
+                         f"Default: {LOCAL_SEARCH_ELITE_NUM_DEFAULT}", metavar="INT")
+parser.add_argument("-lsb", "--local_search_worst_beats_num", dest="local_search_worst_beats_num",
+                    help=f"Number of beats with the worst beat-local award improved by local search, all beats by "
+                         f"default. Default: {LOCAL_SEARCH_WORST_BEATS_NUM_DEFAULT}", metavar="INT")
+
+parser.add_argument("-mt", "--mutation_targeting", dest="mutation_targeting", choices=TARGETINGS,
+                    help=f"Choice of mutated beats: uniform or more often at beats with larger fitness penalties, "
+                         f"e.g. accompaniment not below melody, too big chord drop or chord out of melody key. "
+                         f"Default: {MUTATION_TARGETING_DEFAULT}")
+parser.add_argument("-ssb", "--steady_state_batch_size", dest="steady_state_batch_size",
+                    help=f"Number of children bred and evaluated at once by steady-state engine. "
+                         f"Default: {STEADY_STATE_BATCH_SIZE_DEFAULT}", metavar="INT")
+parser.add_argument("-bif", "--batches_in_flight", dest="batches_in_flight",
+                    help="Number of batches of children evaluated at once by steady-state engine. Default: twice the "
+                         "number of workers", metavar="INT")
+parser.add_argument("-sel", "--selection", dest="selection", choices=list(SELECTION_STRATEGIES.keys()),
+                    help=f"Selection of parents: best_parents_num best and random_parents_num random accompaniments, "
+                         f"winners of tournaments or random accompaniments drawn by rank, best_parents_num + "
+                         f"random_parents_num parents in total. Default: {SELECTION_DEFAULT}")
+parser.add_argument("-ts", "--tournament_size", dest="tournament_size",
+                    help=f"Number of accompaniments that compete for each parent in tournament selection. "
+                         f"Default: {TOURNAMENT_SIZE_DEFAULT}", metavar="INT")
+parser.add_argument("-el", "--elite_num", dest="elite_num",
+                    help=f"Number of the best accompaniments carried over to the next generation with known fitness. "
+                         f"Default: {ELITE_NUM_DEFAULT}", metavar="INT")
+
+
+def read_config(args: Namespace) -> Namespace:
+    """Returns run parameters given by parsed command line arguments or their defaults."""
+    config = Namespace()
+    config.generation_size = int(args.generation_size or GENERATION_SIZE_DEFAULT)
+    config.mutation_chances = [float(value) for value in
+                               (args.mutation_chance or str(MUTATION_CHANCE_DEFAULT)).split(",")]
+    config.best_parents_num = int(args.best_parents_num or BEST_PARENTS_NUM_DEFAULT)
+    config.random_parents_num = int(args.random_parents_num or RANDOM_PARENTS_NUM_DEFAULT)
+    config.iterations_num = int(args.iterations_num or ITERATIONS_NUM_DEFAULT)
+    config.target_fitness = float(args.target_fitness) if args.target_fitness is not None else TARGET_FITNESS_DEFAULT
+    config.similarities_to_single_parent = [float(value) for value in (args.similarity_to_single_parent or
+                                                                       str(SIMILARITY_TO_SINGLE_PARENT_DEFAULT)
+                                                                       ).split(",")]
+    config.save_dir_path = args.save_dir_path or SAVE_DIR_PATH_DEFAULT
+    config.engine = args.engine or ENGINE_DEFAULT
+    config.fitness_function_name = args.fitness_function or FITNESS_FUNCTION_DEFAULT
+    config.evaluation_backend = args.evaluation_backend or EVALUATION_BACKEND_DEFAULT
+    config.workers_num = int(args.workers_num) if args.workers_num is not None else WORKERS_NUM_DEFAULT
+    # fitness states of candidates are not sent to worker processes and back, so children would be fully rescored
+    if config.fitness_function_name == INCREMENTAL_FITNESS and config.evaluation_backend == PROCESS_BACKEND:
+        parser.error(f"{INCREMENTAL_FITNESS} fitness function can not be used with {PROCESS_BACKEND} evaluation "
+                     f"backend")
+    config.chunk_size = int(args.chunk_size) if args.chunk_size is not None else CHUNK_SIZE_DEFAULT
+    config.fitness_cache_size = int(args.fitness_cache_size) if args.fitness_cache_size is not None \
+        else FITNESS_CACHE_SIZE_DEFAULT
+    config.representation = args.representation or REPRESENTATION_DEFAULT
+    if config.engine != DP_ENGINE and config.representation == GENOME_REPRESENTATION and \
+            config.fitness_function_name != TABLE_FITNESS:
+        parser.error(f"{GENOME_REPRESENTATION} representation requires {TABLE_FITNESS} fitness function")
+    config.seed = int(args.seed) if args.seed is not None else SEED_DEFAULT
+    config.islands_num = int(args.islands_num) if args.islands_num is not None else ISLANDS_NUM_DEFAULT
+    config.migration_interval = int(args.migration_interval or MIGRATION_INTERVAL_DEFAULT)
+    config.migrants_num = int(args.migrants_num or MIGRANTS_NUM_DEFAULT)
+    config.island_topology = args.island_topology or TOPOLOGY_DEFAULT
+    config.time_budget = float(args.time_budget) if args.time_budget is not None else TIME_BUDGET_DEFAULT
+    config.snapshots = args.snapshots
+    config.snapshot_interval = int(args.snapshot_interval) if args.snapshot_interval is not None \
+        else SNAPSHOT_INTERVAL_DEFAULT
+    config.stagnation_window = int(args.stagnation_window) if args.stagnation_window is not None \
+        else STAGNATION_WINDOW_DEFAULT
+    config.stagnation_action = args.stagnation_action or STAGNATION_ACTION_DEFAULT
+    config.min_diversity = float(args.min_diversity) if args.min_diversity is not None else MIN_DIVERSITY_DEFAULT
+    if config.min_diversity is not None and config.stagnation_window is None:
+        parser.error("min_diversity requires stagnation_window")
+    config.local_search_interval = int(args.local_search_interval) if args.local_search_interval is not None \
+        else LOCAL_SEARCH_INTERVAL_DEFAULT
+    config.local_search_elite_num = int(args.local_search_elite_num or LOCAL_SEARCH_ELITE_NUM_DEFAULT)
+    config.local_search_worst_beats_num = int(args.local_search_worst_beats_num) \
+        if args.local_search_worst_beats_num is not None else LOCAL_SEARCH_WORST_BEATS_NUM_DEFAULT
+    if config.engine != DP_ENGINE and config.local_search_interval is not None and \
+            config.representation != GENOME_REPRESENTATION:
+        parser.error(f"local search requires {GENOME_REPRESENTATION} representation")
+    config.mutation_targeting = args.mutation_targeting or MUTATION_TARGETING_DEFAULT
+    config.steady_state_batch_size = int(args.steady_state_batch_size or STEADY_STATE_BATCH_SIZE_DEFAULT)
+    config.batches_in_flight = int(args.batches_in_flight) if args.batches_in_flight is not None \
+        else BATCHES_IN_FLIGHT_DEFAULT
+    config.selection = args.selection or SELECTION_DEFAULT
+    config.tournament_size = int(args.tournament_size or TOURNAMENT_SIZE_DEFAULT)
+    config.elite_num = int(args.elite_num or ELITE_NUM_DEFAULT)
+    if config.elite_num >= config.generation_size:
+        parser.error("elite_num must be less than generation_size")
+    if config.engine == STEADY_STATE_ENGINE and (config.islands_num is not None or config.stagnation_window is not None
+                                                 or config.local_search_interval is not None or config.elite_num > 0):
+        parser.error(f"{STEADY_STATE_ENGINE} engine does not support islands, stagnation, local search and elite")
+    if config.islands_num is None and (len(config.mutation_chances) > 1 or
+                                       len(config.similarities_to_single_parent) > 1):
+        parser.error("several mutation_chance or similarity_to_single_parent values require islands")
+    if config.islands_num is not None:
+        config.mutation_chances = [config.mutation_chances[i % len(config.mutation_chances)]
+                                   for i in range(config.islands_num)]
+        config.similarities_to_single_parent = [
+            config.similarities_to_single_parent[i % len(config.similarities_to_single_parent)]
+            for i in range(config.islands_num)]
+    return config
+
+
+def run(config: Namespace, input_file_path: str, save_dir_path: str = None) -> Dict[str, Any]:
+    """Generates accompaniment for the melody of input file and saves results to new numbered directory in
+    save_dir_path, by default in config.save_dir_path. Returns fitness, metrics, execution time and path of results."""
+    random.seed(config.seed)
+
+    input_file_path_normpath = os.path.normpath(input_file_path)
+    input_file_path_dir = input_file_path_normpath.split(os.sep)
+    input_file_name = os.path.splitext(input_file_path_dir[-1])[0]
+
+    save_dir_path_normpath = os.path.normpath(save_dir_path or config.save_dir_path)
+    print(save_dir_path_normpath)
+
+    # Run algorithm
+    start_time = time.time()
+    melody = Composition(midi_file=mido.MidiFile(input_file_path_normpath))
+    melody.MIDI_TEMPLATE_PATH = input_file_path
+    melody_context = MelodyContext(melody)
+    # results directory is taken before the run if snapshots are saved to it
+    save_dir_path = _make_results_dir(save_dir_path_normpath) if config.snapshots and config.engine != DP_ENGINE \
+        else None
+    if config.engine == DP_ENGINE:
+        dp_solver = DPSolver(melody_context)
+        accompaniment, fitness = dp_solver.solve()
+        engine_summaries = [f"DP solver: {dp_solver.summary}", f"Score tables: {dp_solver.tables.summary}"]
+        workers_num = None
+    else:
+        fitness_function_name = config.fitness_function_name
+        representation = config.representation
+        table_fitness_function = TableFitnessFunction(melody_context) \
+            if fitness_function_name == TABLE_FITNESS else None
+        if fitness_function_name == INCREMENTAL_FITNESS:
+            candidate_fitness_function = IncrementalFitnessFunction(melody_context)
+        elif table_fitness_function is not None:
+            candidate_fitness_function = table_fitness_function
+        else:
+            candidate_fitness_function = fitness_function
+        if fitness_function_name == BATCH_FITNESS:
+            candidate_batch_fitness_function = batch_fitness_function
+        elif table_fitness_function is not None:
+            candidate_batch_fitness_function = table_fitness_function.batch
+        else:
+            candidate_batch_fitness_function = None
+        population_operators = None
+        if representation == GENOME_REPRESENTATION:
+            crossover_strategy = make_genome_crossover
+            mutation_strategy = make_genome_mutation
+            random_candidate_strategy = get_random_genome
+            beat_penalties = table_fitness_function.beat_penalties \
+                if config.mutation_targeting == PENALTY_TARGETING else None
+            population_operators = PopulationOperators(melody_context, np.random.default_rng(config.seed),
+                                                       beat_penalties=beat_penalties)
+        else:
+            crossover_strategy = make_crossover
+            mutation_strategy = TargetedMutation(melody_context) \
+                if config.mutation_targeting == PENALTY_TARGETING else make_mutation
+            random_candidate_strategy = get_random_candidate
+        snapshot_writer = None
+        if save_dir_path is not None:
+            snapshot_writer = SnapshotWriter(_snapshot_saver(melody, melody_context,
+                                                             f"{save_dir_path}/{input_file_name}"),
+                                             generations_interval=config.snapshot_interval)
+        stagnation_detector = None
+        if config.stagnation_window is not None:
+            stagnation_detector = StagnationDetector(config.stagnation_window, action=config.stagnation_action,
+                                                     min_diversity=config.min_diversity)
+        local_search = None
+        if config.local_search_interval is not None:
+            local_search = LocalSearch(table_fitness_function, config.local_search_interval,
+                                       config.local_search_elite_num,
+                                       worst_beats_num=config.local_search_worst_beats_num)
+        if config.selection == TOURNAMENT_SELECTION:
+            selection_strategy = partial(select_tournament, tournament_size=config.tournament_size)
+        else:
+            selection_strategy = SELECTION_STRATEGIES[config.selection]
+        gen_alg = GeneticAlgorithm(melody=melody_context, fitness_function=candidate_fitness_function,
+                                   crossover_strategy=crossover_strategy, mutation_strategy=mutation_strategy,
+                                   batch_fitness_function=candidate_batch_fitness_function,
+                                   evaluation_backend=config.evaluation_backend, workers_num=config.workers_num,
+                                   chunk_size=config.chunk_size, fitness_cache_size=config.fitness_cache_size,
+                                   random_candidate_strategy=random_candidate_strategy,
+                                   population_operators=population_operators, snapshot_writer=snapshot_writer,
+                                   stagnation_detector=stagnation_detector, local_search=local_search,
+                                   selection_strategy=selection_strategy, elite_num=config.elite_num)
+        island_model = IslandModel(gen_alg, islands_num=config.islands_num,
+                                   migration_interval=config.migration_interval, migrants_num=config.migrants_num,
+                                   topology=config.island_topology, seed=config.seed) \
+            if config.islands_num is not None else None
+        steady_state = SteadyStateGA(gen_alg, batch_size=config.steady_state_batch_size,
+                                     batches_in_flight=config.batches_in_flight) \
+            if config.engine == STEADY_STATE_ENGINE else None
+        solve_start_time = time.perf_counter()
+        if island_model is not None:
+            accompaniment, fitness = island_model.solve(
+                generation_size=config.generation_size, mutation_chances=config.mutation_chances,
+                best_parents_num=config.best_parents_num, random_parents_num=config.random_parents_num,
+                similarities_to_single_parent=config.similarities_to_single_parent,
+                target_fitness=config.target_fitness, iterations_num=config.iterations_num,
+                time_budget=config.time_budget)
+        else:
+            accompaniment, fitness = (steady_state or gen_alg).solve(
+                generation_size=config.generation_size, mutation_chance=config.mutation_chances[0],
+                best_parents_num=config.best_parents_num, random_parents_num=config.random_parents_num,
+                similarity_to_single_parent=config.similarities_to_single_parent[0],
+                target_fitness=config.target_fitness, iterations_num=config.iterations_num,
+                time_budget=config.time_budget)
+        solve_time = time.perf_counter() - solve_start_time
+        if isinstance(accompaniment, Genome):
+            accompaniment = accompaniment.to_composition(melody_context)
+        if island_model is not None:
+            engine_summaries = [f"Evaluation: {island_model.evaluation_summary}",
+                                f"Fitness cache: {island_model.fitness_cache_summary}",
+                                f"Islands: {island_model.summary}"]
+        else:
+            engine_summaries = [f"Evaluation: {gen_alg.evaluation_backend.summary}",
+                                f"Fitness cache: "
+                                f"{gen_alg.fitness_cache.summary if gen_alg.fitness_cache is not None else None}"]
+            evaluations_num = gen_alg.evaluation_backend.evaluations_num
+            engine_summaries.append(f"Throughput: {evaluations_num} evaluations in {solve_time:.3f} s, "
+                                    f"{evaluations_num / solve_time:.0f} per second")
+            engine_summaries.append(f"Selection: {config.selection} with {config.elite_num} elite, "
+                                    f"{gen_alg.selection_summary}")
+        if steady_state is not None:
+            engine_summaries.append(f"Steady state: {steady_state.summary}")
+        if gen_alg.stagnation_detector is not None:
+            engine_summaries.append(f"Stagnation: {island_model.stagnation_summary}" if island_model is not None else
+                                    f"Stagnation: {gen_alg.stagnation_detector.summary}")
+        if gen_alg.local_search is not None and island_model is None:
+            engine_summaries.append(f"Local search: {gen_alg.local_search.summary}")
+        if gen_alg.snapshot_writer is not None:
+            engine_summaries.append(f"Snapshots: {gen_alg.snapshot_writer.summary}")
+        fitness_curve = [(round(seconds, 3), generation, fitness)
+                         for seconds, generation, fitness in (island_model or gen_alg).fitness_curve]
+        engine_summaries.append(f"Fitness curve (seconds, generation, best fitness): {fitness_curve}")
+        if table_fitness_function is not None:
+            engine_summaries.append(f"Score tables: {table_fitness_function.tables.summary}")
+        workers_num = gen_alg.evaluation_backend.workers_num
+    execution_time = time.time() - start_time
+    print(f"Execution time: {execution_time}")
+    print(f"Accompaniment fitness: {fitness}")
+    for engine_summary in engine_summaries:
+        print(engine_summary)
+    metrics = calculate_metrics(melody_context, accompaniment)
+
+    # Save results
+    save_dir_path = save_dir_path or _make_results_dir(save_dir_path_normpath)
+    accompaniment.MIDI_TEMPLATE_PATH = input_file_path
+    save_with_accompaniment(melody, accompaniment, f"{save_dir_path}/{input_file_name}_with_accompaniment.mid",
+                            f"{save_dir_path}/{input_file_name}_accompaniment.mid")
+    with open(f"{save_dir_path}/result_description.txt", "w") as description_file:
+        description_file.write(f"Config:\n"
+                               f"\tgeneration_size = {config.generation_size}\n"
+                               f"\tmutation_chance = {','.join(map(str, config.mutation_chances))}\n"
+                               f"\tbest_parents_num = {config.best_parents_num}\n"
+                               f"\trandom_parents_num = {config.random_parents_num}\n"
+                               f"\tsimilarity_to_single_parent = "
+                               f"{','.join(map(str, config.similarities_to_single_parent))}\n"
+                               f"\titerations_num = {config.iterations_num}\n"
+                               f"\ttarget_fitness = {config.target_fitness}\n"
+                               f"\tengine = {config.engine}\n"
+                               f"\tfitness_function = {config.fitness_function_name}\n"
+                               f"\tevaluation_backend = {config.evaluation_backend}\n"
+                               f"\tworkers_num = {workers_num}\n"
+                               f"\tchunk_size = {config.chunk_size}\n"
+                               f"\tfitness_cache_size = {config.fitness_cache_size}\n"
+                               f"\trepresentation = {config.representation}\n"
+                               f"\tseed = {config.seed}\n"
+                               f"\tislands_num = {config.islands_num}\n"
+                               f"\tmigration_interval = {config.migration_interval}\n"
+                               f"\tmigrants_num = {config.migrants_num}\n"
+                               f"\tisland_topology = {config.island_topology}\n"
+                               f"\ttime_budget = {config.time_budget}\n"
+                               f"\tsnapshot_interval = {config.snapshot_interval if config.snapshots else None}\n"
+                               f"\tstagnation_window = {config.stagnation_window}\n"
+                               f"\tstagnation_action = {config.stagnation_action}\n"
+                               f"\tmin_diversity = {config.min_diversity}\n"
+                               f"\tlocal_search_interval = {config.local_search_interval}\n"
+                               f"\tlocal_search_elite_num = {config.local_search_elite_num}\n"
+                               f"\tlocal_search_worst_beats_num = {config.local_search_worst_beats_num}\n"
+                               f"\tmutation_targeting = {config.mutation_targeting}\n"
+                               f"\tsteady_state_batch_size = {config.steady_state_batch_size}\n"
+                               f"\tbatches_in_flight = {config.batches_in_flight}\n"
+                               f"\tselection = {config.selection}\n"
+                               f"\ttournament_size = {config.tournament_size}\n"
+                               f"\telite_num = {config.elite_num}\n"
+                               f"\tEVENT_TO_AWARD_WEIGHTS = {EVENT_TO_AWARD_WEIGHTS}\n"
+                               f"\n"
+                               f"Results:\n"
+                               f"\tAccompaniment fitness: {fitness}\n"
+                               f"\tExecution time: {execution_time}\n"
+                               + "".join(f"\t{engine_summary}\n" for engine_summary in engine_summaries) +
+                               f"\tMetrics: {metrics}")
+    print(f"Results were saved to {save_dir_path}")
+    return {"fitness": fitness, "metrics": metrics, "execution_time": execution_time, "save_dir_path": save_dir_path}
+
+
+def _make_results_dir(save_dir_path: str) -> str:
+    """Creates and returns new numbered directory in save_dir_path."""
+    os.makedirs(save_dir_path, exist_ok=True)
+    i = 1
+    while True:
+        results_dir_path = f"{save_dir_path}/{i}"
+        try:
+            # directory is taken atomically, so concurrent runs with the same save_dir_path do not share it
+            os.makedirs(results_dir_path)
+            return results_dir_path
+        except FileExistsError:
+            i += 1
+
+
+def _snapshot_saver(melody: Composition, melody_context: MelodyContext, path_prefix: str) \
+        -> Callable[[Union[Composition, Genome], float, int], None]:
+    """Returns function that saves melody with accompaniment to path_prefix_best_so_far.mid, replacing the file
+    atomically."""
+    def save(accompaniment: Union[Composition, Genome], fitness: float, generation: int):
+        if isinstance(accompaniment, Genome):
+            accompaniment = accompaniment.to_composition(melody_context)
+        save_two_compostitions(melody, accompaniment, f"{path_prefix}_best_so_far.mid.tmp")
+        os.replace(f"{path_prefix}_best_so_far.mid.tmp", f"{path_prefix}_best_so_far.mid")
+    return save
+
+
+def main():
+    args = parser.parse_args()
+    config = read_config(args)
+    assert args.input_file_path is not None, "Specify input_file_path by \"python3 main.py -ifp PATH\""
+    run(config, args.input_file_path)
+
+
+if __name__ == "__main__":
+    main()
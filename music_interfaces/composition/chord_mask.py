@@ -0,0 +1,80 @@
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from music_interfaces.composition.composition_constants import NAME_TO_CHORD
+
+# Chord code is root << 12 | mask, where root is pitch class of the lowest note and mask has bit i set if pitch class i
+# is used in chord. Only chords in close position (distinct notes within an octave from the lowest one) have codes.
+PITCH_CLASSES_NUM = 12
+MASKS_NUM = 1 << PITCH_CLASSES_NUM
+CODES_NUM = PITCH_CLASSES_NUM * MASKS_NUM
+NO_CHORD_CODE = -1
+
+
+def pitch_class_mask(notes: Iterable[int]) -> int:
+    """Returns 12-bit mask of pitch classes of the notes."""
+    mask = 0
+    for note in notes:
+        mask |= 1 << note % PITCH_CLASSES_NUM
+    return mask
+
+
+def chord_code(notes: Sequence[int]) -> int:
+    """Returns code of the chord given by sorted note numbers or NO_CHORD_CODE if chord is not in close position.
+
+    Empty chord has code 0.
+
+    """
+    if len(notes) == 0:
+        return 0
+    if notes[-1] - notes[0] >= PITCH_CLASSES_NUM:
+        return NO_CHORD_CODE
+    mask = pitch_class_mask(notes)
+    if mask.bit_count() != len(notes):
+        return NO_CHORD_CODE
+    return notes[0] % PITCH_CLASSES_NUM << PITCH_CLASSES_NUM | mask
+
+
+def code_root(code: int) -> int:
+    """Returns pitch class of the lowest note of chord code."""
+    return code >> PITCH_CLASSES_NUM
+
+
+def code_mask(code: int) -> int:
+    """Returns pitch class mask of chord code."""
+    return code & MASKS_NUM - 1
+
+
+def included_notes_num(chord_mask: int, mask_layers: Tuple[int, ...]) -> int:
+    """Returns number of notes of a multiset given as mask_layers (see mask_layers) with pitch classes in chord_mask."""
+    return sum([(chord_mask & layer).bit_count() for layer in mask_layers])
+
+
+def mask_layers(pitch_class_counts: Sequence[int]) -> Tuple[int, ...]:
+    """Returns multiset of pitch classes as masks, where layer k has pitch classes used more than k times."""
+    layers = []
+    while True:
+        layer = pitch_class_mask(pitch_class for pitch_class, count in enumerate(pitch_class_counts)
+                                 if count > len(layers))
+        if layer == 0:
+            return tuple(layers)
+        layers.append(layer)
+
+
+def chord_name(code: int) -> Optional[str]:
+    """Returns name of chord shape of the code in NAME_TO_CHORD or None if the shape is unknown."""
+    return CHORD_NAMES_BY_CODE[code] if code != NO_CHORD_CODE else None
+
+
+def _chord_names_by_code() -> List[Optional[str]]:
+    """Returns names of NAME_TO_CHORD shapes for every root indexed by chord code. First name wins for equal shapes."""
+    names = [None] * CODES_NUM
+    for name, chord in NAME_TO_CHORD.items():
+        for root in range(PITCH_CLASSES_NUM):
+            code = chord_code([root + note for note in chord])
+            assert code != NO_CHORD_CODE, f"chord {name} must be in close position"
+            if names[code] is None and (len(chord) > 0 or root == 0):
+                names[code] = name
+    return names
+
+
+CHORD_NAMES_BY_CODE = _chord_names_by_code()
@@ -1,17 +1,50 @@
-from typing import List, Tuple, Dict
+import functools
+import io
+from array import array
+from operator import add
+from types import MappingProxyType
+from typing import Callable, Dict, List, Mapping, Tuple, Set
 
-from lazy import lazy
-from mido import MidiFile, Message, MidiTrack
+import numpy as np
+from mido import MidiFile, Message
 
-from music_interfaces.composition.composition_constants import MAJOR_TONIC, MINOR_TONIC, NAME_TO_CHORD, \
-    UNKNOWN_CHORD_NAME
+from music_interfaces.composition.chord_mask import chord_code, chord_name, code_root
+from music_interfaces.composition.composition_constants import MAJOR_TONIC, MINOR_TONIC, UNKNOWN_CHORD_NAME
+from music_interfaces.composition.midi_writer import MidiTemplate
 from music_interfaces.note import CompositionNote
 
 
+def cached_view(method: Callable) -> property:
+    """Returns property of Composition computed by method from its notes and metadata and cached until
+    Composition.version changes. Cached values must be immutable."""
+    name = method.__name__
+
+    @functools.wraps(method)
+    def view(self):
+        cached = self._views.get(name)
+        if cached is None or cached[0] != self._version:
+            cached = self._views[name] = (self._version, method(self))
+        return cached[1]
+    return property(view)
+
+
 class Composition:
-    """Interface for working with track, its notes and metadata."""
+    """Interface for working with track, its notes and metadata.
+
+    Notes are stored by columns: parallel arrays of note numbers, start times and durations in the order of notes.
+    Composition.notes builds a list of CompositionNote from the columns at each access, so changes of the returned notes
+    do not change the Composition: assign Composition.notes to change them. Columns are never changed in place, so
+    clones share them until their notes are assigned, and they are exposed only as read-only views.
+
+    Views derived from notes and metadata (notes_at, notes_by_buckets, triad_names_by_beats, key, duration) are cached
+    (see cached_view) and are immutable. Assignment of notes, min_duration or ticks_per_beat increments
+    Composition.version, which invalidates them. Notes inside views are shared between accesses and must not be changed.
+
+    """
     MIDI_TEMPLATE_PATH = "music_interfaces/composition/template.mid"
-    min_duration: int = None
+    _min_duration: int = None
+    fitness_state = None  # per-beat fitness contributions, see IncrementalFitnessFunction
+    dirty_beats: Set[int] = None  # beats changed since fitness_state was computed
 
     def __init__(self, notes: List[CompositionNote] = None, ticks_per_beat: int = None, tempo: int = None,
                  midi_file: MidiFile = None):
@@ -19,6 +52,8 @@ class Composition:
                (notes is not None and ticks_per_beat is not None and tempo is not None or midi_file is not None), \
             "exactly one of {(notes, ticks_per_beat), midi_file} must be used"
         self._midi_file = midi_file
+        self._version = 0
+        self._views = {}
         if notes and ticks_per_beat and tempo:
             self.notes = notes
             self.ticks_per_beat = ticks_per_beat
@@ -27,13 +62,107 @@ class Composition:
             self.notes, self.ticks_per_beat, self.tempo = self._read_midi_file(midi_file)
 
     @property
-    def notes_at(self) -> Dict[int, List[CompositionNote]]:
+    def notes(self) -> List[CompositionNote]:
+        """Returns list of notes built from the columns."""
+        return list(map(CompositionNote.view, self._pitches, self._start_times, self._durations))
+
+    @notes.setter
+    def notes(self, notes: List[CompositionNote]):
+        self._set_columns(array("H", [note.note for note in notes]), array("I", [note.start_time for note in notes]),
+                          array("I", [note.duration for note in notes]))
+
+    @property
+    def version(self) -> int:
+        """Returns number of changes of notes, min_duration and ticks_per_beat, cached views are computed for it."""
+        return self._version
+
+    @property
+    def min_duration(self) -> int:
+        """Returns minimal duration in ticks or None."""
+        return self._min_duration
+
+    @min_duration.setter
+    def min_duration(self, min_duration: int):
+        self._min_duration = min_duration
+        self._version += 1
+
+    @property
+    def ticks_per_beat(self) -> int:
+        """Returns number of ticks in a beat."""
+        return self._ticks_per_beat
+
+    @ticks_per_beat.setter
+    def ticks_per_beat(self, ticks_per_beat: int):
+        self._ticks_per_beat = ticks_per_beat
+        self._version += 1
+
+    @property
+    def pitches(self) -> memoryview:
+        """Returns read-only view of the column of note numbers."""
+        return memoryview(self._pitches).toreadonly()
+
+    @property
+    def start_times(self) -> memoryview:
+        """Returns read-only view of the column of note start times."""
+        return memoryview(self._start_times).toreadonly()
+
+    @property
+    def durations(self) -> memoryview:
+        """Returns read-only view of the column of note durations."""
+        return memoryview(self._durations).toreadonly()
+
+    @property
+    def columns(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns read-only NumPy views of columns of note numbers, start times and durations."""
+        columns = (np.frombuffer(self._pitches, dtype=np.uint16), np.frombuffer(self._start_times, dtype=np.uint32),
+                   np.frombuffer(self._durations, dtype=np.uint32))
+        for column in columns:
+            column.flags.writeable = False
+        return columns
+
+    def notes_slice(self, start: int, stop: int) -> List[CompositionNote]:
+        """Returns list of notes from start to stop index built from the columns."""
+        return list(map(CompositionNote.view, self._pitches[start:stop], self._start_times[start:stop],
+                        self._durations[start:stop]))
+
+    def at_beats(self, beats_num: int):
+        """Returns (composition, offsets). Notes of the composition are the notes of this one that start at the first
+        beats_num beats, ordered by start time, and offsets[i]:offsets[i + 1] are indices of its notes at beat i. The
+        composition is this one if its notes are such already, otherwise it is a copy."""
+        pitches, start_times, durations = self.columns
+        beat_times = np.arange(beats_num + 1) * self.ticks_per_beat
+        if np.all(start_times[1:] >= start_times[:-1]) and not np.any(start_times % self.ticks_per_beat) and \
+                (len(start_times) == 0 or start_times[-1] < beat_times[-1]):
+            return self, np.searchsorted(start_times, beat_times)
+        kept = np.flatnonzero((start_times % self.ticks_per_beat == 0) & (start_times < beat_times[-1]))
+        order = kept[np.argsort(start_times[kept], kind="stable")]
+        ordered = self.with_columns(pitches[order], start_times[order], durations[order])
+        return ordered, np.searchsorted(start_times[order], beat_times)
+
+    def replace_beats(self, chords: Dict[int, List[CompositionNote]], offsets: np.ndarray):
+        """Returns copy of the Composition with notes of each beat of chords replaced by the chord. offsets are the
+        ones of Composition.at_beats, notes of other beats are copied from the columns by slices."""
+        pitches, start_times, durations = array("H"), array("I"), array("I")
+        previous = 0
+        for beat in sorted(chords):
+            pitches += self._pitches[previous:offsets[beat]]
+            start_times += self._start_times[previous:offsets[beat]]
+            durations += self._durations[previous:offsets[beat]]
+            for note in chords[beat]:
+                pitches.append(note.note)
+                start_times.append(note.start_time)
+                durations.append(note.duration)
+            previous = offsets[beat + 1]
+        return self._with_columns(pitches + self._pitches[previous:], start_times + self._start_times[previous:],
+                                  durations + self._durations[previous:])
+
+    @cached_view
+    def notes_at(self) -> Mapping[int, Tuple[CompositionNote, ...]]:
         """Returns dict of start_time: notes that has this start_time."""
         notes_at = {}
         for note in self.notes:
-            notes_at[note.start_time] = notes_at.get(note.start_time, [])
-            notes_at[note.start_time].append(note)
-        return notes_at
+            notes_at.setdefault(note.start_time, []).append(note)
+        return MappingProxyType({time: tuple(notes) for time, notes in notes_at.items()})
 
     @property
     def as_midi(self) -> MidiFile:
@@ -42,58 +171,57 @@ class Composition:
         Note: order of messages in tracks matters
 
         """
-        mid = MidiFile(self.MIDI_TEMPLATE_PATH, clip=True)
-        mid.ticks_per_beat = self.ticks_per_beat
-        mid.tracks[0][1].tempo = self.tempo
-        mid.tracks[1] = mid.tracks[1][:2] + self.notes_to_midi_messages() + [mid.tracks[1][-1]]
-        if self.min_duration is not None:
-            mid.tracks[1][-1].time = self.min_duration - max([note.end_time for note in self.notes])
-        return mid
+        return MidiFile(file=io.BytesIO(self.to_midi_bytes()), clip=True)
 
-    @property
-    def triad_names_by_beats(self) -> List[Tuple[int, str]]:
+    def to_midi_bytes(self) -> bytes:
+        """Returns Composition as MIDI file bytes written into MIDI_TEMPLATE_PATH template (see MidiTemplate)."""
+        template = MidiTemplate.of(self.MIDI_TEMPLATE_PATH)
+        return template.file_bytes([self.midi_track_chunk(template)], self.tempo, self.ticks_per_beat)
+
+    def midi_track_chunk(self, template: MidiTemplate) -> bytes:
+        """Returns notes as MIDI track chunk of the template."""
+        return template.track_chunk(*self.columns, min_duration=self.min_duration)
+
+    @cached_view
+    def triad_names_by_beats(self) -> Tuple[Tuple[int, str], ...]:
         """Returns list of (base_note, chord_name) for each beat. Unknown chord are denoted (0, UNKNOWN_CHORD_NAME)."""
         notes_at = self.notes_at
         triad_names = []
         for time in range(0, self.duration + 1, self.ticks_per_beat):
-            current_notes = sorted(notes_at.get(time, []), key=lambda note: note.note)
-            min_chord_note = current_notes[0].note if len(current_notes) > 0 else 0
-            octave_note = (min_chord_note // 12) * 12
-            pure_notes = [note.note - octave_note for note in current_notes]
-            found = False
-            for triad_name, triad in NAME_TO_CHORD.items():
-                if pure_notes == triad:
-                    triad_names.append((min_chord_note, triad_name))
-                    found = True
-                    break
-            if not found:
+            current_notes = sorted([note.note for note in notes_at.get(time, [])])
+            code = chord_code(current_notes)
+            # chords are counted from the octave of their lowest note, so only chords rooted at C are recognized
+            triad_name = chord_name(code) if code_root(code) == 0 else None
+            if triad_name is not None:
+                triad_names.append((current_notes[0] if len(current_notes) > 0 else 0, triad_name))
+            else:
                 triad_names.append((0, UNKNOWN_CHORD_NAME))
-        return triad_names
+        return tuple(triad_names)
 
-    @lazy  # Attention: lazy
-    def notes_by_buckets(self) -> Dict[int, List[CompositionNote]]:
+    @cached_view
+    def notes_by_buckets(self) -> Mapping[int, Tuple[CompositionNote, ...]]:
         """Return dict of 4 quarter-start tick: notes that lie inside this 4 quarter-interval."""
         bucket_notes = {}
         for note in self.notes:
             bucket_tick = (note.start_time // self.ticks_per_beat) * self.ticks_per_beat
             bucket_notes[bucket_tick] = bucket_notes.get(bucket_tick, [])
             bucket_notes[bucket_tick].append(note)
-        return bucket_notes
+        return MappingProxyType({bucket_tick: tuple(notes) for bucket_tick, notes in bucket_notes.items()})
 
     def save_midi(self, filename: str):
         """Saves Composition at given path as MIDI file."""
-        self.as_midi.save(filename)
+        with open(filename, "wb") as midi_file:
+            midi_file.write(self.to_midi_bytes())
 
-    @property
+    @cached_view
     def key(self) -> Tuple[int, str]:
         """Returns the most probable key as (tonic (int[0-11]), scale (str["major"/"minor"]))"""
         MAJOR_KEY_OFFSETS = [0, 2, 4, 5, 7, 9, 11, 12]  # [0, 2, 2, 1, 2, 2, 2, 1]
         MINOR_KEY_OFFSETS = [0, 2, 3, 5, 7, 8, 10, 12]  # [0, 2, 1, 2, 2, 1, 2, 2]
-        min_note_num = self.notes[0].note
-        max_note_num = self.notes[0].note
+        min_note_num = self._pitches[0]
+        max_note_num = self._pitches[0]
         notes_used = {}
-        for note in self.notes:
-            note_num = note.note
+        for note_num in self._pitches:
             if note_num < min_note_num:
                 min_note_num = note_num
             if note_num > max_note_num:
@@ -122,27 +250,58 @@ class Composition:
                 max_similarity = minor_similarity
         return most_similar_key_tonic, most_similar_key_scale
 
-    @property
+    @cached_view
     def duration(self) -> int:
         """Returns duration in ticks."""
-        return max([note.end_time for note in self.notes] +
+        return max(list(map(add, self._start_times, self._durations)) +
                    ([self.min_duration] if self.min_duration is not None else []))
 
     def clone(self):
-        """Returns exact copy of the Composition."""
-        copy = Composition(notes=[note.clone() for note in self.notes], ticks_per_beat=self.ticks_per_beat,
-                           tempo=self.tempo)
+        """Returns exact copy of the Composition that shares columns and cached views with it."""
+        copy = self._with_columns(self._pitches, self._start_times, self._durations)
+        copy._version = self._version
+        copy._views = dict(self._views)
+        return copy
+
+    def to_compact(self) -> bytes:
+        """Returns notes packed as columns of note numbers, start times and durations one after another."""
+        return self._pitches.tobytes() + self._start_times.tobytes() + self._durations.tobytes()
+
+    def from_compact(self, packed_notes: bytes):
+        """Returns copy of the Composition with notes unpacked from Composition.to_compact result."""
+        pitches, start_times, durations = array("H"), array("I"), array("I")
+        notes_num = len(packed_notes) // (pitches.itemsize + start_times.itemsize + durations.itemsize)
+        start_times_offset = notes_num * pitches.itemsize
+        durations_offset = start_times_offset + notes_num * start_times.itemsize
+        pitches.frombytes(packed_notes[:start_times_offset])
+        start_times.frombytes(packed_notes[start_times_offset:durations_offset])
+        durations.frombytes(packed_notes[durations_offset:])
+        return self._with_columns(pitches, start_times, durations)
+
+    def with_columns(self, pitches: np.ndarray, start_times: np.ndarray, durations: np.ndarray):
+        """Returns Composition with metadata of this one and notes given by columns."""
+        return self._with_columns(array("H", np.asarray(pitches, dtype=np.uint16).tobytes()),
+                                  array("I", np.asarray(start_times, dtype=np.uint32).tobytes()),
+                                  array("I", np.asarray(durations, dtype=np.uint32).tobytes()))
+
+    def _with_columns(self, pitches: array, start_times: array, durations: array):
+        """Returns Composition with metadata of this one and the given columns."""
+        copy = Composition.__new__(Composition)
+        copy._midi_file = None
+        copy._version = 0
+        copy._views = {}
+        copy._pitches, copy._start_times, copy._durations = pitches, start_times, durations
+        copy.ticks_per_beat = self.ticks_per_beat
+        copy.tempo = self.tempo
         copy.min_duration = self.min_duration
         return copy
 
     def notes_to_midi_messages(self) -> List[Message]:
         messages = []
         times = {}
-        for note in self.notes:
-            times[note.start_time] = times.get(note.start_time, [])
-            times[note.start_time].append((note.note, "note_on"))
-            times[note.end_time] = times.get(note.end_time, [])
-            times[note.end_time].append((note.note, "note_off"))
+        for note, start_time, duration in zip(self._pitches, self._start_times, self._durations):
+            times.setdefault(start_time, []).append((note, "note_on"))
+            times.setdefault(start_time + duration, []).append((note, "note_off"))
         prev_time = 0
         for i, time in enumerate(sorted(times.keys())):
             for event in times[time]:
@@ -184,22 +343,42 @@ class Composition:
         sum_ = self.clone()
         if sum_.min_duration is None or (other.min_duration is not None and sum_.min_duration < other.min_duration):
             sum_.min_duration = other.min_duration
-        sum_.notes += [note.clone() for note in other.notes]
+        sum_._set_columns(self._pitches + other._pitches, self._start_times + other._start_times,
+                          self._durations + other._durations)
         return sum_
 
+    def __getstate__(self):
+        # cached views are not picklable and are computed again
+        state = dict(self.__dict__)
+        state["_views"] = {}
+        return state
+
+    def _set_columns(self, pitches: array, start_times: array, durations: array):
+        """Replaces columns of notes and invalidates cached views."""
+        self._pitches, self._start_times, self._durations = pitches, start_times, durations
+        self._version += 1
+
 
 def save_two_compostitions(melody: Composition, accompaniment: Composition, filename: str):
     """Saves two compositions as two tracks in single MIDI file."""
+    save_with_accompaniment(melody, accompaniment, filename)
+
+
+def save_with_accompaniment(melody: Composition, accompaniment: Composition, filename: str,
+                            accompaniment_filename: str = None):
+    """Saves two compositions as two tracks in single MIDI file and, if accompaniment_filename is given, the
+    accompaniment alone. Track of the accompaniment is encoded once for both files if they use the same template."""
     assert melody.ticks_per_beat == accompaniment.ticks_per_beat, "ticks_per_beat must be the same for each Composition"
     assert melody.tempo == accompaniment.tempo, "tempo must be the same for each Composition"
-    assert melody.ticks_per_beat == accompaniment.ticks_per_beat, "ticks_per_beat must be the same for each Composition"
-    mid = MidiFile(melody.MIDI_TEMPLATE_PATH, clip=True)
-    mid.ticks_per_beat = melody.ticks_per_beat
-    mid.tracks[0][1].tempo = melody.tempo
-    mid.tracks[1] = mid.tracks[1][:2] + melody.notes_to_midi_messages() + [mid.tracks[1][-1]]
-    if melody.min_duration is not None:
-        mid.tracks[1][-1].time = melody.min_duration - max([note.end_time for note in melody.notes])
-    mid.tracks.append(MidiTrack(mid.tracks[1][:2] + accompaniment.notes_to_midi_messages() + [mid.tracks[1][-1]]))
-    if accompaniment.min_duration is not None:
-        mid.tracks[2][-1].time = accompaniment.min_duration - max([note.end_time for note in accompaniment.notes])
-    mid.save(filename)
+    template = MidiTemplate.of(melody.MIDI_TEMPLATE_PATH)
+    accompaniment_chunk = accompaniment.midi_track_chunk(template)
+    with open(filename, "wb") as midi_file:
+        midi_file.write(template.file_bytes([melody.midi_track_chunk(template), accompaniment_chunk], melody.tempo,
+                                            melody.ticks_per_beat))
+    if accompaniment_filename is not None:
+        if accompaniment.MIDI_TEMPLATE_PATH != melody.MIDI_TEMPLATE_PATH:
+            accompaniment.save_midi(accompaniment_filename)
+            return
+        with open(accompaniment_filename, "wb") as midi_file:
+            midi_file.write(template.file_bytes([accompaniment_chunk], accompaniment.tempo,
+                                                accompaniment.ticks_per_beat))
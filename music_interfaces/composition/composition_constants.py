@@ -2,6 +2,11 @@
 MAJOR_TONIC = "major"
 MINOR_TONIC = "minor"
 
+# Key detection modes, see app_config.KEY_DETECTION
+LEGACY_KEY_DETECTION = "legacy"
+GLOBAL_KEY_DETECTION = "global"
+WINDOWED_KEY_DETECTION = "windowed"
+
 # Chords as offsets from lowest note
 # please keep chords sorted
 MAJOR_TRIAD = [0, 4, 7]
@@ -14,6 +19,8 @@ DIMINISHED_CHORD = [0, 3, 6]
 SUS2_CHORD = [0, 2, 7]
 SUS4_CHORD = [0, 5, 7]
 EMPTY_CHORD = []
+ACCOMPANIMENT_CHORDS = [MAJOR_TRIAD, MINOR_TRIAD, MAJOR_TRIAD_1I, MAJOR_TRIAD_2I, MINOR_TRIAD_1I, MINOR_TRIAD_2I,
+                        DIMINISHED_CHORD, SUS2_CHORD, SUS4_CHORD, EMPTY_CHORD]
 
 # Chord names
 MAJOR_TRIAD_NAME = "major_triad"
@@ -41,6 +48,9 @@ NAME_TO_CHORD = {
     EMPTY_CHORD_NAME: EMPTY_CHORD,
 }
 
+# Length of progression window in beats
+PROGRESSION_LEN = 4
+
 # Progressions list that is took from https://en.wikipedia.org/wiki/List_of_chord_progressions
 FIFTIES_PROGRESSION = [
     (0, MAJOR_TRIAD_NAME),
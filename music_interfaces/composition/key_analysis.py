@@ -0,0 +1,73 @@
+from typing import Sequence, Tuple
+
+import numpy as np
+
+from music_interfaces.composition.composition_constants import MAJOR_TONIC, MINOR_TONIC
+
+# Key is an index in 0..KEYS_NUM - 1: tonic is key % 12 and scale is KEY_SCALES[key // 12]. Keys are scored by
+# pitch class histograms of notes, a histogram has counts of notes of each pitch class.
+PITCH_CLASSES_NUM = 12
+KEY_SCALES = (MAJOR_TONIC, MINOR_TONIC)
+KEYS_NUM = PITCH_CLASSES_NUM * len(KEY_SCALES)
+# Krumhansl-Kessler key profiles, fit of each pitch class to a key by its offset from tonic
+SCALE_PROFILES = {
+    MAJOR_TONIC: [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+    MINOR_TONIC: [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+}
+
+
+def _key_profiles() -> np.ndarray:
+    """Returns profiles of all keys (KEYS_NUM x PITCH_CLASSES_NUM) centered and scaled to unit norm, so the product
+    with a histogram orders keys as correlation of the histogram with key profiles (Krumhansl-Schmuckler)."""
+    profiles = np.array([np.roll(SCALE_PROFILES[scale], tonic) for scale in KEY_SCALES
+                         for tonic in range(PITCH_CLASSES_NUM)])
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    return profiles / np.linalg.norm(profiles, axis=1, keepdims=True)
+
+
+def key_index(tonic: int, scale: str) -> int:
+    """Returns key of the tonic (int[0-11]) and scale (str["major"/"minor"])."""
+    return KEY_SCALES.index(scale) * PITCH_CLASSES_NUM + tonic % PITCH_CLASSES_NUM
+
+
+def key_name(key: int) -> Tuple[int, str]:
+    """Returns (tonic (int[0-11]), scale (str["major"/"minor"])) of the key."""
+    return key % PITCH_CLASSES_NUM, KEY_SCALES[key // PITCH_CLASSES_NUM]
+
+
+def pitch_class_histogram(pitches: Sequence[int]) -> np.ndarray:
+    """Returns counts of notes of each pitch class (PITCH_CLASSES_NUM,)."""
+    return np.bincount(np.asarray(pitches, dtype=np.int64) % PITCH_CLASSES_NUM, minlength=PITCH_CLASSES_NUM)
+
+
+def key_scores(histograms: np.ndarray) -> np.ndarray:
+    """Returns similarity of histograms (... x PITCH_CLASSES_NUM) to all keys (... x KEYS_NUM)."""
+    return histograms @ KEY_PROFILES.T
+
+
+def estimate_key(histogram: np.ndarray) -> int:
+    """Returns the most probable key of the histogram, the first of the keys with the best score."""
+    return int(np.argmax(key_scores(histogram)))
+
+
+def windowed_keys(beat_histograms: np.ndarray, window_beats: int, default_key: int) -> np.ndarray:
+    """Returns the most probable key at each beat (beats,) of histograms of notes at beats (beats x
+    PITCH_CLASSES_NUM).
+
+    Key at a beat is estimated by notes of window_beats beats around it, windows are shifted to fit the start of the
+    melody and cut at its end. Beats whose windows have no notes get default_key. All windows are scored at once by
+    prefix sums of histograms.
+
+    """
+    assert window_beats >= 1, "window_beats must be positive"
+    beats_num = len(beat_histograms)
+    prefix_sums = np.zeros((beats_num + 1, PITCH_CLASSES_NUM), dtype=np.int64)
+    np.cumsum(beat_histograms, axis=0, out=prefix_sums[1:])
+    starts = np.clip(np.arange(beats_num) - window_beats // 2, 0, beats_num)
+    stops = np.clip(starts + window_beats, 0, beats_num)
+    window_histograms = prefix_sums[stops] - prefix_sums[starts]
+    keys = np.argmax(key_scores(window_histograms), axis=1)
+    return np.where(window_histograms.any(axis=1), keys, default_key)
+
+
+KEY_PROFILES = _key_profiles()
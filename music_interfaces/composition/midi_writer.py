@@ -0,0 +1,123 @@
+import io
+import struct
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from mido import MidiFile, MidiTrack
+
+NOTE_ON_STATUS = 0x90
+NOTE_OFF_STATUS = 0x80
+NOTE_ON_VELOCITY = 50
+MAX_MIDI_NOTE = 127
+# bytes of variable-length quantity of MIDI delta times, 7 bits in each
+MAX_DELTA_BYTES = 4
+END_OF_TRACK = b"\x00\xff\x2f\x00"
+
+
+class MidiTemplate:
+    """MIDI file that compositions are written into, parsed once per process (see MidiTemplate.of).
+
+    Written file has the first track of the template with tempo of the composition at its second message. Notes of the
+    first composition are put into the second track of the template between its first two messages and its last one,
+    other tracks of the template follow, and further compositions are appended as tracks of the same form. Tracks are
+    encoded to bytes directly, note events without mido messages.
+
+    """
+    _templates: Dict[str, "MidiTemplate"] = {}
+
+    def __init__(self, path: str):
+        midi_file = MidiFile(path, clip=True)
+        self.path = path
+        self.type = midi_file.type
+        self._midi_file = midi_file
+        self._tempo_chunks = {}
+        notes_track = midi_file.tracks[1]
+        self._prefix = self._encode(notes_track[:2])[:-len(END_OF_TRACK)]
+        last_header_message = notes_track[1] if len(notes_track) > 1 else notes_track[0]
+        self._running_status = None if last_header_message.is_meta or last_header_message.type == "sysex" else \
+            last_header_message.bytes()[0]
+        self.end_time = notes_track[-1].time
+        # delta time of the last message is written separately
+        self._suffix = self._encode([notes_track[-1].copy(time=0)])[1:]
+        self._other_chunks = [_chunk(self._encode(track)) for track in midi_file.tracks[2:]]
+
+    @classmethod
+    def of(cls, path: str) -> "MidiTemplate":
+        """Returns template of the MIDI file at path, parsed at the first call with the path in the process."""
+        template = cls._templates.get(path)
+        if template is None:
+            template = cls._templates[path] = cls(path)
+        return template
+
+    def track_chunk(self, pitches: np.ndarray, start_times: np.ndarray, durations: np.ndarray,
+                    min_duration: Optional[int] = None) -> bytes:
+        """Returns track chunk of notes given by columns. If min_duration is given, end of track is placed at it."""
+        end_time = self.end_time
+        if min_duration is not None:
+            end_time = min_duration - int((start_times.astype(np.int64) + durations).max())
+            if end_time < 0:
+                raise ValueError("message time must be non-negative in MIDI file")
+        end_delta, used = _variable_int(np.array([end_time]))
+        return _chunk(self._prefix + note_events(pitches, start_times, durations, self._running_status) +
+                      end_delta[used].tobytes() + self._suffix)
+
+    def file_bytes(self, track_chunks: Sequence[bytes], tempo: int, ticks_per_beat: int) -> bytes:
+        """Returns MIDI file of track chunks of track_chunk, the first of them replaces the second track of the
+        template."""
+        tempo_chunk = self._tempo_chunks.get(tempo)
+        if tempo_chunk is None:
+            tempo_track = MidiTrack(self._midi_file.tracks[0])
+            tempo_track[1] = tempo_track[1].copy(tempo=tempo)
+            tempo_chunk = self._tempo_chunks[tempo] = _chunk(self._encode(tempo_track))
+        chunks = [tempo_chunk] + list(track_chunks[:1]) + self._other_chunks + list(track_chunks[1:])
+        return _chunk(struct.pack(">hhh", self.type, len(chunks), ticks_per_beat), b"MThd") + b"".join(chunks)
+
+    def _encode(self, messages: List) -> bytes:
+        """Returns track data of messages encoded by mido, ended by end of track."""
+        midi_file = MidiFile(type=self.type, charset=self._midi_file.charset)
+        midi_file.tracks.append(MidiTrack(messages))
+        output = io.BytesIO()
+        midi_file.save(file=output)
+        # header chunk and name and length of the track chunk
+        return output.getvalue()[14 + 8:]
+
+
+def note_events(pitches: np.ndarray, start_times: np.ndarray, durations: np.ndarray,
+                running_status: Optional[int] = None) -> bytes:
+    """Returns MIDI track data of note_on and note_off events of the notes, with running status after running_status.
+
+    Events are ordered by time, and events at the same time are ordered by notes with note_on before note_off of the
+    same note, as Composition.notes_to_midi_messages orders them.
+
+    """
+    if len(pitches) > 0 and int(np.max(pitches)) > MAX_MIDI_NOTE:
+        raise ValueError(f"note must be in range 0..{MAX_MIDI_NOTE}")
+    times = np.empty(2 * len(pitches), dtype=np.int64)
+    times[0::2] = start_times
+    times[1::2] = times[0::2] + durations
+    order = np.argsort(times, kind="stable")
+    is_on = order % 2 == 0
+    statuses = np.where(is_on, NOTE_ON_STATUS, NOTE_OFF_STATUS)
+    table = np.zeros((len(order), MAX_DELTA_BYTES + 3), dtype=np.uint8)
+    written = np.ones(table.shape, dtype=bool)
+    table[:, :MAX_DELTA_BYTES], written[:, :MAX_DELTA_BYTES] = _variable_int(np.diff(times[order], prepend=0))
+    table[:, MAX_DELTA_BYTES] = statuses
+    written[:, MAX_DELTA_BYTES] = statuses != np.concatenate([[running_status or -1], statuses[:-1]])
+    table[:, MAX_DELTA_BYTES + 1] = np.asarray(pitches)[order // 2]
+    table[:, MAX_DELTA_BYTES + 2] = np.where(is_on, NOTE_ON_VELOCITY, 0)
+    return table[written].tobytes()
+
+
+def _variable_int(values: np.ndarray) -> (np.ndarray, np.ndarray):
+    """Returns (bytes, used) arrays (values x MAX_DELTA_BYTES) of variable-length quantities of values, most
+    significant byte first, where only used bytes are written."""
+    values = values.astype(np.int64)
+    bytes_nums = 1 + sum((values >= 1 << 7 * i).astype(np.int64) for i in range(1, MAX_DELTA_BYTES))
+    groups = np.arange(MAX_DELTA_BYTES - 1, -1, -1)
+    encoded = (values[:, None] >> 7 * groups) & 0x7f | np.where(groups > 0, 0x80, 0)
+    return encoded.astype(np.uint8), groups < bytes_nums[:, None]
+
+
+def _chunk(data: bytes, name: bytes = b"MTrk") -> bytes:
+    """Returns chunk of MIDI file with data."""
+    return name + struct.pack(">L", len(data)) + data
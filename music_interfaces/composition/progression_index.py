@@ -0,0 +1,82 @@
+import json
+from typing import List, Sequence, Tuple
+
+from app_config import PROGRESSIONS_PATH
+from music_interfaces.composition.composition_constants import NAME_TO_CHORD, PROGRESSIONS, PROGRESSION_LEN
+
+Progression = List[Tuple[int, str]]
+
+
+class ProgressionIndex:
+    """Index of chord progressions for matching windows of (base_note, chord_name) triads, as
+    Composition.triad_names_by_beats gives them.
+
+    Progressions are normalized by transposition to their first chord and cut to window_len chords. Each window
+    position keeps bitsets of progressions by their (delta from the first base note, chord_name) step, so the best
+    partial match of a window takes O(window_len) operations on bitsets whatever the number of progressions, and
+    windows that complete a progression are found by hash of the whole window.
+
+    """
+    def __init__(self, progressions: Sequence[Progression], window_len: int = PROGRESSION_LEN):
+        assert window_len >= 1, "window_len must be positive"
+        self.window_len = window_len
+        self.progressions = [normalize_progression(progression)[:window_len] for progression in progressions]
+        self.sequences = set(tuple(progression) for progression in self.progressions if len(progression) == window_len)
+        self.position_masks = [{} for _ in range(window_len)]
+        for i, progression in enumerate(self.progressions):
+            for position, step in enumerate(progression):
+                self.position_masks[position][step] = self.position_masks[position].get(step, 0) | 1 << i
+
+    def done_partial_max(self, triads: Sequence[Tuple[int, str]]) -> int:
+        """Returns the maximal number of window triads that match the same positions of one progression."""
+        assert len(triads) == self.window_len, "window must have window_len triads"
+        steps = tuple((base_note - triads[0][0], name) for base_note, name in triads)
+        if steps in self.sequences:
+            return self.window_len
+        # bit-sliced counters: bit k of counters[j] is bit j of the number of matched steps of progression k
+        counters = []
+        for position, step in enumerate(steps):
+            carry = self.position_masks[position].get(step, 0)
+            for j in range(len(counters)):
+                if carry == 0:
+                    break
+                counters[j], carry = counters[j] ^ carry, counters[j] & carry
+            if carry != 0:
+                counters.append(carry)
+        done_partial_max = 0
+        candidates = -1  # all progressions
+        for j in reversed(range(len(counters))):
+            if candidates & counters[j]:
+                candidates &= counters[j]
+                done_partial_max |= 1 << j
+        return done_partial_max
+
+
+def normalize_progression(progression: Progression) -> Progression:
+    """Returns progression with deltas counted from its first chord."""
+    first_delta = progression[0][0] if len(progression) > 0 else 0
+    return [(delta - first_delta, name) for delta, name in progression]
+
+
+def load_progressions(path: str) -> List[Progression]:
+    """Returns progressions from JSON file with object of progression name: list of [delta, chord_name] pairs.
+
+    Progressions may have any positive length. Windows of PROGRESSION_LEN beats are matched against the first
+    PROGRESSION_LEN chords of a progression, so shorter progressions can be matched only partially.
+
+    """
+    with open(path) as file:
+        progressions = json.load(file)
+    assert isinstance(progressions, dict), "progressions file must contain object of progression name: chords"
+    loaded = []
+    for progression_name, chords in progressions.items():
+        assert len(chords) > 0, f"progression {progression_name} is empty"
+        for delta, chord_name in chords:
+            assert isinstance(delta, int), f"delta {delta} of progression {progression_name} must be integer"
+            assert chord_name in NAME_TO_CHORD, f"unknown chord {chord_name} in progression {progression_name}"
+        loaded.append([(delta, chord_name) for delta, chord_name in chords])
+    return loaded
+
+
+PROGRESSION_INDEX = ProgressionIndex(load_progressions(PROGRESSIONS_PATH) if PROGRESSIONS_PATH is not None
+                                     else PROGRESSIONS)
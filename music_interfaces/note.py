@@ -1,5 +1,7 @@
 class Note:
     """Note object that contain note number and duration of its play."""
+    __slots__ = ("note", "duration")
+
     def __init__(self, note: int, duration: int):
         assert note >= 0, "note must be positive"
         assert duration >= 0, "duration must be positive"
@@ -9,11 +11,22 @@ class Note:
 
 class CompositionNote(Note):
     """Note object that has start_time of play."""
+    __slots__ = ("start_time",)
+
     def __init__(self, note: int, start_time: int, duration: int):
         super().__init__(note=note, duration=duration)
         assert start_time >= 0, "start_time must be positive"
         self.start_time = start_time
 
+    @classmethod
+    def view(cls, note: int, start_time: int, duration: int):
+        """Returns note of values that are known to be valid, e.g. read from columns of Composition."""
+        view = cls.__new__(cls)
+        view.note = note
+        view.start_time = start_time
+        view.duration = duration
+        return view
+
     @property
     def end_time(self) -> int:
         """Returns end time of play."""
@@ -21,4 +34,4 @@ class CompositionNote(Note):
 
     def clone(self):
         """Returns exact copy of the note."""
-        return CompositionNote(note=self.note, start_time=self.start_time, duration=self.duration)
+        return CompositionNote.view(self.note, self.start_time, self.duration)
@@ -0,0 +1,132 @@
+import os
+import random
+import unittest
+from typing import List, Tuple
+
+import mido
+import numpy as np
+
+from genetic_algorithm.crossover_strategy import make_crossover, make_genome_crossover
+from genetic_algorithm.dp_solver import DPSolver
+from genetic_algorithm.fitness_function.batch_fitness_function import batch_fitness_function, \
+    compositions_to_chords
+from genetic_algorithm.fitness_function.fitness_function import fitness_function
+from genetic_algorithm.fitness_function.incremental_fitness_function import IncrementalFitnessFunction
+from genetic_algorithm.fitness_function.table_fitness_function import TableFitnessFunction
+from genetic_algorithm.genome import Genome, GENOME_DTYPE
+from genetic_algorithm.local_search import LocalSearch
+from genetic_algorithm.melody_context import MelodyContext
+from genetic_algorithm.mutation_strategy import get_random_candidate, get_random_genome, make_mutation, \
+    make_genome_mutation
+from music_interfaces.composition.composition import Composition
+from music_interfaces.note import CompositionNote
+
+INPUT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "input")
+SEED = 0
+CANDIDATES_NUM = 6
+MUTATION_CHANCE = 0.3
+SIMILARITY_TO_SINGLE_PARENT = 0.5
+TICKS_PER_BEAT = 384
+TEMPO = 500000
+# melodies of these lengths in beats cover every beats_num % PROGRESSION_LEN
+SYNTHETIC_BEATS_NUMS = range(4, 12)
+# input1 is also cut to this number of beats, so the last progression window ends after the last beat
+CUT_BEATS_NUM = 27
+
+
+def _melodies() -> List[Tuple[str, Composition]]:
+    """Returns (name, melody) of input melodies, input1 cut to CUT_BEATS_NUM beats, synthetic melodies and melodies
+    with min_duration after the last note."""
+    rng = random.Random(SEED)
+    melodies = [(file_name, Composition(midi_file=mido.MidiFile(os.path.join(INPUT_DIR, file_name))))
+                for file_name in sorted(os.listdir(INPUT_DIR)) if file_name.lower().endswith(".mid")]
+    cut = dict(melodies)["input1.mid"].clone()
+    cut.notes = [note for note in cut.notes if note.start_time + note.duration <= CUT_BEATS_NUM * cut.ticks_per_beat]
+    cut.min_duration = None
+    melodies.append((f"input1_{CUT_BEATS_NUM}_beats", cut))
+    for beats_num in SYNTHETIC_BEATS_NUMS:
+        notes = [CompositionNote(rng.randrange(60, 84), beat * TICKS_PER_BEAT, TICKS_PER_BEAT)
+                 for beat in range(beats_num)]
+        melodies.append((f"synthetic_{beats_num}",
+                         Composition(notes=notes, ticks_per_beat=TICKS_PER_BEAT, tempo=TEMPO)))
+        longer = Composition(notes=notes, ticks_per_beat=TICKS_PER_BEAT, tempo=TEMPO)
+        longer.min_duration = (beats_num + rng.randrange(1, 6)) * TICKS_PER_BEAT
+        melodies.append((f"synthetic_{beats_num}_longer", longer))
+    return melodies
+
+
+class FitnessFunctionsTest(unittest.TestCase):
+    """Checks that all fitness functions and the DP engine give the same values as fitness_function."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.melodies = _melodies()
+
+    def setUp(self):
+        random.seed(SEED)
+        np.random.seed(SEED)
+
+    def assert_fitnesses_equal(self, expected: List[float], actual: List[float], name: str):
+        for i, (expected_fitness, actual_fitness) in enumerate(zip(expected, actual)):
+            self.assertAlmostEqual(expected_fitness, float(actual_fitness), places=6, msg=f"{name}, candidate {i}")
+
+    def test_compositions(self):
+        for name, melody in self.melodies:
+            with self.subTest(melody=name):
+                melody_context = MelodyContext(melody)
+                incremental = IncrementalFitnessFunction(melody_context)
+                table = TableFitnessFunction(melody_context)
+                parents = [get_random_candidate(melody_context) for _ in range(CANDIDATES_NUM)]
+                # parents get fitness states, so children are evaluated incrementally
+                for parent in parents:
+                    incremental(melody_context, parent)
+                children = []
+                for i in range(0, CANDIDATES_NUM, 2):
+                    children += make_crossover(parents[i], parents[i + 1], SIMILARITY_TO_SINGLE_PARENT)
+                children += [make_mutation(child, MUTATION_CHANCE) for child in children]
+                candidates = parents + children
+                expected = [fitness_function(melody_context, candidate) for candidate in candidates]
+                self.assert_fitnesses_equal(expected, batch_fitness_function(melody_context, candidates),
+                                            f"batch {name}")
+                self.assert_fitnesses_equal(expected, table.batch(melody_context, candidates), f"table {name}")
+                self.assert_fitnesses_equal(expected, [incremental(melody_context, candidate)
+                                                       for candidate in candidates], f"incremental {name}")
+
+    def test_genomes(self):
+        for name, melody in self.melodies:
+            with self.subTest(melody=name):
+                melody_context = MelodyContext(melody)
+                table = TableFitnessFunction(melody_context)
+                parents = [get_random_genome(melody_context) for _ in range(CANDIDATES_NUM)]
+                children = []
+                for i in range(0, CANDIDATES_NUM, 2):
+                    children += make_genome_crossover(parents[i], parents[i + 1], SIMILARITY_TO_SINGLE_PARENT)
+                children += [make_genome_mutation(child, MUTATION_CHANCE) for child in children]
+                genomes = parents + children
+                expected = [fitness_function(melody_context, genome.to_composition(melody_context))
+                            for genome in genomes]
+                fitnesses = table.batch(melody_context, genomes)
+                self.assert_fitnesses_equal(expected, fitnesses, f"table {name}")
+                local_search = LocalSearch(table, interval=1, elite_num=1)
+                improved = [local_search.improve_genome(genome, float(fitness))
+                            for genome, fitness in zip(genomes, fitnesses)]
+                self.assert_fitnesses_equal([fitness_function(melody_context, genome.to_composition(melody_context))
+                                             for genome, _ in improved],
+                                            [fitness for _, fitness in improved], f"local search {name}")
+
+    def test_dp_solver(self):
+        for name, melody in self.melodies:
+            with self.subTest(melody=name):
+                melody_context = MelodyContext(melody)
+                accompaniment, fitness = DPSolver(melody_context).solve()
+                self.assertAlmostEqual(fitness_function(melody_context, accompaniment), fitness, places=6)
+                table = TableFitnessFunction(melody_context)
+                self.assertAlmostEqual(table(melody_context, accompaniment), fitness, places=6)
+                chords, _ = compositions_to_chords([accompaniment], melody_context.ticks_per_beat)
+                states, _ = table.tables.states_of(chords)
+                genome = Genome(states[0, :melody_context.beats_num].astype(GENOME_DTYPE))
+                self.assertAlmostEqual(table(melody_context, genome), fitness, places=6)
+
+
+if __name__ == "__main__":
+    unittest.main()